@@ -1,22 +1,47 @@
-from typing import List
+import importlib
+import shutil
+from pathlib import Path
+from typing import List, Optional
 
+import click
 import typer
-from pysh import which
+from typer.core import TyperGroup
 
-from stb import config, db, graph, run, update, use
 from stb.__version__ import __version__
 
+
+class LazyTyperGroup(TyperGroup):
+    """I import the module of a command group only when that group is invoked.
+
+    This way `stb --version` or `stb update env` don't pay for importing gitlab, requests, keyring, and others.
+    """
+
+    lazy_subcommands = {
+        "config": "stb.config:config_app",
+        "db": "stb.db:app",
+        "graph": "stb.graph:app",
+        "update": "stb.update:app",
+    }
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted({*super().list_commands(ctx), *self.lazy_subcommands})
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name in self.lazy_subcommands:
+            module_name, attribute = self.lazy_subcommands[cmd_name].split(":")
+            command = typer.main.get_group(getattr(importlib.import_module(module_name), attribute))
+            command.name = cmd_name
+            return command
+        return super().get_command(ctx, cmd_name)
+
+
 app = typer.Typer(
     name="stb",
+    cls=LazyTyperGroup,
     add_completion=False,
     help="Stanislav's Toolbox (stb) helps you manage your local microservices. Specifically, it can set them up for you, create/delete/migrate databases, manage service ports and .env files, and much more",
 )
 
-app.add_typer(db.app, name="db")
-app.add_typer(update.app)
-app.add_typer(config.config_app)
-app.add_typer(graph.app)
-
 
 def version_callback(value: bool):
     if value:
@@ -40,6 +65,8 @@ def use_(
     ),
 ) -> None:
     """Switches the version of a company package in the current project. For example, `stb use my_package 0.1.0` or `stb use my_package ~/package`"""
+    from stb import use
+
     return use.use_packages(requirements, editable, fix)
 
 
@@ -49,37 +76,80 @@ def run_(
         help="The select services to checkout and run together at the same time",
     ),
 ) -> None:
+    from stb import run
+
     return run.run_services(set(services))
 
 
-if which("concurrently"):
+if shutil.which("concurrently"):
     run_ = app.command(name="run")(run_)
 
-try:
+
+@app.command(name="setup")
+def setup_(
+    services: List[str] = typer.Argument(
+        ...,
+        help="Names of services to setup. For example, use 'my_company/backend/oatmeal' to setup oatmeal service in the backend namespace",
+    ),
+    skip_existing: bool = typer.Option(True, help="Automatically skip existing services"),
+    update_env: bool = typer.Option(True, help="Generate .env settings files"),
+    update_ports: bool = typer.Option(True, help="Add dependended services' ports to .env settings files"),
+    setup_poetry_env: bool = typer.Option(True, help="Pick the correct python version and install dependencies"),
+    workers: int = typer.Option(8, "-j", "--workers", min=1, help="Number of repositories to clone at the same time"),
+    install_workers: int = typer.Option(
+        4, min=1, help="Number of repositories to install dependencies for at the same time"
+    ),
+    refresh: bool = typer.Option(False, help="Redownload the cached list of gitlab projects"),
+) -> None:
+    """Does the initial localhost setup of microservices. Downloads, configures .env, inits submodules, installs the correct pyenv environment, creates the correct poetry environment, and installs dependencies"""
     from stb import setup
 
-    @app.command(name="setup")
-    def setup_(
-        services: List[str] = typer.Argument(
-            ...,
-            help="Names of services to setup. For example, use 'my_company/backend/oatmeal' to setup oatmeal service in the backend namespace",
-        ),
-        skip_existing: bool = typer.Option(True, help="Automatically skip existing services"),
-        update_env: bool = typer.Option(True, help="Generate .env settings files"),
-        update_ports: bool = typer.Option(True, help="Add dependended services' ports to .env settings files"),
-        setup_poetry_env: bool = typer.Option(True, help="Pick the correct python version and install dependencies"),
-    ) -> None:
-        """Does the initial localhost setup of microservices. Downloads, configures .env, inits submodules, installs the correct pyenv environment, creates the correct poetry environment, and installs dependencies"""
-        return setup.setup_services(
-            services,
-            skip_existing,
-            update_env=update_env,
-            update_ports=update_ports,
-            setup_poetry_env=setup_poetry_env,
-        )
-
-except ImportError:
-    pass
+    return setup.setup_services(
+        services,
+        skip_existing,
+        update_env=update_env,
+        update_ports=update_ports,
+        setup_poetry_env=setup_poetry_env,
+        clone_workers=workers,
+        install_workers=install_workers,
+        refresh_catalog=refresh,
+    )
+
+
+@app.command(name="status")
+def status_(
+    service_paths: Optional[List[Path]] = typer.Argument(
+        None,
+        help="Paths to service directories or root directories that contain multiple services. Current working directory by default",
+        dir_okay=True,
+        file_okay=False,
+        exists=True,
+        show_default=False,
+    ),
+    fetch: bool = typer.Option(
+        False, "-f", "--fetch", help="Fetch from the remotes first to get fresh ahead/behind counts"
+    ),
+    output_json: bool = typer.Option(False, "--json", help="Print the statuses as JSON instead of a table"),
+    workers: int = typer.Option(16, "-j", "--workers", min=1, help="Number of repositories to query at the same time"),
+    fetch_timeout: float = typer.Option(30, help="Seconds to wait for a single git fetch"),
+    recursive: bool = typer.Option(
+        False,
+        "--recursive",
+        help="Look for services in all subdirectories of the root directories instead of only in their direct subdirectories",
+    ),
+    max_depth: Optional[int] = typer.Option(
+        None,
+        "--max-depth",
+        min=1,
+        help="How many levels of subdirectories to look for services in. Implies --recursive",
+    ),
+) -> None:
+    """Shows the branch, uncommitted changes, and ahead/behind counts of every service without changing anything"""
+    from stb import status
+
+    return status.show_status(
+        service_paths or [Path.cwd()], fetch, output_json, workers, fetch_timeout, recursive, max_depth
+    )
 
 
 @app.callback()
@@ -0,0 +1,242 @@
+import datetime
+import itertools
+import json
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import quote
+
+import requests
+import requests.adapters
+
+from .config import CONFIG, get_cache_dir, get_gitlab_api_url
+from .utils.common import atomic_write_text
+
+GITLAB_MAX_PER_PAGE = 100
+GITLAB_PAGE_FETCH_WORKERS = 8
+CATALOG_FORMAT_VERSION = 1
+CATALOG_TTL = datetime.timedelta(minutes=30)
+# Incremental syncs can't see the projects that were deleted or became inaccessible, only full listings can
+CATALOG_RELIST_INTERVAL = datetime.timedelta(days=1)
+# Gitlab updates last_activity_at at most once an hour so we ask for a bit more than we need
+LAST_ACTIVITY_PRECISION = datetime.timedelta(hours=1)
+INSTANCE_SCOPE = ""
+
+
+@dataclass(frozen=True)
+class CatalogProject:
+    id: int
+    path: str
+    path_with_namespace: str
+    name: str
+    name_with_namespace: str
+    ssh_url_to_repo: str
+    default_branch: Optional[str]
+    last_activity_at: str
+
+    @classmethod
+    def from_api(cls, project: Dict[str, Any]) -> "CatalogProject":
+        return cls(**{field: project.get(field) for field in cls.__dataclass_fields__})
+
+
+class ProjectCatalog:
+    """I am a local copy of the gitlab project list with a sorted index of project paths for fast prefix lookups.
+
+    Scopes are the groups that have been fully listed at least once. Everything inside them is kept up to date
+    by incrementally asking gitlab only for the projects of the scopes that were active since the last sync.
+    Once in a CATALOG_RELIST_INTERVAL, the scopes are listed from scratch to drop the projects that are gone.
+    """
+
+    def __init__(self, path: Path, git_url: str) -> None:
+        self.path = path
+        self.git_url = git_url
+        self.synced_at: Optional[datetime.datetime] = None
+        self.listed_at: Optional[datetime.datetime] = None
+        self.scopes: List[str] = []
+        self.projects: Dict[int, CatalogProject] = {}
+        self._index: Optional[List[str]] = None
+        self._by_path: Dict[str, CatalogProject] = {}
+
+    @classmethod
+    def load(cls, path: Path, git_url: str) -> "ProjectCatalog":
+        catalog = cls(path, git_url)
+        if not path.is_file():
+            return catalog
+        try:
+            data = json.loads(path.read_text())
+        except json.JSONDecodeError:
+            return catalog
+        if data.get("version") != CATALOG_FORMAT_VERSION or data.get("git_url") != git_url:
+            return catalog
+        catalog.synced_at = datetime.datetime.fromisoformat(data["synced_at"]) if data["synced_at"] else None
+        catalog.listed_at = datetime.datetime.fromisoformat(data["listed_at"]) if data.get("listed_at") else None
+        catalog.scopes = data["scopes"]
+        catalog.upsert(CatalogProject(**p) for p in data["projects"])
+        return catalog
+
+    def save(self) -> None:
+        data = {
+            "version": CATALOG_FORMAT_VERSION,
+            "git_url": self.git_url,
+            "synced_at": self.synced_at.isoformat() if self.synced_at else None,
+            "listed_at": self.listed_at.isoformat() if self.listed_at else None,
+            "scopes": self.scopes,
+            "projects": [asdict(p) for p in self.projects.values()],
+        }
+        atomic_write_text(self.path, json.dumps(data))
+
+    def upsert(self, projects: Iterable[CatalogProject]) -> None:
+        for project in projects:
+            self.projects[project.id] = project
+        self._index = None
+
+    def covers(self, name: str) -> bool:
+        return any(self._scope_contains(scope, name) for scope in self.scopes)
+
+    def is_stale(self, now: datetime.datetime) -> bool:
+        return self.synced_at is not None and now - self.synced_at > CATALOG_TTL
+
+    def find(self, prefix: str) -> List[CatalogProject]:
+        """Returns all projects whose path_with_namespace starts with the prefix, sorted by path"""
+        if self._index is None:
+            self._by_path = {p.path_with_namespace: p for p in self.projects.values()}
+            self._index = sorted(self._by_path)
+        found = []
+        for path in itertools.islice(self._index, bisect_left(self._index, prefix), None):
+            if not path.startswith(prefix):
+                break
+            found.append(self._by_path[path])
+        return found
+
+    def sync_scope(self, scope: str, session: requests.Session, now: datetime.datetime) -> None:
+        self.upsert(self._list_scope(scope, session))
+        self.scopes.append(scope)
+        if self.synced_at is None:
+            self.synced_at = now
+        if self.listed_at is None:
+            self.listed_at = now
+
+    def sync_changes(self, session: requests.Session, now: datetime.datetime) -> None:
+        assert self.synced_at is not None
+        if self.listed_at is None or now - self.listed_at > CATALOG_RELIST_INTERVAL:
+            self.relist(session, now)
+            return
+        last_activity_after = (self.synced_at - LAST_ACTIVITY_PRECISION).isoformat()
+        for scope in self._get_outermost_scopes():
+            self.upsert(self._list_scope(scope, session, {"last_activity_after": last_activity_after}))
+        self.synced_at = now
+
+    def relist(self, session: requests.Session, now: datetime.datetime) -> None:
+        """Replaces the projects with a full listing of every scope"""
+        projects = [project for scope in self._get_outermost_scopes() for project in self._list_scope(scope, session)]
+        self.projects = {}
+        self.upsert(projects)
+        self.synced_at = self.listed_at = now
+
+    def _get_outermost_scopes(self) -> List[str]:
+        """Listing a group also lists its subgroups so the scopes inside other scopes don't need to be listed again"""
+        return [
+            scope
+            for scope in dict.fromkeys(self.scopes)
+            if not any(other != scope and self._scope_contains(other, scope) for other in self.scopes)
+        ]
+
+    @staticmethod
+    def _scope_contains(scope: str, name: str) -> bool:
+        return scope == INSTANCE_SCOPE or name == scope or name.startswith(scope + "/")
+
+    @staticmethod
+    def _list_scope(
+        scope: str, session: requests.Session, params: Optional[Dict[str, str]] = None
+    ) -> Iterator[CatalogProject]:
+        if scope == INSTANCE_SCOPE:
+            url, scope_params = f"{get_gitlab_api_url()}/projects", {"simple": "true"}
+        else:
+            url = f"{get_gitlab_api_url()}/groups/{quote(scope, safe='')}/projects"
+            scope_params = {"simple": "true", "include_subgroups": "true"}
+        for project in paginated_get(url, session, {**scope_params, **(params or {})}):
+            yield CatalogProject.from_api(project)
+
+
+def find_projects(names: List[str], refresh: bool = False) -> Dict[str, List[CatalogProject]]:
+    """Resolves project path prefixes against the local catalog, syncing it with gitlab only when necessary"""
+    git_url = CONFIG["git_url"]
+    path = get_cache_dir() / "gitlab" / f"{git_url.split('@')[-1]}.json"
+    catalog = ProjectCatalog(path, git_url) if refresh else ProjectCatalog.load(path, git_url)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    session: Optional[requests.Session] = None
+    try:
+        if catalog.is_stale(now):
+            session = gitlab_session()
+            catalog.sync_changes(session, now)
+        for name in names:
+            if not catalog.covers(name):
+                session = session or gitlab_session()
+                catalog.sync_scope(find_enclosing_group(name, session) or INSTANCE_SCOPE, session, now)
+    finally:
+        if session is not None:
+            session.close()
+            catalog.save()
+    return {name: catalog.find(name) for name in names}
+
+
+def find_enclosing_group(name: str, session: requests.Session) -> Optional[str]:
+    """Finds the longest group path that contains all projects starting with the name. For example, 'a/b' for 'a/b/c'"""
+    path_parts = name.strip("/").split("/")
+    for end in range(len(path_parts), 0, -1):
+        group = "/".join(path_parts[:end])
+        response = session.get(
+            f"{get_gitlab_api_url()}/groups/{quote(group, safe='')}", params={"with_projects": "false"}
+        )
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        return group
+
+
+def gitlab_session(pool_size: int = GITLAB_PAGE_FETCH_WORKERS) -> requests.Session:
+    """Creates a session that keeps enough connections alive for pool_size concurrent requests"""
+    session = requests.Session()
+    session.headers["PRIVATE-TOKEN"] = CONFIG.get_api_token()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def paginated_get(
+    url: str, session: requests.Session, params: Optional[Dict[str, str]] = None
+) -> Iterator[Dict[str, Any]]:
+    """Yields the records of a paginated gitlab api response page by page, fetching several pages at the same time"""
+    params = {**(params or {}), "per_page": str(GITLAB_MAX_PER_PAGE)}
+    response = _get_page(session, url, params)
+    yield from response.json()
+
+    if "X-Total-Pages" not in response.headers:
+        # Gitlab omits the page count for very large collections so we have to follow the links one by one
+        while "next" in response.links:
+            response = _get_page(session, response.links["next"]["url"])
+            yield from response.json()
+        return
+
+    remaining_pages = iter(range(2, int(response.headers["X-Total-Pages"]) + 1))
+    with ThreadPoolExecutor(GITLAB_PAGE_FETCH_WORKERS) as executor:
+        # We only keep a few pages in flight so that memory usage doesn't depend on the number of projects
+        pending = {
+            executor.submit(_get_page, session, url, {**params, "page": str(page)})
+            for page in itertools.islice(remaining_pages, GITLAB_PAGE_FETCH_WORKERS)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for page in itertools.islice(remaining_pages, 1):
+                    pending.add(executor.submit(_get_page, session, url, {**params, "page": str(page)}))
+                yield from future.result().json()
+
+
+def _get_page(session: requests.Session, url: str, params: Optional[Dict[str, str]] = None) -> requests.Response:
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    return response
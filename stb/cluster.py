@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import typer
+
+from .utils.common import (
+    MAX_DEPTH_ARG,
+    RECURSIVE_ARG,
+    SERVICE_PATHS_ARG,
+    add_default_service_path,
+    atomic_write_text,
+    gather_services,
+    get_discovery_depth,
+    get_service,
+    save_dotenv_file,
+)
+from .utils.postgres import PostgresError, PostgresServer, query, quote_identifier, quote_literal
+
+app = typer.Typer(
+    name="cluster",
+    help="starts throwaway in-memory postgres clusters for your services to make their databases faster to reset and migrate",
+)
+RAM_BACKED_DIRS = Path("/dev/shm"), Path("/run/shm")
+# The cluster is deleted on `down` anyway so we trade away all durability for speed
+CLUSTER_SETTINGS = {
+    "listen_addresses": "'localhost'",
+    "max_connections": "200",
+    "fsync": "off",
+    "synchronous_commit": "off",
+    "full_page_writes": "off",
+    "wal_level": "minimal",
+    "max_wal_senders": "0",
+    "max_wal_size": "1GB",
+    "checkpoint_timeout": "1d",
+    "autovacuum": "off",
+}
+
+
+@app.command()
+@add_default_service_path
+def up(
+    service_paths: List[Path] = SERVICE_PATHS_ARG,
+    port: Optional[int] = typer.Option(None, help="Port for the cluster. A free port is picked by default"),
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
+):
+    """Start a throwaway postgres cluster in memory and point POSTGRES_PORT of the services to it"""
+    state_path = get_cluster_state_path(service_paths)
+    if state_path.is_file():
+        state = json.loads(state_path.read_text())
+        if is_cluster_running(Path(state["data_dir"])):
+            typer.echo(f"The cluster for these services is already running on port {state['port']}")
+            return
+        # A reboot wipes RAM-backed directories and a crash leaves the cluster dead but its state in place
+        typer.echo(f"The cluster on port {state['port']} is gone so a new one will be started", err=True)
+        stop_cluster(Path(state["data_dir"]))
+        restore_service_ports(state)
+        state_path.unlink()
+
+    services = gather_services(service_paths, load=("dotenv",), max_depth=get_discovery_depth(recursive, max_depth))
+    if not services:
+        typer.echo("No services found", err=True)
+        raise typer.Exit(1)
+
+    port = port or find_free_port()
+    users = {
+        service.dotenv.get("POSTGRES_USER") or "postgres": service.dotenv.get("POSTGRES_PASSWORD") or ""
+        for service in services.values()
+    }
+    data_dir = Path(tempfile.mkdtemp(prefix="stb-cluster-", dir=get_ram_backed_dir()))
+    typer.echo(f"Starting a postgres cluster in {data_dir} on port {port}")
+    try:
+        start_cluster(data_dir, port, users)
+    except Exception:
+        stop_cluster(data_dir)
+        raise
+
+    state = {
+        "data_dir": str(data_dir),
+        "port": port,
+        "services": {str(service.dir): service.dotenv.get("POSTGRES_PORT") for service in services.values()},
+    }
+    atomic_write_text(state_path, json.dumps(state, indent=4))
+    for service in services.values():
+        service.dotenv["POSTGRES_PORT"] = str(port)
+        if save_dotenv_file(service) is not None:
+            typer.echo(f"Updated {service.dotenv_path}")
+
+
+@app.command()
+@add_default_service_path
+def down(service_paths: List[Path] = SERVICE_PATHS_ARG):
+    """Stop the cluster started by `stb db cluster up` for the same services, delete it, and restore their POSTGRES_PORT"""
+    state_path = get_cluster_state_path(service_paths)
+    if not state_path.is_file():
+        typer.echo("There is no cluster running for these services", err=True)
+        raise typer.Exit(1)
+    state = json.loads(state_path.read_text())
+    stop_cluster(Path(state["data_dir"]))
+    restore_service_ports(state)
+    state_path.unlink()
+    typer.echo(f"Stopped the cluster on port {state['port']}")
+
+
+def restore_service_ports(state: Dict[str, Any]) -> None:
+    for service_dir, original_port in state["services"].items():
+        if not Path(service_dir).is_dir():
+            continue
+        service = get_service(Path(service_dir))
+        if original_port is None:
+            service.dotenv.pop("POSTGRES_PORT", None)
+        else:
+            service.dotenv["POSTGRES_PORT"] = original_port
+        if save_dotenv_file(service) is not None:
+            typer.echo(f"Updated {service.dotenv_path}")
+
+
+def is_cluster_running(data_dir: Path) -> bool:
+    """The first line of postmaster.pid is the pid of the server, which is only worth something while it's alive"""
+    try:
+        pid = int((data_dir / "postmaster.pid").read_text().split("\n", 1)[0])
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def start_cluster(data_dir: Path, port: int, users: Dict[str, str]) -> None:
+    superuser, *other_users = users
+    run_postgres_tool("initdb", "-D", str(data_dir), "-U", superuser, "--auth=trust", "-E", "UTF8", "--no-sync")
+    settings = {**CLUSTER_SETTINGS, "port": str(port), "unix_socket_directories": f"'{data_dir}'"}
+    with (data_dir / "postgresql.conf").open("a") as f:
+        f.write("\n# Added by stb\n" + "".join(f"{key} = {value}\n" for key, value in settings.items()))
+    run_postgres_tool("pg_ctl", "-D", str(data_dir), "-l", str(data_dir / "server.log"), "-w", "start")
+
+    server = PostgresServer("localhost", port, superuser, users[superuser])
+    try:
+        for user in other_users:
+            query(
+                server,
+                f"CREATE ROLE {quote_identifier(user)} SUPERUSER LOGIN PASSWORD {quote_literal(users[user])}",
+            )
+    except PostgresError as e:
+        raise RuntimeError(f"Failed to create the users of the cluster: {e}") from e
+
+
+def stop_cluster(data_dir: Path) -> None:
+    if (data_dir / "postmaster.pid").is_file():
+        # Nothing in the cluster is worth saving so we don't wait for a checkpoint
+        run_postgres_tool("pg_ctl", "-D", str(data_dir), "-m", "immediate", "-w", "stop")
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def run_postgres_tool(name: str, *args: str) -> None:
+    process = subprocess.run([find_postgres_tool(name), *args], capture_output=True, text=True)
+    if process.returncode:
+        raise RuntimeError(f"{name} failed: {process.stderr.strip() or process.stdout.strip()}")
+
+
+def find_postgres_tool(name: str) -> str:
+    """Server tools like initdb are often not in PATH (e.g. /usr/lib/postgresql/16/bin on Debian) unlike pg_config"""
+    path = shutil.which(name)
+    if path is None and shutil.which("pg_config"):
+        bin_dir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True).stdout.strip()
+        path = shutil.which(name, path=bin_dir)
+    if path is None:
+        raise RuntimeError(f"Failed to find {name}. Make sure that postgres is installed and its binaries are in PATH")
+    return path
+
+
+def get_ram_backed_dir() -> Optional[Path]:
+    for path in RAM_BACKED_DIRS:
+        if path.is_dir() and os.access(path, os.W_OK):
+            return path
+    typer.echo("Failed to find a RAM-backed directory so the cluster will be kept in the temporary directory", err=True)
+    return None
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def get_cluster_state_path(service_paths: List[Path]) -> Path:
+    from .config import get_cache_dir
+
+    workspace = json.dumps(sorted(str(path.resolve()) for path in service_paths))
+    return get_cache_dir() / "db" / "clusters" / f"{hashlib.sha256(workspace.encode()).hexdigest()[:16]}.json"
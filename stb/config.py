@@ -3,16 +3,16 @@ import functools
 import re
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable, Optional, ParamSpec, Tuple, TypeVar
+from typing import TYPE_CHECKING, Any, Callable, Optional, ParamSpec, Tuple, TypeVar
 
-import keyring
-import keyring.errors
-import tomlkit
 import typer
-from platformdirs import user_config_dir
+from platformdirs import user_cache_dir, user_config_dir, user_data_dir, user_log_dir
 
 from .utils.common import sh_with_log
 
+if TYPE_CHECKING:
+    import tomlkit
+
 STB_APP_CONFIG_NAME = "stb"
 STB_APP_AUTHOR_NAME = "ovsyanka83"
 APP_TOKEN_NAME = "stb_app_token"
@@ -41,9 +41,18 @@ T = TypeVar("T")
 class Config:
     def __init__(self) -> None:
         self.config_dir = Path(user_config_dir(STB_APP_CONFIG_NAME, STB_APP_AUTHOR_NAME))
-        self.config_dir.mkdir(parents=True, exist_ok=True)
         self.config_file = self.config_dir / "cfg.toml"
-        self.doc = tomlkit.loads(self.config_file.read_text()) if self.config_file.exists() else tomlkit.document()
+        self._doc: "Optional[tomlkit.TOMLDocument]" = None
+
+    @property
+    def doc(self) -> "tomlkit.TOMLDocument":
+        """The config file is only read when a command needs it so that other commands start faster"""
+        if self._doc is None:
+            import tomlkit
+
+            self._doc = tomlkit.loads(self.config_file.read_text()) if self.config_file.exists() else tomlkit.document()
+            migrate_legacy_config(self)
+        return self._doc
 
     def __setitem__(self, key: str, value: Any) -> None:
         self.doc.__setitem__(key, value)
@@ -67,6 +76,9 @@ class Config:
 
         api_token_name = self["gitlab_api_token_name"]
 
+        import keyring
+        import keyring.errors
+
         try:
             token = keyring.get_password(APP_TOKEN_NAME, api_token_name)
         except (RuntimeError, keyring.errors.KeyringError):
@@ -77,6 +89,9 @@ class Config:
         return token
 
     def set_api_token(self, name: str, value: str) -> None:
+        import keyring
+        import keyring.errors
+
         try:
             keyring.set_password(APP_TOKEN_NAME, name, value)
         except (RuntimeError, keyring.errors.KeyringError) as e:
@@ -85,6 +100,9 @@ class Config:
     def save(self, path: Optional[Path] = None) -> None:
         if path is None:
             path = self.config_file
+        import tomlkit
+
+        path.parent.mkdir(parents=True, exist_ok=True)
         path.write_text(tomlkit.dumps(self.doc))
 
     def requires(self, first_key: str, *keys: str):
@@ -215,23 +233,36 @@ def get_gitlab_api_url() -> str:
     return f"https://{git_host}/api/v4"
 
 
-# TODO: Delete after everyone has updated to >=3.0.0
-if "git_url" in CONFIG and ":" in CONFIG["git_url"]:
-    CONFIG["git_url"] = CONFIG["git_url"].split(":")[0]
-    CONFIG.save()
+def get_log_dir() -> Path:
+    return Path(user_log_dir(STB_APP_CONFIG_NAME, STB_APP_AUTHOR_NAME))
 
-# TODO: Delete after everyone has updated to >=4.5.0
-if "gitlab_api_token" in CONFIG.doc:
-    if "gitlab_api_token_name" in CONFIG.doc:
-        try:
-            CONFIG.get_api_token()
-        except typer.BadParameter:
-            typer.echo("Adding gitlab api token into keyring", err=True)
-            try:
-                CONFIG.set_api_token(CONFIG.doc["gitlab_api_token_name"], CONFIG.doc["gitlab_api_token"])
-            except Exception as e:
-                typer.echo(f"Something went wrong, please set the token again. Error message:\n{e}", err=True)
 
-    typer.echo("Removing gitlab_api_token from config", err=True)
-    CONFIG.doc.remove("gitlab_api_token")
-    CONFIG.save()
+def get_cache_dir() -> Path:
+    return Path(user_cache_dir(STB_APP_CONFIG_NAME, STB_APP_AUTHOR_NAME))
+
+
+def get_data_dir() -> Path:
+    return Path(user_data_dir(STB_APP_CONFIG_NAME, STB_APP_AUTHOR_NAME))
+
+
+def migrate_legacy_config(config: Config) -> None:
+    # TODO: Delete after everyone has updated to >=3.0.0
+    if "git_url" in config and ":" in config["git_url"]:
+        config["git_url"] = config["git_url"].split(":")[0]
+        config.save()
+
+    # TODO: Delete after everyone has updated to >=4.5.0
+    if "gitlab_api_token" in config.doc:
+        if "gitlab_api_token_name" in config.doc:
+            try:
+                config.get_api_token()
+            except typer.BadParameter:
+                typer.echo("Adding gitlab api token into keyring", err=True)
+                try:
+                    config.set_api_token(config.doc["gitlab_api_token_name"], config.doc["gitlab_api_token"])
+                except Exception as e:
+                    typer.echo(f"Something went wrong, please set the token again. Error message:\n{e}", err=True)
+
+        typer.echo("Removing gitlab_api_token from config", err=True)
+        config.doc.remove("gitlab_api_token")
+        config.save()
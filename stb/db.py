@@ -1,16 +1,49 @@
 #!/usr/bin/env python3
 
+import datetime
 import enum
-import multiprocessing
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from pathlib import Path
-from typing import List, cast
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, cast
 
 import rich
 import typer
-from pysh import env
 
-from .utils.common import SERVICE_PATHS_ARG, Service, add_default_service_path, cd_with_log, get_service, sh_with_log
+from .cluster import app as cluster_app
+from .utils.common import (
+    MAX_DEPTH_ARG,
+    RECURSIVE_ARG,
+    SERVICE_PATHS_ARG,
+    Service,
+    add_default_service_path,
+    atomic_write_text,
+    gather_services,
+    get_discovery_depth,
+    get_service,
+)
+from .utils.parallel import PrefixedLog, run_concurrently
+from .utils.postgres import (
+    MAX_IDENTIFIER_LENGTH,
+    PostgresError,
+    PostgresServer,
+    copy_databases,
+    create_databases,
+    drop_databases,
+    dump_database,
+    get_database_comments,
+    get_database_oids,
+    restore_database,
+    set_database_comment,
+)
+from .utils.venv import get_poetry_env
 
 
 def old_parallel_flag_deprecation_callback(value: bool):
@@ -20,11 +53,25 @@ def old_parallel_flag_deprecation_callback(value: bool):
         )
 
 
+def validate_data_snapshot_name(value: str) -> str:
+    if not re.fullmatch(r"\w[\w.-]*", value):
+        raise typer.BadParameter("Only letters, digits, '_', '-', and '.' are allowed")
+    return value
+
+
 app = typer.Typer(
     name="migrator",
     help="creates/upgrades/drops dbs for microservices",
 )
+app.add_typer(cluster_app)
 REQUIRED_DOTENV_KEYS = "POSTGRES_PASSWORD", "POSTGRES_USER"
+SNAPSHOT_PREFIX = "stb_snapshot_"
+SNAPSHOT_FORMAT_VERSION = 1
+UPGRADE_CACHE_FORMAT_VERSION = 1
+DEFAULT_JOBS_PER_SERVER = 4
+DEFAULT_DUMP_JOBS = 4
+DATA_SNAPSHOT_FORMAT_VERSION = 1
+DATA_SNAPSHOT_MANIFEST = "manifest.json"
 OLD_PARALLEL_MIGRATIONS_ARG = typer.Option(
     False,
     "-p",
@@ -33,6 +80,31 @@ OLD_PARALLEL_MIGRATIONS_ARG = typer.Option(
     callback=old_parallel_flag_deprecation_callback,
 )
 NO_PARALLEL_MIGRATIONS_ARG = typer.Option(False, "-P", "--no-parallel", help="Do not run migrations in parallel")
+SNAPSHOT_ARG = typer.Option(
+    False,
+    "-s",
+    "--snapshot",
+    help="Create databases from snapshots of their freshly migrated versions and only run the migrations added since the snapshot was taken. The snapshots are saved after every successful migration from scratch.",
+)
+JOBS_PER_SERVER_ARG = typer.Option(
+    DEFAULT_JOBS_PER_SERVER,
+    "-j",
+    "--jobs",
+    min=1,
+    help="Number of services to process at the same time on every postgres server. Lower it if the server runs out of connections",
+)
+DATA_SNAPSHOT_NAME_ARG = typer.Argument(
+    ..., help="Name of the snapshot. For example, 'seeded'", callback=validate_data_snapshot_name
+)
+DUMP_JOBS_ARG = typer.Option(
+    DEFAULT_DUMP_JOBS, min=1, help="Number of tables to dump or restore at the same time in every database"
+)
+FORCE_UPGRADE_ARG = typer.Option(
+    False,
+    "-f",
+    "--force",
+    help="Upgrade the migrations even if neither they nor the databases have changed since the last successful upgrade",
+)
 FORCE_DROP_ARG = typer.Option(
     False,
     "-f",
@@ -53,9 +125,20 @@ def upgrade(
     service_paths: List[Path] = SERVICE_PATHS_ARG,
     no_parallel_migrations: bool = NO_PARALLEL_MIGRATIONS_ARG,
     old_parallel_migrations: bool = OLD_PARALLEL_MIGRATIONS_ARG,
+    force: bool = FORCE_UPGRADE_ARG,
+    jobs: int = JOBS_PER_SERVER_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
 ):
     """Upgrade database migrations"""
-    run_on_several_services(service_paths, Choices.upgrade, not no_parallel_migrations)
+    run_on_several_services(
+        service_paths,
+        [Choices.upgrade],
+        not no_parallel_migrations,
+        force_upgrade=force,
+        jobs_per_server=jobs,
+        max_depth=get_discovery_depth(recursive, max_depth),
+    )
 
 
 @app.command()
@@ -64,9 +147,20 @@ def create(
     service_paths: List[Path] = SERVICE_PATHS_ARG,
     no_parallel_migrations: bool = NO_PARALLEL_MIGRATIONS_ARG,
     old_parallel_migrations: bool = OLD_PARALLEL_MIGRATIONS_ARG,
+    snapshot: bool = SNAPSHOT_ARG,
+    jobs: int = JOBS_PER_SERVER_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
 ):
     """Create databases and upgrade their migrations"""
-    run_on_several_services(service_paths, Choices.create, not no_parallel_migrations)
+    run_on_several_services(
+        service_paths,
+        [Choices.create],
+        not no_parallel_migrations,
+        use_snapshots=snapshot,
+        jobs_per_server=jobs,
+        max_depth=get_discovery_depth(recursive, max_depth),
+    )
 
 
 @app.command()
@@ -74,9 +168,18 @@ def create(
 def drop(
     service_paths: List[Path] = SERVICE_PATHS_ARG,
     force: bool = FORCE_DROP_ARG,
+    jobs: int = JOBS_PER_SERVER_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
 ):
     """Drop databases"""
-    run_on_several_services(service_paths, Choices.drop, force)
+    run_on_several_services(
+        service_paths,
+        [Choices.drop],
+        force_drop=force,
+        jobs_per_server=jobs,
+        max_depth=get_discovery_depth(recursive, max_depth),
+    )
 
 
 @app.command()
@@ -86,23 +189,123 @@ def reset(
     no_parallel_migrations: bool = NO_PARALLEL_MIGRATIONS_ARG,
     force: bool = FORCE_DROP_ARG,
     old_parallel_migrations: bool = OLD_PARALLEL_MIGRATIONS_ARG,
+    snapshot: bool = SNAPSHOT_ARG,
+    jobs: int = JOBS_PER_SERVER_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
 ):
     """Drop databases, recreate them, and then upgrade their migrations"""
-    for service in service_paths:
-        with suppress(Exception):
-            run_on_single_service(service, Choices.drop, not no_parallel_migrations, force)
-            run_on_single_service(service, Choices.create, not no_parallel_migrations)
+    run_on_several_services(
+        service_paths,
+        [Choices.drop, Choices.create],
+        not no_parallel_migrations,
+        force,
+        use_snapshots=snapshot,
+        jobs_per_server=jobs,
+        max_depth=get_discovery_depth(recursive, max_depth),
+    )
+
+
+@app.command()
+def snapshot(
+    name: str = DATA_SNAPSHOT_NAME_ARG,
+    service_paths: Optional[List[Path]] = SERVICE_PATHS_ARG,
+    jobs: int = JOBS_PER_SERVER_ARG,
+    dump_jobs: int = DUMP_JOBS_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
+):
+    """Save the data of all databases of the services under a name so that it can be restored later"""
+    run_for_each_service(
+        service_paths or [Path.cwd()],
+        lambda service, log: save_data_snapshot(service, name, dump_jobs, log),
+        "snapshot",
+        jobs,
+        get_discovery_depth(recursive, max_depth),
+    )
+
+
+@app.command()
+def restore(
+    name: str = DATA_SNAPSHOT_NAME_ARG,
+    service_paths: Optional[List[Path]] = SERVICE_PATHS_ARG,
+    force: bool = typer.Option(
+        False, "-f", "--force", help="Restore the snapshot even if the migrations have changed since it was saved"
+    ),
+    jobs: int = JOBS_PER_SERVER_ARG,
+    dump_jobs: int = DUMP_JOBS_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
+):
+    """Replace all databases of the services with the data saved by 'stb db snapshot'"""
+    run_for_each_service(
+        service_paths or [Path.cwd()],
+        lambda service, log: restore_data_snapshot(service, name, dump_jobs, force, log),
+        "restore",
+        jobs,
+        get_discovery_depth(recursive, max_depth),
+    )
 
 
 def run_on_several_services(
     service_paths: List[Path],
-    choice: Choices,
+    commands: Sequence[Choices],
     parallel_migrations: bool = False,
     force_drop: bool = False,
-):
-    for service in service_paths:
-        with suppress(Exception):
-            run_on_single_service(service, choice, parallel_migrations, force_drop)
+    use_snapshots: bool = False,
+    force_upgrade: bool = False,
+    jobs_per_server: int = DEFAULT_JOBS_PER_SERVER,
+    max_depth: Optional[int] = 1,
+) -> None:
+    """I run the commands for all services at the same time while keeping their order within every service"""
+
+    def run(service: Service, log: PrefixedLog) -> None:
+        for command in commands:
+            run_on_single_service(
+                service.dir, command, parallel_migrations, force_drop, use_snapshots, force_upgrade, log
+            )
+
+    run_for_each_service(service_paths, run, " and ".join(commands), jobs_per_server, max_depth)
+
+
+def run_for_each_service(
+    service_paths: List[Path],
+    function: Callable[[Service, PrefixedLog], None],
+    action: str,
+    jobs_per_server: int = DEFAULT_JOBS_PER_SERVER,
+    max_depth: Optional[int] = 1,
+) -> None:
+    """I run the function for all services at the same time and report the ones that have failed.
+
+    Services that use the same postgres server wait for each other so that only jobs_per_server of them
+    are connected to it at the same time. Services without postgres settings are skipped, not failed.
+    """
+    services = gather_services(service_paths, load=("dotenv",), max_depth=max_depth)
+    if not services:
+        typer.echo("No services found", err=True)
+        raise typer.Exit(1)
+    servers = {name: PostgresServer.from_dotenv(service.dotenv) for name, service in services.items()}
+    server_slots = {
+        (server.host, server.port): threading.Semaphore(max(1, jobs_per_server)) for server in servers.values()
+    }
+
+    skipped = set()
+
+    def run(name: str) -> None:
+        with server_slots[servers[name].host, servers[name].port]:
+            try:
+                function(services[name], PrefixedLog(name))
+            except MissingPostgresSettingsError:
+                skipped.add(name)
+
+    failures = run_concurrently(run, services, len(services))
+    if skipped:
+        typer.echo(f"Skipped the services without postgres settings: {', '.join(sorted(skipped))}", err=True)
+    if failures:
+        for name, exception in sorted(failures.items()):
+            typer.echo(f"[{name}] {exception}", err=True)
+        typer.echo(f"Failed to {action} the databases of: {', '.join(sorted(failures))}", err=True)
+        raise typer.Exit(1)
 
 
 def run_on_single_service(
@@ -110,46 +313,317 @@ def run_on_single_service(
     command: Choices,
     parallel_migrations: bool = False,
     force_drop: bool = False,
+    use_snapshots: bool = False,
+    force_upgrade: bool = False,
+    log: Optional[PrefixedLog] = None,
 ) -> None:
     service = get_service(service_path)
+    log = log or PrefixedLog(service.dir.name)
+    server, databases = get_postgres_server(service, log), get_service_databases(service)
+    aerich_apps = find_aerich_apps(service)
+
+    migration_files = get_migration_file_hashes(service)
+    up_to_date_databases: Set[str] = set()
+    if command == Choices.create:
+        databases_to_create = databases
+        if use_snapshots:
+            up_to_date_databases, outdated_databases = restore_database_snapshots(
+                server, databases, migration_files, log
+            )
+            databases_to_create = databases - up_to_date_databases - outdated_databases
+        report_database_results(log, "create", create_databases(server, databases_to_create))
+    elif command == Choices.drop:
+        report_database_results(log, "drop", drop_databases(server, databases, force_drop))
+
+    if command == Choices.create and databases and up_to_date_databases == databases:
+        log.echo("All databases were restored from up-to-date snapshots so there are no migrations to run")
+        return
+
+    if command in {Choices.create, Choices.upgrade}:
+        migrated = run_migrations(
+            service, server, aerich_apps, migration_files, log, parallel_migrations, force_upgrade
+        )
+        if command == Choices.create and use_snapshots:
+            if migrated:
+                save_database_snapshots(server, databases, migration_files, log)
+            else:
+                log.echo("The database snapshots were not updated because some of the migrations have failed", err=True)
+        if not migrated:
+            raise RuntimeError(f"Failed to upgrade the migrations of {service.dir.name}")
+
+
+def save_data_snapshot(service: Service, name: str, dump_jobs: int, log: PrefixedLog) -> None:
+    """I dump all databases of the service at the same time into a temporary directory and only replace
+    the previous snapshot with the same name once every dump has succeeded"""
+    server, databases = get_postgres_server(service, log), sorted(get_service_databases(service))
+    if not databases:
+        log.echo("The service has no databases to snapshot")
+        return
+    snapshot_dir = get_data_snapshot_dir(service, name)
+    snapshot_dir.parent.mkdir(parents=True, exist_ok=True)
+    temporary_dir = Path(tempfile.mkdtemp(dir=snapshot_dir.parent, prefix=f".{name}."))
+    try:
+        with ThreadPoolExecutor(len(databases)) as executor:
+            errors = executor.map(lambda db: dump_database(server, db, temporary_dir / db, dump_jobs), databases)
+            results = dict(zip(databases, errors))
+        report_database_results(log, "dump", results)
+        if any(results.values()):
+            raise RuntimeError(f"Failed to dump {', '.join(db for db, error in results.items() if error)}")
+
+        manifest = {
+            "version": DATA_SNAPSHOT_FORMAT_VERSION,
+            "name": name,
+            "service": str(service.dir),
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "migrations_fingerprint": hash_text(json.dumps(get_migration_file_hashes(service))),
+            "databases": databases,
+        }
+        (temporary_dir / DATA_SNAPSHOT_MANIFEST).write_text(json.dumps(manifest, indent=4))
+        if snapshot_dir.exists():
+            snapshot_dir.rename(temporary_dir.with_name(temporary_dir.name + ".old"))
+        temporary_dir.rename(snapshot_dir)
+        log.echo(f"Saved snapshot '{name}' to {snapshot_dir}")
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        shutil.rmtree(temporary_dir.with_name(temporary_dir.name + ".old"), ignore_errors=True)
+
+
+def restore_data_snapshot(service: Service, name: str, dump_jobs: int, force: bool, log: PrefixedLog) -> None:
+    snapshot_dir = get_data_snapshot_dir(service, name)
+    manifest_path = snapshot_dir / DATA_SNAPSHOT_MANIFEST
+    if not manifest_path.is_file():
+        raise LookupError(f"There is no snapshot named '{name}' in {snapshot_dir.parent}")
+    manifest = json.loads(manifest_path.read_text())
+    if manifest.get("version") != DATA_SNAPSHOT_FORMAT_VERSION:
+        raise RuntimeError(f"Snapshot '{name}' was saved by an incompatible version of stb")
+    if manifest["migrations_fingerprint"] != hash_text(json.dumps(get_migration_file_hashes(service))) and not force:
+        raise RuntimeError(
+            f"Snapshot '{name}' was saved with different migrations so its data may not match the current schema. "
+            "Use --force to restore it anyway"
+        )
+
+    server, databases = get_postgres_server(service, log), manifest["databases"]
+    report_database_results(log, "drop", drop_databases(server, databases))
+    results = create_databases(server, databases)
+    report_database_results(log, "create", results)
+    if any(results.values()):
+        raise RuntimeError(f"Failed to recreate {', '.join(db for db, error in results.items() if error)}")
+    with ThreadPoolExecutor(len(databases)) as executor:
+        errors = executor.map(lambda db: restore_database(server, db, snapshot_dir / db, dump_jobs), databases)
+        results = dict(zip(databases, errors))
+    report_database_results(log, "restore", results)
+    if any(results.values()):
+        raise RuntimeError(f"Failed to restore {', '.join(db for db, error in results.items() if error)}")
+
+
+def get_data_snapshot_dir(service: Service, name: str) -> Path:
+    from .config import get_data_dir
 
+    # The name keeps the directory recognizable, the hash keeps services with the same name in different places apart
+    service_key = f"{service.dir.name}-{hash_text(str(service.dir.resolve()))[:16]}"
+    return get_data_dir() / "snapshots" / service_key / name
+
+
+def run_migrations(
+    service: Service,
+    server: PostgresServer,
+    aerich_apps: Set[str],
+    migration_files: Dict[str, str],
+    log: PrefixedLog,
+    parallel_migrations: bool = False,
+    force: bool = False,
+) -> bool:
+    """I run `aerich upgrade` for every app whose migrations or database have changed since its last successful
+    upgrade and return whether all of the upgrades have succeeded"""
+    apps = aerich_apps - {"aerich"}
+    cache = UpgradeCache.load(get_upgrade_cache_path(service))
+    fingerprints = {app: get_app_fingerprint(migration_files, app) for app in apps}
+    try:
+        targets = {
+            app: f"{server.host}:{server.port}/{app}#{oid}" for app, oid in get_database_oids(server, apps).items()
+        }
+    except PostgresError as e:
+        log.echo(f"Failed to look up the databases, so none of the upgrades will be skipped: {e}", err=True)
+        targets = {}
+
+    apps_to_upgrade = sorted(
+        app for app in apps if force or not cache.is_up_to_date(app, fingerprints[app], targets.get(app))
+    )
+    if skipped_apps := sorted(apps.difference(apps_to_upgrade)):
+        log.echo(
+            f"Skipped upgrading {', '.join(skipped_apps)} because neither their migrations nor their databases have "
+            "changed since the last successful upgrade. Use --force to upgrade them anyway"
+        )
+    if apps and not apps_to_upgrade:
+        return True
+
+    def sh(cmd: str) -> bool:
+        return log.sh(cmd, service.dir, env={"PGPASSWORD": server.password})
+
+    poetry_env = get_poetry_env(service.dir)
+    default_succeeded = sh(poetry_env.command("aerich", "upgrade"))
+    commands_to_run = [poetry_env.command("aerich", f"--app {app} upgrade") for app in apps_to_upgrade]
+    if parallel_migrations:
+        # Threads are enough here because all of the work happens in the aerich processes
+        with ThreadPoolExecutor(os.cpu_count()) as executor:
+            results = list(executor.map(sh, commands_to_run))
+    else:
+        results = [sh(cmd) for cmd in commands_to_run]
+
+    if poetry_env.get_executable("aerich") is not None:
+        log.echo(
+            f"Ran aerich directly from {poetry_env.venv_dir} instead of 'poetry run', saving about "
+            f"{poetry_env.poetry_overhead * (len(commands_to_run) + 1):.1f}s"
+        )
+    if default_succeeded:
+        for app, succeeded in zip(apps_to_upgrade, results):
+            if succeeded and app in targets:
+                cache.record(app, fingerprints[app], targets[app])
+        cache.save()
+    return default_succeeded and all(results)
+
+
+def get_upgrade_cache_path(service: Service) -> Path:
+    # stb.config imports tomlkit which slows down the startup of `stb update env` that imports this module
+    from .config import get_cache_dir
+
+    return get_cache_dir() / "db" / "upgrades" / f"{hash_text(str(service.dir))}.json"
+
+
+class UpgradeCache:
+    """I remember the migrations fingerprint and the exact database (including its oid) of every successful upgrade"""
+
+    def __init__(self, path: Path, data: Dict[str, Any]) -> None:
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def load(cls, path: Path) -> "UpgradeCache":
+        data: Dict[str, Any] = {}
+        if path.is_file():
+            with suppress(json.JSONDecodeError):
+                data = json.loads(path.read_text())
+        if data.get("version") != UPGRADE_CACHE_FORMAT_VERSION:
+            data = {"version": UPGRADE_CACHE_FORMAT_VERSION, "apps": {}}
+        return cls(path, data)
+
+    def save(self) -> None:
+        atomic_write_text(self.path, json.dumps(self.data))
+
+    def is_up_to_date(self, app: str, fingerprint: str, target: Optional[str]) -> bool:
+        return target is not None and self.data["apps"].get(app) == {"fingerprint": fingerprint, "target": target}
+
+    def record(self, app: str, fingerprint: str, target: str) -> None:
+        self.data["apps"][app] = {"fingerprint": fingerprint, "target": target}
+
+
+def restore_database_snapshots(
+    server: PostgresServer, databases: Set[str], migration_files: Dict[str, str], log: PrefixedLog
+) -> Tuple[Set[str], Set[str]]:
+    """I create the databases from their snapshots and return the ones that are up to date and the ones that still
+    need the migrations that were added after their snapshot was taken.
+
+    A snapshot is only usable if all of its migration files are still present and unchanged. Otherwise, the database
+    is left for the caller to create from scratch.
+    """
+    try:
+        snapshot_comments = get_database_comments(server, {get_snapshot_name(db) for db in databases})
+    except PostgresError as e:
+        log.echo(f"Failed to look up database snapshots: {e}", err=True)
+        return set(), set()
+
+    up_to_date_databases, outdated_databases = set(), set()
+    for db in databases:
+        snapshot_files = parse_snapshot_comment(snapshot_comments.get(get_snapshot_name(db)))
+        if snapshot_files is None or not snapshot_files.items() <= migration_files.items():
+            continue
+        elif snapshot_files == migration_files:
+            up_to_date_databases.add(db)
+        else:
+            outdated_databases.add(db)
+
+    results = copy_databases(server, {db: get_snapshot_name(db) for db in up_to_date_databases | outdated_databases})
+    report_database_results(log, "restore from snapshot", results)
+    restored_databases = {db for db, error in results.items() if error is None}
+    return up_to_date_databases & restored_databases, outdated_databases & restored_databases
+
+
+def save_database_snapshots(
+    server: PostgresServer, databases: Set[str], migration_files: Dict[str, str], log: PrefixedLog
+) -> None:
+    snapshots = {get_snapshot_name(db): db for db in databases}
+    drop_databases(server, snapshots)
+    results = copy_databases(server, snapshots)
+    comment = json.dumps({"stb_snapshot": SNAPSHOT_FORMAT_VERSION, "migrations": migration_files})
+    for snapshot, error in results.items():
+        if error is None:
+            try:
+                set_database_comment(server, snapshot, comment)
+            except PostgresError as e:
+                results[snapshot] = str(e)
+    report_database_results(log, "save snapshot", {snapshots[snapshot]: error for snapshot, error in results.items()})
+
+
+def get_snapshot_name(db: str) -> str:
+    name = f"{SNAPSHOT_PREFIX}{db}"
+    if len(name.encode()) <= MAX_IDENTIFIER_LENGTH:
+        return name
+    # Postgres silently truncates long names so we make them unique ourselves
+    return f"{SNAPSHOT_PREFIX}{hashlib.sha256(db.encode()).hexdigest()[:32]}"
+
+
+def get_app_fingerprint(migration_files: Dict[str, str], app: str) -> str:
+    return hash_text(
+        json.dumps({path: digest for path, digest in migration_files.items() if path.startswith(f"{app}/")})
+    )
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def parse_snapshot_comment(comment: Optional[str]) -> Optional[Dict[str, str]]:
+    with suppress(ValueError, TypeError):
+        data = json.loads(cast(str, comment))
+        if data.get("stb_snapshot") == SNAPSHOT_FORMAT_VERSION:
+            return data["migrations"]
+
+
+def get_migration_file_hashes(service: Service) -> Dict[str, str]:
+    """Returns the sha256 of every migration file, keyed by its path relative to the migrations directory"""
+    migrations_dir = service.dir / "migrations"
+    if not migrations_dir.is_dir():
+        return {}
+    return {
+        path.relative_to(migrations_dir).as_posix(): hashlib.sha256(path.read_bytes()).hexdigest()
+        for path in sorted(migrations_dir.rglob("*"))
+        if path.is_file() and "__pycache__" not in path.parts
+    }
+
+
+def report_database_results(log: PrefixedLog, action: str, results: Dict[str, Optional[str]]) -> None:
+    for db, error in results.items():
+        if error is None:
+            log.echo(f">>> {action} {db}")
+        else:
+            log.echo(f">>> {action} {db}: {error}", err=True)
+
+
+class MissingPostgresSettingsError(LookupError):
+    """The service doesn't use postgres, or at least its .env doesn't say how to connect to it"""
+
+
+def get_postgres_server(service: Service, log: PrefixedLog) -> PostgresServer:
     for field in REQUIRED_DOTENV_KEYS:
         if field not in service.dotenv:
             err = f"{field} field is required for the correct functioning of stb db but it was not filled out in {service.dotenv_path}"
-            typer.echo(err, err=True)
-            raise LookupError(err)
-    if not "POSTGRES_PORT" in service.dotenv:
-        service.dotenv["POSTGRES_PORT"] = "5432"
+            log.echo(err, err=True)
+            raise MissingPostgresSettingsError(err)
+    return PostgresServer.from_dotenv(service.dotenv)
 
-    aerich_apps = find_aerich_apps(service)
-    postgres_dbs = {v for k, v in service.dotenv.items() if k.startswith("POSTGRES_DB")}
-    postgres_user = service.dotenv["POSTGRES_USER"]
-    postgres_password = cast(str, service.dotenv["POSTGRES_PASSWORD"])
-    postgres_port = service.dotenv["POSTGRES_PORT"]
-
-    with cd_with_log(service.dir), env(PGPASSWORD=postgres_password):
-        for db in aerich_apps | postgres_dbs:
-            if command == Choices.create:
-                sh_with_log(f"createdb -h localhost -p {postgres_port} -U {postgres_user} {db}", "", "")
-            elif command == Choices.drop:
-                sh_with_log(
-                    f"dropdb {'-f' if force_drop else ''} -h localhost -p {postgres_port} -U {postgres_user} {db}",
-                    "",
-                    "",
-                )
-
-        if command in {Choices.create, Choices.upgrade}:
-            if "aerich" in aerich_apps:
-                aerich_apps.remove("aerich")
-            sh_with_log("poetry run aerich upgrade")
-            commands_to_run = [f"poetry run aerich --app {db} upgrade" for db in aerich_apps]
-
-            if parallel_migrations:
-                with multiprocessing.Pool() as pool:
-                    pool.map(sh_with_log, commands_to_run)
-            else:
-                for cmd in commands_to_run:
-                    sh_with_log(cmd)
+
+def get_service_databases(service: Service) -> Set[str]:
+    return find_aerich_apps(service) | {v for k, v in service.dotenv.items() if k.startswith("POSTGRES_DB") and v}
 
 
 def find_aerich_apps(service: Service) -> "set[str]":
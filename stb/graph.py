@@ -2,30 +2,69 @@ import contextlib
 import datetime
 import io
 import json
+import os
+import re
 import subprocess
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-import gitlab
+import requests
 import tomli
 import typer
 from pysh import which
 from rich.console import Console
 from rich.progress import Progress, track
 
-from .config import CONFIG, get_gitlab_api_url
+from .catalog import CatalogProject, find_projects, gitlab_session
+from .config import CONFIG, get_cache_dir, get_gitlab_api_url
+from .graph_index import GraphIndex
+from .registry import get_registry_index
+from .utils.common import atomic_write_text
 
 app = typer.Typer(
     name="graph",
     help="graphs the dependencies of microservices using various backends",
 )
+query_app = typer.Typer(
+    name="query",
+    help="answers questions about the dependency graph from the last `stb graph json` run without going to gitlab",
+)
+app.add_typer(query_app)
 ignore_packages = typer.Option(
     None,
     "-i",
     help="The packages to omit from output even if they are in the registry.",
 )
+refresh_catalog = typer.Option(False, "--refresh", help="Redownload the cached list of gitlab projects")
+report_cache_stats = typer.Option(
+    False, "--cache-stats", help="Report how many dependency records were reused from the cache and refetched"
+)
+dependency_mapping_file = typer.Option(
+    None,
+    "--input",
+    dir_okay=False,
+    exists=True,
+    help="A file with the output of `stb graph json`. The output of its last run by default",
+)
+local_source = typer.Option(
+    None,
+    "--local",
+    file_okay=False,
+    exists=True,
+    help="Build the graph from local checkouts in this directory instead of gitlab. Doesn't require network access",
+)
 console = Console(stderr=True)
+PYPROJECT_FETCH_WORKERS = 16
+DEPENDENCY_CACHE_FORMAT_VERSION = 2
+RIPGREP_INSTALLED = which("rg")
+IGNORED_SCAN_DIRS = {"node_modules", "venv", "__pycache__"}
+# Both scanners must look at the same files: python files outside of hidden and IGNORED_SCAN_DIRS directories,
+# regardless of .gitignore because the python scanner doesn't know about it
+RIPGREP_SCAN_ARGS = ["--type", "py", "--no-ignore", *(f"--glob=!{d}" for d in sorted(IGNORED_SCAN_DIRS))]
+LOCAL_PARSE_PROCESS_THRESHOLD = 64
 
 REPLACEMENTS = {
     "xchange-rates": "exchange-rates",
@@ -64,14 +103,21 @@ if which("dot"):
 
     @app.command()
     def graphviz(
-        services: List[str],
+        services: List[str] = typer.Argument(
+            None,
+            help="Gitlab groups or projects to graph. With --local, subdirectories of the local directory (all by default)",
+            show_default=False,
+        ),
         ignore_packages: list[str] = ignore_packages,
         display_domains: bool = False,
         connector_usage_source: Path = typer.Option(default=None, dir_okay=True, file_okay=False, exists=True),
+        refresh: bool = refresh_catalog,
+        cache_stats: bool = report_cache_stats,
+        local: Optional[Path] = local_source,
     ):
         """Graphs the dependencies of microservices using graphviz"""
         with contextlib.redirect_stdout(io.StringIO()):
-            dependencies = json_(services, ignore_packages)
+            dependencies = json_(services, ignore_packages, refresh, cache_stats, local)
 
         dependencies = {
             project_name.replace("-", "_"): {
@@ -86,7 +132,8 @@ if which("dot"):
             _find_connector_usages(dependencies, connector_usage_source)
         domains = defaultdict(list)
         for project_name, project in dependencies.items():
-            domains[project["name_with_namespace"].split(" / ")[-2]].append(project_name)
+            namespace = project["name_with_namespace"].split(" / ")
+            domains[namespace[-2] if len(namespace) > 1 else namespace[-1]].append(project_name)
         graphviz_dependency_definitions = "\n".join(
             [
                 f"{k} -> {dep} {'[color=blue, style=solid]' if dep in v.get('dependencies_with_connectors', ()) or 'dependencies_with_connectors' not in v else '[color=red, style=dashed, arrowhead=tee]'};"
@@ -123,69 +170,231 @@ if which("dot"):
         )
 
     def _find_connector_usages(dependencies: dict, connector_usage_source: Path):
-        for _, project_info in dependencies.items():
-            project = connector_usage_source / project_info["name"]
-
+        """Scans every project once for the connector imports of all of its dependencies at the same time"""
+        projects_to_scan = [info for info in dependencies.values() if info["dependencies"]]
+        for project_info in dependencies.values():
             project_info["dependencies_with_connectors"] = []
-            for dep in project_info["dependencies"]:
-                found = subprocess.run(
-                    ["rg", f"from.+{dep}.+connectors.+import"],
-                    cwd=project,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                )
-                if found.returncode == 0:
-                    project_info["dependencies_with_connectors"].append(dep)
+
+        executor_class = ThreadPoolExecutor if RIPGREP_INSTALLED else ProcessPoolExecutor
+        with executor_class() as executor:
+            found_dependencies = executor.map(
+                find_connector_usages_in_project,
+                [connector_usage_source / info["name"] for info in projects_to_scan],
+                [info["dependencies"] for info in projects_to_scan],
+            )
+            for project_info, found in zip(projects_to_scan, found_dependencies):
+                project_info["dependencies_with_connectors"] = [
+                    dep for dep in project_info["dependencies"] if dep in found
+                ]
+
+
+def find_connector_usages_in_project(project_dir: Path, dependency_names: List[str]) -> Set[str]:
+    """Returns the names of the dependencies whose connectors are imported anywhere in the project"""
+    if not dependency_names or not project_dir.is_dir():
+        return set()
+    # The longest names go first and are anchored on word boundaries so that `auth` isn't credited with `auth_sdk`
+    alternatives = "|".join(re.escape(dep) for dep in sorted(dependency_names, key=len, reverse=True))
+    pattern = rf"from.+\b({alternatives})\b.+connectors.+import"
+    if RIPGREP_INSTALLED:
+        found = subprocess.run(
+            [
+                "rg",
+                *RIPGREP_SCAN_ARGS,
+                "--only-matching",
+                "--no-filename",
+                "--no-line-number",
+                "--replace",
+                "$1",
+                pattern,
+            ],
+            cwd=project_dir,
+            capture_output=True,
+            text=True,
+        )
+        return set(found.stdout.split())
+
+    compiled_pattern = re.compile(pattern)
+    found_dependencies: Set[str] = set()
+    for root, dirs, files in os.walk(project_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d not in IGNORED_SCAN_DIRS]
+        for file in files:
+            if file.endswith(".py") and not file.startswith("."):
+                with open(os.path.join(root, file), errors="ignore") as f:
+                    found_dependencies.update(match[1] for match in compiled_pattern.finditer(f.read()))
+    return found_dependencies
 
 
-@CONFIG.requires("gitlab_api_token", "git_url", "pypi_registry_id")
 @app.command(name="json")
 def json_(
-    services: List[str],
+    services: List[str] = typer.Argument(
+        None,
+        help="Gitlab groups or projects to graph. With --local, subdirectories of the local directory (all by default)",
+        show_default=False,
+    ),
     ignore_packages: list[str] = ignore_packages,
+    refresh: bool = refresh_catalog,
+    cache_stats: bool = report_cache_stats,
+    local: Optional[Path] = local_source,
 ):
-    gl = gitlab.Gitlab(url=get_gitlab_api_url().removesuffix("/api/v4"), private_token=CONFIG["gitlab_api_token"])
+    if local is not None:
+        dep_mapping = get_local_dependency_mapping(local, services or [], ignore_packages)
+    elif services:
+        dep_mapping = get_gitlab_dependency_mapping(services, ignore_packages, refresh, cache_stats)
+    else:
+        raise typer.BadParameter("You must specify the services to graph or a --local directory")
+    atomic_write_text(get_last_dependency_mapping_path(), json.dumps(dep_mapping, ensure_ascii=False))
+    typer.echo(json.dumps(dep_mapping, indent=4, ensure_ascii=False))
+    return dep_mapping
+
 
+@CONFIG.requires("gitlab_api_token", "git_url", "pypi_registry_id")
+def get_gitlab_dependency_mapping(
+    services: List[str], ignore_packages: List[str], refresh: bool, cache_stats: bool
+) -> Dict[str, Dict[str, Any]]:
     with Progress(console=console) as progress:
         progress.add_task("[red]Loading all projects...", total=None)
-        projects = get_projects(gl, services)
+        projects = get_projects(services, refresh)
+    cache = DependencyCache.load(get_cache_dir() / "graph" / f"{CONFIG['git_url'].split('@')[-1]}.json")
     dep_mapping = {}
-    project_with_registry = gl.projects.get(CONFIG["pypi_registry_id"])
-    packages = project_with_registry.packages.list(all=True)
-    packages_in_registry = {package.name for package in packages}
+    packages_in_registry = set(get_registry_index(refresh).packages)
+
+    try:
+        for project, record in track(
+            get_dependency_records(projects, cache),
+            description="Getting pyproject files",
+            total=len(projects),
+            console=console,
+        ):
+            if record is None or not record["service_name"]:
+                continue
+            dep_mapping[record["service_name"]] = {
+                "id": project.id,
+                "name": project.name,
+                "name_with_namespace": project.name_with_namespace,
+                "dependencies": get_internal_dependencies(record, packages_in_registry, ignore_packages),
+            }
+    finally:
+        # The records that were fetched before a failure are still valid
+        cache.save()
+    if cache_stats:
+        console.print(f"Reused {cache.reused} cached dependency records, refetched {cache.refetched}")
+    # Pyproject files arrive in the order of completion so we restore the order of projects to keep the output stable
+    project_order = {project.id: i for i, project in enumerate(projects)}
+    return dict(sorted(dep_mapping.items(), key=lambda item: project_order[item[1]["id"]]))
+
+
+def get_local_dependency_mapping(
+    root: Path, services: List[str], ignore_packages: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Builds the same mapping as the gitlab source but from local checkouts, using their package names as the registry"""
+    root = root.resolve()
+    project_dirs = find_local_projects(root, services)
+    records = read_local_dependency_records(project_dirs)
+    packages_in_registry = {record["package_name"] for record in records if record is not None}
 
-    for project, pyproject in track(
-        get_pyproject_tomls(projects), description="Getting pyproject files", total=len(projects), console=console
-    ):
-        service_name = get_service_name(pyproject)
-        if not service_name:
+    dep_mapping = {}
+    for project_dir, record in zip(project_dirs, records):
+        if record is None or not record["service_name"]:
             continue
-
-        direct_dependencies = get_direct_dependencies(pyproject)
-        direct_registry_dependencies = [
-            dep for dep in direct_dependencies if dep in packages_in_registry and not dep in ignore_packages
-        ]
-        if service_name in direct_registry_dependencies:
-            direct_registry_dependencies.remove(service_name)
-        dep_mapping[service_name] = {
-            "id": project.id,
-            "name": project.name,
-            "name_with_namespace": project.name_with_namespace,
-            "dependencies": direct_registry_dependencies,
+        dep_mapping[record["service_name"]] = {
+            "id": None,
+            "name": project_dir.name,
+            "name_with_namespace": get_local_name_with_namespace(root, project_dir),
+            "dependencies": get_internal_dependencies(record, packages_in_registry, ignore_packages),
         }
-    dep_mapping = {k: v for k, v in dep_mapping.items() if dep_is_in_mapping(dep_mapping, k)}
-    typer.echo(json.dumps(dep_mapping, indent=4, ensure_ascii=False))
     return dep_mapping
 
 
-def dep_is_in_mapping(dep_mapping: dict[str, list[str]], searched_service: str):
-    if dep_mapping.get(searched_service):
-        return True
-    for dependencies in dep_mapping.values():
-        for dependency in dependencies:
-            if dependency == searched_service:
-                return True
-    return False
+def get_local_name_with_namespace(root: Path, project_dir: Path) -> str:
+    """The local directory is the namespace of its projects, and a project that is the local directory itself is its
+    own namespace, so that every name has a namespace just like in gitlab"""
+    return " / ".join((root.name, *(project_dir.relative_to(root).parts or (root.name,))))
+
+
+def find_local_projects(root: Path, services: List[str]) -> List[Path]:
+    if (root / "pyproject.toml").is_file():
+        return [root]
+    services = [service.strip("/") for service in services]
+    return sorted(
+        path
+        for path in root.iterdir()
+        if (path / "pyproject.toml").is_file() and (not services or any(path.name.startswith(s) for s in services))
+    )
+
+
+def read_local_dependency_records(project_dirs: List[Path]) -> List[Optional[Dict[str, Any]]]:
+    # Starting worker processes costs more than parsing a few dozen small files
+    if len(project_dirs) < LOCAL_PARSE_PROCESS_THRESHOLD:
+        return [read_local_dependency_record(project_dir) for project_dir in project_dirs]
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(read_local_dependency_record, project_dirs, chunksize=16))
+
+
+def read_local_dependency_record(project_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        pyproject = tomli.loads((project_dir / "pyproject.toml").read_text())
+    except (OSError, UnicodeDecodeError, tomli.TOMLDecodeError) as e:
+        console.print(f"Skipped {project_dir}: {e}", style="yellow", markup=False)
+        return None
+    if "name" not in pyproject.get("tool", {}).get("poetry", {}):
+        return None
+    return make_dependency_record(pyproject)
+
+
+def make_dependency_record(pyproject: dict, blob_id: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "blob_id": blob_id,
+        "package_name": pyproject["tool"]["poetry"]["name"].replace("_", "-"),
+        "service_name": get_service_name(pyproject),
+        "dependencies": get_direct_dependencies(pyproject),
+    }
+
+
+def get_internal_dependencies(
+    record: Dict[str, Any], packages_in_registry: Set[str], ignore_packages: List[str]
+) -> List[str]:
+    return [
+        dep
+        for dep in record["dependencies"]
+        if dep in packages_in_registry and dep not in ignore_packages and dep != record["service_name"]
+    ]
+
+
+class DependencyCache:
+    """I store the parsed dependencies of every project keyed by the blob sha of its pyproject.toml"""
+
+    def __init__(self, path: Path, data: Dict[str, Any]) -> None:
+        self.path = path
+        self.data = data
+        self.reused = 0
+        self.refetched = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path) -> "DependencyCache":
+        data: Dict[str, Any] = {}
+        if path.is_file():
+            with contextlib.suppress(json.JSONDecodeError):
+                data = json.loads(path.read_text())
+        if data.get("version") != DEPENDENCY_CACHE_FORMAT_VERSION:
+            data = {"version": DEPENDENCY_CACHE_FORMAT_VERSION, "projects": {}}
+        return cls(path, data)
+
+    def save(self) -> None:
+        atomic_write_text(self.path, json.dumps(self.data))
+
+    def get(self, project_id: int, blob_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self.data["projects"].get(str(project_id))
+            if record is not None and record["blob_id"] == blob_id:
+                self.reused += 1
+                return record
+            self.refetched += 1
+        return None
+
+    def set(self, project_id: int, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.data["projects"][str(project_id)] = record
 
 
 def get_service_name(pyproject: dict) -> str:
@@ -199,28 +408,78 @@ def get_direct_dependencies(pyproject):
     return [dep.replace("_", "-") for dep in pyproject["tool"]["poetry"]["dependencies"].keys()]
 
 
-def get_pyproject_tomls(projects: list):
-    for project in projects:
-        with contextlib.suppress(gitlab.GitlabGetError):
-            possible_pyproject_ids = [
-                i["id"] for i in project.repository_tree(get_all=True) if i["path"] == "pyproject.toml"
-            ]
-            if possible_pyproject_ids:
-                yield project, tomli.loads(project.repository_raw_blob(possible_pyproject_ids[0]).decode("utf-8"))
-
-
-def get_projects(gl: gitlab.Gitlab, repo_names: List[str]) -> list:
-    all_projects = gl.projects.list(get_all=True)
-
-    calculated_projects = []
+def get_dependency_records(
+    projects: List[CatalogProject], cache: DependencyCache
+) -> Iterator[Tuple[CatalogProject, Optional[Dict[str, Any]]]]:
+    """Gets the dependencies of the projects concurrently and yields them in the order of completion"""
+    with gitlab_session(PYPROJECT_FETCH_WORKERS) as session, ThreadPoolExecutor(PYPROJECT_FETCH_WORKERS) as executor:
+        futures = {executor.submit(get_dependency_record, session, project, cache): project for project in projects}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def get_dependency_record(
+    session: requests.Session, project: CatalogProject, cache: DependencyCache
+) -> Optional[Dict[str, Any]]:
+    """Only downloads and parses pyproject.toml if its blob sha has changed since the last run"""
+    response = session.head(
+        f"{get_gitlab_api_url()}/projects/{project.id}/repository/files/pyproject.toml",
+        params={"ref": get_pyproject_ref(project)},
+    )
+    if response.status_code == 404:
+        return None
+    try:
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        warn_about_skipped_project(project, e)
+        return None
+    blob_id = response.headers["X-Gitlab-Blob-Id"]
+    record = cache.get(project.id, blob_id)
+    if record is not None:
+        return record
+
+    pyproject = get_pyproject_toml(session, project)
+    if pyproject is None:
+        return None
+    record = make_dependency_record(pyproject, blob_id)
+    cache.set(project.id, record)
+    return record
+
+
+def get_pyproject_toml(session: requests.Session, project: CatalogProject) -> Optional[dict]:
+    """Reads pyproject.toml from the default branch in a single request. Returns None if the project doesn't have one,
+    or if it can't be read or parsed, so that a single broken project doesn't abort the whole graph"""
+    response = session.get(
+        f"{get_gitlab_api_url()}/projects/{project.id}/repository/files/pyproject.toml/raw",
+        params={"ref": get_pyproject_ref(project)},
+    )
+    if response.status_code == 404:
+        return None
+    try:
+        response.raise_for_status()
+        return tomli.loads(response.content.decode("utf-8"))
+    except (requests.HTTPError, tomli.TOMLDecodeError, UnicodeDecodeError) as e:
+        warn_about_skipped_project(project, e)
+        return None
+
+
+def get_pyproject_ref(project: CatalogProject) -> str:
+    """The blob sha and the contents must come from the same ref, or a wrong record gets cached under the sha"""
+    return project.default_branch or "HEAD"
+
+
+def warn_about_skipped_project(project: CatalogProject, error: Exception) -> None:
+    console.print(f"Skipped {project.path_with_namespace}: {error}", style="yellow", markup=False)
+
+
+def get_projects(repo_names: List[str], refresh: bool = False) -> List[CatalogProject]:
+    # Remove all whitespace in case the user accidentally added some
     repo_names = ["".join(name.split()) for name in repo_names]
-    for name in repo_names:
-        if name.count("/") == 2:
-            calculated_projects.append(name.split("/")[-1])
+    found_projects = find_projects(repo_names, refresh)
 
+    calculated_projects = []
     for name in repo_names:
-        # Remove all whitespace in case the user accidentally added some
-        projects = [p for p in all_projects if p.path_with_namespace.startswith(name)]
+        projects = found_projects[name]
         if not projects:
             raise ValueError(
                 f"Failed to find any projects that start with '{name}'. Maybe you need to add a group/namespace or to fix a typo?"
@@ -228,3 +487,81 @@ def get_projects(gl: gitlab.Gitlab, repo_names: List[str]) -> list:
         calculated_projects.extend(projects)
 
     return calculated_projects
+
+
+def get_last_dependency_mapping_path() -> Path:
+    return get_cache_dir() / "graph" / "last_dependencies.json"
+
+
+def load_graph_index(dependency_mapping_path: Optional[Path]) -> GraphIndex:
+    if dependency_mapping_path is None:
+        dependency_mapping_path = get_last_dependency_mapping_path()
+        if not dependency_mapping_path.is_file():
+            raise typer.BadParameter("No dependency graph has been saved yet. Run `stb graph json` first")
+    return GraphIndex.from_dependency_mapping(json.loads(dependency_mapping_path.read_text()))
+
+
+def _query_node(index: GraphIndex, query: Callable[[str], List[str]], name: str) -> List[str]:
+    try:
+        return query(name)
+    except KeyError as e:
+        raise typer.BadParameter(e.args[0]) from e
+
+
+@query_app.command()
+def dependents(
+    name: str,
+    direct: bool = typer.Option(False, help="Only show the services that depend on the package directly"),
+    dependency_mapping_path: Optional[Path] = dependency_mapping_file,
+):
+    """Show every service that depends on the package, i.e. everything you have to redeploy if you bump it"""
+    index = load_graph_index(dependency_mapping_path)
+    for dependent in _query_node(index, lambda n: index.dependents(n, transitive=not direct), name):
+        typer.echo(dependent)
+
+
+@query_app.command()
+def dependencies(
+    name: str,
+    direct: bool = typer.Option(False, help="Only show the direct dependencies of the service"),
+    dependency_mapping_path: Optional[Path] = dependency_mapping_file,
+):
+    """Show every package that the service depends on"""
+    index = load_graph_index(dependency_mapping_path)
+    for dependency in _query_node(index, lambda n: index.dependencies(n, transitive=not direct), name):
+        typer.echo(dependency)
+
+
+@query_app.command()
+def order(dependency_mapping_path: Optional[Path] = dependency_mapping_file):
+    """Show the services in topological order: every service comes after all of its dependencies"""
+    index = load_graph_index(dependency_mapping_path)
+    ordered = index.topological_order()
+    for name in ordered:
+        typer.echo(name)
+    if len(ordered) != len(index.names):
+        console.print(
+            f"[bold red]{len(index.names) - len(ordered)} services are a part of or depend on a cycle and were omitted. "
+            "See `stb graph query cycles`[/bold red]"
+        )
+        raise typer.Exit(1)
+
+
+@query_app.command()
+def cycles(dependency_mapping_path: Optional[Path] = dependency_mapping_file):
+    """Show the groups of services that depend on each other"""
+    found_cycles = load_graph_index(dependency_mapping_path).cycles()
+    for cycle in found_cycles:
+        typer.echo(" <-> ".join(cycle))
+    if found_cycles:
+        raise typer.Exit(1)
+
+
+@query_app.command()
+def rank(
+    top: int = typer.Option(20, help="The number of services to show"),
+    dependency_mapping_path: Optional[Path] = dependency_mapping_file,
+):
+    """Show the services with the most dependents and dependencies"""
+    for name, fan_in, fan_out in load_graph_index(dependency_mapping_path).fan_in_out()[:top]:
+        typer.echo(f"{name}\t{fan_in} dependents\t{fan_out} dependencies")
@@ -0,0 +1,141 @@
+from collections import deque
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
+
+
+class GraphIndex:
+    """I am an in-memory index of the dependency graph produced by `stb graph json`.
+
+    Every service and dependency gets an integer id. Edges are stored as adjacency and reverse adjacency lists
+    indexed by these ids so that all queries run in linear time of the graph size.
+    """
+
+    def __init__(self, edges: Iterable[Tuple[str, str]], nodes: Iterable[str] = ()) -> None:
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.adjacency: List[List[int]] = []
+        self.reverse_adjacency: List[List[int]] = []
+        for node in nodes:
+            self._add_node(node)
+        for dependent, dependency in edges:
+            dependent_id, dependency_id = self._add_node(dependent), self._add_node(dependency)
+            self.adjacency[dependent_id].append(dependency_id)
+            self.reverse_adjacency[dependency_id].append(dependent_id)
+
+    @classmethod
+    def from_dependency_mapping(cls, dep_mapping: Mapping[str, Mapping[str, Any]]) -> "GraphIndex":
+        return cls(
+            ((service, dep) for service, info in dep_mapping.items() for dep in info["dependencies"]),
+            nodes=dep_mapping,
+        )
+
+    def _add_node(self, name: str) -> int:
+        node_id = self.ids.get(name)
+        if node_id is None:
+            node_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.adjacency.append([])
+            self.reverse_adjacency.append([])
+        return node_id
+
+    def _id(self, name: str) -> int:
+        if name not in self.ids:
+            raise KeyError(f"'{name}' is not present in the dependency graph")
+        return self.ids[name]
+
+    def dependents(self, name: str, transitive: bool = True) -> List[str]:
+        """Returns everything that depends on the node, i.e. everything that has to be redeployed if it changes"""
+        return self._reachable(self._id(name), self.reverse_adjacency, transitive)
+
+    def dependencies(self, name: str, transitive: bool = True) -> List[str]:
+        return self._reachable(self._id(name), self.adjacency, transitive)
+
+    def _reachable(self, start: int, adjacency: List[List[int]], transitive: bool) -> List[str]:
+        seen = [False] * len(self.names)
+        seen[start] = True
+        queue = deque([start])
+        found = []
+        while queue:
+            for neighbour in adjacency[queue.popleft()]:
+                if not seen[neighbour]:
+                    seen[neighbour] = True
+                    found.append(neighbour)
+                    if transitive:
+                        queue.append(neighbour)
+        return [self.names[node] for node in found]
+
+    def topological_order(self) -> List[str]:
+        """Returns the nodes so that every node comes after all of its dependencies.
+
+        Nodes that are a part of a cycle or depend on one are omitted so check `cycles()` if the result is incomplete.
+        """
+        remaining_dependencies = [len(dependencies) for dependencies in self.adjacency]
+        queue = deque(node for node, count in enumerate(remaining_dependencies) if count == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependent in self.reverse_adjacency[node]:
+                remaining_dependencies[dependent] -= 1
+                if remaining_dependencies[dependent] == 0:
+                    queue.append(dependent)
+        return [self.names[node] for node in order]
+
+    def strongly_connected_components(self) -> List[List[str]]:
+        """Tarjan's algorithm without recursion so that deep graphs don't hit the recursion limit"""
+        node_count = len(self.names)
+        index = [-1] * node_count
+        lowlink = [0] * node_count
+        on_stack = [False] * node_count
+        stack: List[int] = []
+        components: List[List[str]] = []
+        counter = 0
+
+        for root in range(node_count):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, next_edge = work.pop()
+                if next_edge == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                neighbours = self.adjacency[node]
+                while next_edge < len(neighbours):
+                    neighbour = neighbours[next_edge]
+                    next_edge += 1
+                    if index[neighbour] == -1:
+                        work.append((node, next_edge))
+                        work.append((neighbour, 0))
+                        break
+                    elif on_stack[neighbour]:
+                        lowlink[node] = min(lowlink[node], index[neighbour])
+                else:
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            component.append(self.names[member])
+                            if member == node:
+                                break
+                        components.append(component)
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+        return components
+
+    def cycles(self) -> List[List[str]]:
+        return [
+            component
+            for component in self.strongly_connected_components()
+            if len(component) > 1 or self.ids[component[0]] in self.adjacency[self.ids[component[0]]]
+        ]
+
+    def fan_in_out(self) -> List[Tuple[str, int, int]]:
+        """Returns (name, number of direct dependents, number of direct dependencies) sorted by fan-in and fan-out"""
+        ranking = [
+            (name, len(self.reverse_adjacency[node]), len(self.adjacency[node])) for node, name in enumerate(self.names)
+        ]
+        return sorted(ranking, key=lambda item: (-item[1], -item[2], item[0]))
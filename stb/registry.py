@@ -0,0 +1,227 @@
+import datetime
+import json
+import re
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+from .catalog import CATALOG_TTL, GITLAB_MAX_PER_PAGE, gitlab_session, paginated_get
+from .config import CONFIG, get_cache_dir, get_gitlab_api_url
+from .utils.common import atomic_write_text
+
+REGISTRY_INDEX_FORMAT_VERSION = 1
+RE_VERSION_RELEASE = re.compile(r"^v?(\d+(?:\.\d+)*)(.*)$")
+RE_CONSTRAINT = re.compile(r"^(==|!=|<=|>=|~=|<|>|=|\^|~)?\s*(.+)$")
+# poetry accepts both '||' and '|' between the alternatives of a constraint
+RE_CONSTRAINT_OR = re.compile(r"\|\|?")
+# Sort keys of the pre-release tags and their aliases
+PRE_RELEASE_TAG_ORDER = {"dev": "0", "alpha": "a", "beta": "b", "c": "rc", "pre": "rc", "preview": "rc"}
+VersionKey = Tuple[Tuple[int, ...], int, Tuple[Tuple[int, str, int], ...]]
+
+
+class RegistryIndex:
+    """I am a local index of the internal package registry: every distinct package name with its sorted versions.
+
+    Gitlab returns one record per package version so instead of downloading all of them on every run,
+    I only ask for the versions created after the newest one I already know about.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.packages: Dict[str, List[str]] = {}
+        self.newest_created_at: Optional[str] = None
+        self.synced_at: Optional[datetime.datetime] = None
+
+    @classmethod
+    def load(cls, path: Path) -> "RegistryIndex":
+        index = cls(path)
+        if path.is_file():
+            try:
+                data = json.loads(path.read_text())
+            except json.JSONDecodeError:
+                return index
+            if data.get("version") == REGISTRY_INDEX_FORMAT_VERSION:
+                index.packages = data["packages"]
+                index.newest_created_at = data["newest_created_at"]
+                index.synced_at = datetime.datetime.fromisoformat(data["synced_at"])
+        return index
+
+    def save(self) -> None:
+        data = {
+            "version": REGISTRY_INDEX_FORMAT_VERSION,
+            "packages": self.packages,
+            "newest_created_at": self.newest_created_at,
+            "synced_at": self.synced_at.isoformat() if self.synced_at else None,
+        }
+        atomic_write_text(self.path, json.dumps(data))
+
+    def is_fresh(self, now: datetime.datetime) -> bool:
+        return self.synced_at is not None and now - self.synced_at <= CATALOG_TTL
+
+    def add(self, packages: Iterable[Dict[str, Any]]) -> None:
+        changed_names = set()
+        for package in packages:
+            versions = self.packages.setdefault(package["name"], [])
+            if package["version"] not in versions:
+                versions.append(package["version"])
+                changed_names.add(package["name"])
+            if self.newest_created_at is None or package["created_at"] > self.newest_created_at:
+                self.newest_created_at = package["created_at"]
+        for name in changed_names:
+            self.packages[name].sort(key=version_key)
+
+    def sync(self, session: requests.Session, registry_url: str, now: datetime.datetime) -> None:
+        params = {"package_type": "pypi", "order_by": "created_at", "sort": "desc"}
+        if self.newest_created_at is None:
+            self.add(paginated_get(registry_url, session, params))
+        else:
+            self.add(self._iter_newer_packages(session, registry_url, params))
+        self.synced_at = now
+
+    def _iter_newer_packages(self, session: requests.Session, registry_url: str, params: Dict[str, str]):
+        """Walks the newest-first listing only until it reaches the versions that are already in the index"""
+        assert self.newest_created_at is not None
+        page = 1
+        while True:
+            response = session.get(registry_url, params={**params, "page": str(page), "per_page": GITLAB_MAX_PER_PAGE})
+            response.raise_for_status()
+            packages = response.json()
+            for package in packages:
+                if package["created_at"] <= self.newest_created_at:
+                    return
+                yield package
+            if len(packages) < GITLAB_MAX_PER_PAGE:
+                return
+            page += 1
+
+    def find_name(self, name: str) -> Optional[str]:
+        """Finds the name under which the package is stored in the registry, ignoring the differences in separators"""
+        normalized_name = normalize_package_name(name)
+        for registry_name in self.packages:
+            if normalize_package_name(registry_name) == normalized_name:
+                return registry_name
+
+    def matching_versions(self, name: str, constraint: str) -> List[str]:
+        """Pre-releases only match if the constraint names one or if no release matches, the same way as in poetry"""
+        versions = self.packages.get(name, [])
+        return [version for version in versions if version_matches(version, constraint)] or [
+            version for version in versions if version_matches(version, constraint, allow_prereleases=True)
+        ]
+
+
+@CONFIG.requires("gitlab_api_token", "git_url", "pypi_registry_id")
+def get_registry_index(refresh: bool = False) -> RegistryIndex:
+    registry_id = CONFIG["pypi_registry_id"]
+    path = get_cache_dir() / "registry" / f"{CONFIG['git_url'].split('@')[-1]}-{registry_id}.json"
+    index = RegistryIndex(path) if refresh else RegistryIndex.load(path)
+    if not index.is_fresh(datetime.datetime.now(datetime.timezone.utc)):
+        sync_registry_index(index)
+    return index
+
+
+@CONFIG.requires("gitlab_api_token", "git_url", "pypi_registry_id")
+def sync_registry_index(index: RegistryIndex) -> None:
+    """Syncs the index regardless of its age, e.g. when it's missing a version that could've been published just now"""
+    with gitlab_session() as session:
+        index.sync(
+            session,
+            f"{get_gitlab_api_url()}/projects/{CONFIG['pypi_registry_id']}/packages",
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+    index.save()
+
+
+def normalize_package_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def version_key(version: str) -> VersionKey:
+    """Sorts versions by their numeric release and puts pre-releases like 1.0.0a1 before the release itself"""
+    match = RE_VERSION_RELEASE.match(version.strip())
+    if match is None:
+        return (), 0, ((0, version, 0),)
+    release = tuple(int(part) for part in match[1].split("."))
+    while len(release) > 1 and release[-1] == 0:
+        release = release[:-1]
+    suffix = match[2]
+    return release, 0 if suffix and not suffix.startswith(("+", ".post", "post")) else 1, _suffix_key(suffix)
+
+
+def _suffix_key(suffix: str) -> Tuple[Tuple[int, str, int], ...]:
+    """Compares the numbers of the suffix as numbers so that 1.0.0a10 comes after 1.0.0a2, and the pre-release tags
+    in the order of PEP 440: dev, alpha, beta, release candidate"""
+    return tuple(
+        (1, "", int(token)) if token.isdigit() else (0, PRE_RELEASE_TAG_ORDER.get(token, token), 0)
+        for token in re.findall(r"\d+|[a-z]+", suffix.lower())
+    )
+
+
+def is_prerelease(version: str) -> bool:
+    key = version_key(version)
+    return bool(key[0]) and key[1] == 0
+
+
+def version_matches(version: str, constraint: str, allow_prereleases: bool = False) -> bool:
+    """Checks the version against a poetry-style constraint such as '^4.5', '~=1.2', '>=1,<2', '^1.0 || ^2.0',
+    '1.2.*', or 'latest'. Pre-releases only match if allowed or if the constraint names a pre-release itself"""
+    constraint = constraint.strip()
+    if is_prerelease(version) and not allow_prereleases and not _names_prerelease(constraint):
+        return False
+    if constraint in {"", "*", "latest"}:
+        return True
+    return any(
+        all(_version_matches_single(version, part.strip()) for part in alternative.split(","))
+        for alternative in RE_CONSTRAINT_OR.split(constraint)
+    )
+
+
+def _names_prerelease(constraint: str) -> bool:
+    return any(
+        match is not None and is_prerelease(match[2].strip().rstrip(".*"))
+        for match in (RE_CONSTRAINT.match(part.strip()) for part in re.split(r"\|\|?|,", constraint))
+    )
+
+
+def _version_matches_single(version: str, constraint: str) -> bool:
+    match = RE_CONSTRAINT.match(constraint)
+    if match is None:
+        return False
+    operator, target = match[1] or "==", match[2].strip()
+    if target.endswith(".*"):
+        prefix = version_key(target[:-2])[0]
+        matches_prefix = version_key(version)[0][: len(prefix)] == prefix
+        return matches_prefix if operator != "!=" else not matches_prefix
+
+    key, target_key = version_key(version), version_key(target)
+    if operator in {"==", "="}:
+        return key == target_key
+    elif operator == "!=":
+        return key != target_key
+    elif operator == ">":
+        return key > target_key
+    elif operator == ">=":
+        return key >= target_key
+    elif operator == "<":
+        return key < target_key
+    elif operator == "<=":
+        return key <= target_key
+    return target_key <= key < _upper_bound(operator, target)
+
+
+def _upper_bound(operator: str, target: str) -> VersionKey:
+    parts = [int(part) for part in version_key(target)[0]] or [0]
+    raw_parts = RE_VERSION_RELEASE.match(target)
+    precision = len(raw_parts[1].split(".")) if raw_parts else len(parts)
+    parts += [0] * (precision - len(parts))
+    if operator == "^":
+        # ^1.2.3 := <2.0.0, ^0.2.3 := <0.3.0, ^0.0.3 := <0.0.4
+        position = next((i for i, part in enumerate(parts) if part != 0), len(parts) - 1)
+    elif operator == "~=":
+        # ~=1.2 := <2.0, ~=1.2.3 := <1.3.0
+        position = max(len(parts) - 2, 0)
+    else:
+        # ~1.2.3 := <1.3.0, ~1.2 := <1.3, ~1 := <2
+        position = min(1, len(parts) - 1)
+    upper = parts[:position] + [parts[position] + 1]
+    return version_key(".".join(str(part) for part in upper))[0], 0, ()
@@ -1,8 +1,11 @@
+from pathlib import Path
 from typing import Set
 
 import typer
 
 from stb.utils.common import cd_with_log, sh_with_log
+from stb.utils.parallel import PrefixedLog
+from stb.utils.venv import get_poetry_env, install_dependencies
 
 app = typer.Typer(
     name="run",
@@ -13,6 +16,8 @@ app = typer.Typer(
 def run_services(services: Set[str]) -> None:
     typer.echo("Checking out services...", err=True)
 
+    # The paths are relative to the current directory, which changes while the services are being checked out
+    service_dirs = {service: Path(service).resolve() for service in services}
     for service in services:
         with cd_with_log(service):
             # TODO: Sounds like this needs to reuse `stb update package`
@@ -20,8 +25,9 @@ def run_services(services: Set[str]) -> None:
             sh_with_log("git checkout master")
             sh_with_log("git pull")
             sh_with_log("stb db reset")
-            sh_with_log("poetry install --all-extras")
+            install_dependencies(service_dirs[service], PrefixedLog(service))
 
-    concurrently_query = " ".join([f'"cd {s} && (make run || poetry run python3 run.py)"' for s in services])
+    run_commands = {s: get_poetry_env(service_dirs[s]).command("python3", "run.py") for s in services}
+    concurrently_query = " ".join([f'"cd {s} && (make run || {run_commands[s]})"' for s in services])
 
     sh_with_log("concurrently " + concurrently_query)
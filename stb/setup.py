@@ -1,14 +1,16 @@
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
-import requests
 import tomli as toml
 import typer
 from pysh import sh, which
 
 from . import update
-from .config import CONFIG, get_gitlab_api_url
-from .utils.common import cd_with_log, clean_python_version, parse_python_version, sh_with_log
+from .catalog import find_projects
+from .config import CONFIG, get_log_dir
+from .utils.common import clean_python_version, parse_python_version, sh_with_log
+from .utils.parallel import PrefixedLog, run_concurrently
+from .utils.venv import install_dependencies
 
 PYENV_INSTALLED = which("pyenv")
 
@@ -20,72 +22,77 @@ def setup_services(
     update_env: bool,
     update_ports: bool,
     setup_poetry_env: bool,
+    clone_workers: int = 8,
+    install_workers: int = 4,
+    refresh_catalog: bool = False,
 ) -> None:
+    """Clones the services concurrently, installs their dependencies in a separate pool, and then configures them together"""
     if not "git_url" in CONFIG:
         raise typer.BadParameter("You must set the git_url in the config file before you can use this command")
     if not PYENV_INSTALLED:
         typer.echo("Failed to locate pyenv. Will use the system python version(s) instead", err=True)
-    installable_pyenv_versions = [
-        clean_python_version(v) for v in sh("pyenv install --list", capture=True).stdout.split("\n") if v.strip()
-    ]
-
-    repositories_to_clone = get_repositories_to_clone(services, skip_existing)
-
-    typer.echo(
-        f"Cloning {len(repositories_to_clone)} repositories: {', '.join([name for name, _ in repositories_to_clone])}"
-    )
-    skipped_repos = []
-    for name, link in repositories_to_clone:
-        setup_service(
-            name,
-            link,
-            installable_pyenv_versions,
-            update_env=update_env,
-            update_ports=update_ports,
-            setup_poetry_env=setup_poetry_env,
-            skipped_repos=skipped_repos,
-        )
-    if skipped_repos:
-        typer.echo(f"Skipped cloning the following repos: {', '.join(skipped_repos)}", err=True)
-
-
-def setup_service(
-    repo_name: str,
-    git_link: str,
-    installable_pyenv_versions: List[str],
-    update_env: bool,
-    update_ports: bool,
-    setup_poetry_env: bool,
-    skipped_repos: list[str],
-):
-    typer.echo(f"Setting up {repo_name}", err=True)
-    success = clone_repo(git_link)
-
-    if success:
-        if not (update_env or update_ports or setup_poetry_env):
-            return
-        with cd_with_log(repo_name):
-            if Path("pyproject.toml").exists() and setup_poetry_env:
-                python_version = get_python_version(Path("pyproject.toml"))
-                if python_version:
-                    if PYENV_INSTALLED:
-                        setup_pyenv_locally(python_version, installable_pyenv_versions)
-                    else:
-                        sh_with_log(f"poetry env use {python_version}")
-                sh_with_log("poetry install --all-extras")
-            if update_env:
-                update.env([Path()])
-            if update_ports:
-                update.ports([Path()])
+        installable_pyenv_versions = []
     else:
-        skipped_repos.append(repo_name)
+        installable_pyenv_versions = [
+            clean_python_version(v) for v in sh("pyenv install --list", capture=True).stdout.split("\n") if v.strip()
+        ]
+
+    repositories_to_clone = dict(get_repositories_to_clone(services, skip_existing, refresh_catalog))
+
+    typer.echo(f"Cloning {len(repositories_to_clone)} repositories: {', '.join(repositories_to_clone)}")
+    log_dir = get_log_dir() / "setup"
+    logs = {name: PrefixedLog(name, log_dir / f"{name}.log") for name in repositories_to_clone}
+    try:
+        clone_failures = run_concurrently(
+            lambda name: clone_repo(repositories_to_clone[name], logs[name]), repositories_to_clone, clone_workers
+        )
+        cloned_repos = [name for name in repositories_to_clone if name not in clone_failures]
+
+        install_failures: Dict[str, BaseException] = {}
+        if setup_poetry_env:
+            install_failures = run_concurrently(
+                lambda name: setup_poetry_environment(Path(name), installable_pyenv_versions, logs[name]),
+                cloned_repos,
+                install_workers,
+            )
+    finally:
+        for log in logs.values():
+            log.close()
+
+    if cloned_repos:
+        if update_env:
+            update.env([Path(name) for name in cloned_repos])
+        if update_ports:
+            update.ports([Path(name) for name in cloned_repos])
+
+    if clone_failures:
         typer.echo(
-            f"FAILED to enter the directory '{repo_name}'. Most likely because such directory already exists", err=True
+            f"Skipped cloning the following repos: {', '.join(clone_failures)}. "
+            "Most likely because directories with the same names already exist",
+            err=True,
         )
+    if install_failures:
+        typer.echo(f"Failed to install dependencies for: {', '.join(install_failures)}", err=True)
+    if clone_failures or install_failures:
+        typer.echo(f"See the logs of each repository in {log_dir}", err=True)
 
 
-def clone_repo(git_link: str) -> bool:
-    return bool(sh_with_log(f"git clone {git_link}"))
+def clone_repo(git_link: str, log: PrefixedLog) -> None:
+    if not log.sh(f"git clone {git_link}"):
+        raise RuntimeError(f"Failed to clone {git_link}")
+
+
+def setup_poetry_environment(repo_dir: Path, installable_pyenv_versions: List[str], log: PrefixedLog) -> None:
+    pyproject_path = repo_dir / "pyproject.toml"
+    if not pyproject_path.exists():
+        return
+    python_version = get_python_version(pyproject_path)
+    if python_version:
+        if PYENV_INSTALLED:
+            setup_pyenv_locally(python_version, installable_pyenv_versions, log, repo_dir)
+        else:
+            log.sh(f"poetry env use {python_version}", repo_dir)
+    install_dependencies(repo_dir, log)
 
 
 def get_python_version(pyproject_path: Path) -> Optional[str]:
@@ -100,8 +107,10 @@ def get_python_version(pyproject_path: Path) -> Optional[str]:
         )
 
 
-def setup_pyenv_locally(python_version: str, installable_pyenv_versions: List[str]):
-    raw_installed_pyenv_venvs = sh("pyenv versions", capture=True).stdout.split("\n")
+def setup_pyenv_locally(
+    python_version: str, installable_pyenv_versions: List[str], log: PrefixedLog, cwd: Path = Path(".")
+):
+    raw_installed_pyenv_venvs = sh("pyenv versions", capture=True, cwd=cwd).stdout.split("\n")
     installed_pyenv_venvs = [clean_python_version(v) for v in raw_installed_pyenv_venvs]
     installable_python_version = get_usable_pyenv_version(
         python_version,
@@ -114,8 +123,8 @@ def setup_pyenv_locally(python_version: str, installable_pyenv_versions: List[st
     if installable_python_version is not None:
         if " " in installable_python_version:
             installable_python_version = installable_python_version.split(" ")[0]
-        sh_with_log(f"pyenv local {installable_python_version}")
-        sh_with_log(f"poetry env use {installable_python_version}")
+        log.sh(f"pyenv local {installable_python_version}", cwd)
+        log.sh(f"poetry env use {installable_python_version}", cwd)
 
 
 def get_usable_pyenv_version(current: str, available: Sequence[str], install: bool = False) -> Optional[str]:
@@ -127,57 +136,35 @@ def get_usable_pyenv_version(current: str, available: Sequence[str], install: bo
             return version
 
 
-def get_repositories_to_clone(repo_names: List[str], skip_existing: bool) -> List[Tuple[str, str]]:
+def get_repositories_to_clone(
+    repo_names: List[str], skip_existing: bool, refresh_catalog: bool = False
+) -> List[Tuple[str, str]]:
     """Expands gitlab repo names to include all repos if the name is a group or a namespace"""
     expanded_repo_names = []
+    # Remove all whitespace in case the user accidentally added some
+    repo_names = ["".join(name.split()) for name in repo_names]
+    names_to_expand = [name for name in repo_names if name.count("/") != 2]
+    expanded_names = find_projects(names_to_expand, refresh_catalog) if names_to_expand else {}
 
     for name in repo_names:
-        # Remove all whitespace in case the user accidentally added some
-        name = "".join(name.split())
-
         if name.count("/") == 2:
             expanded_repo_names.append((name.split("/")[-1], f'{CONFIG["git_url"]}:{name}.git'))
         else:
-            with requests.Session() as session:
-                session.headers = {"PRIVATE-TOKEN": CONFIG.get_api_token()}
-                project_jsons = _paginated_get(f"{get_gitlab_api_url()}/projects", session)
-
-                projects = [
-                    (p["path"], p["ssh_url_to_repo"])
-                    for p in project_jsons
-                    if p["path_with_namespace"].startswith(name)
-                ]
-                if not projects:
-                    raise ValueError(
-                        f"Failed to find any projects that start with '{name}'. Maybe you need to add a group/namespace or to fix a typo?"
+            projects = [(p.path, p.ssh_url_to_repo) for p in expanded_names[name]]
+            if not projects:
+                raise ValueError(
+                    f"Failed to find any projects that start with '{name}'. Maybe you need to add a group/namespace or to fix a typo?"
+                )
+            non_repeating_projects = []
+            for project in projects:
+                if Path(project[0]).exists():
+                    yes = skip_existing or typer.confirm(
+                        f"Found project {project[0]} but a folder with the same name already exists. You should use `stb update` for it instead. Would you like to skip it?",
                     )
-                non_repeating_projects = []
-                for project in projects:
-                    if Path(project[0]).exists():
-                        yes = skip_existing or typer.confirm(
-                            f"Found project {project[0]} but a folder with the same name already exists. You should use `stb update` for it instead. Would you like to skip it?",
-                        )
-                        if not yes:
-                            raise typer.Exit(1)
-                    else:
-                        non_repeating_projects.append(project)
-                expanded_repo_names.extend(non_repeating_projects)
+                    if not yes:
+                        raise typer.Exit(1)
+                else:
+                    non_repeating_projects.append(project)
+            expanded_repo_names.extend(non_repeating_projects)
 
     return expanded_repo_names
-
-
-def _paginated_get(url: str, session: requests.Session) -> List[Dict[str, Any]]:
-    """Gets a paginated response from the gitlab api"""
-    response = session.get(url, params={"per_page": 20})
-    response.raise_for_status()
-
-    total_pages = int(response.headers["X-Total-Pages"])
-
-    projects = response.json()
-
-    for _ in range(1, total_pages):
-        response = session.get(response.links["next"]["url"])
-        response.raise_for_status()
-        projects.extend(response.json())
-
-    return projects
@@ -0,0 +1,120 @@
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import typer
+from rich.console import Console
+from rich.table import Table
+
+from .utils.common import gather_services, get_discovery_depth
+
+# Never wait for a password prompt that nobody is going to answer
+GIT_ENV = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+
+
+@dataclass
+class RepositoryStatus:
+    name: str
+    dir: str
+    branch: Optional[str] = None
+    detached: bool = False
+    upstream: Optional[str] = None
+    ahead: Optional[int] = None
+    behind: Optional[int] = None
+    changed: int = 0
+    untracked: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.changed or self.untracked)
+
+
+def show_status(
+    service_paths: List[Path],
+    fetch: bool,
+    output_json: bool,
+    workers: int,
+    fetch_timeout: float,
+    recursive: bool = False,
+    max_depth: Optional[int] = None,
+) -> None:
+    """I print the git status of every service, querying all of their repositories at the same time"""
+    services = gather_services(service_paths, max_depth=get_discovery_depth(recursive, max_depth))
+    statuses = get_statuses({name: service.dir for name, service in services.items()}, fetch, workers, fetch_timeout)
+    if output_json:
+        typer.echo(json.dumps([{**asdict(status), "dirty": status.dirty} for status in statuses], indent=4))
+    else:
+        Console().print(render_statuses(statuses))
+
+
+def get_statuses(
+    repositories: Dict[str, Path], fetch: bool = False, workers: int = 16, fetch_timeout: float = 30
+) -> List[RepositoryStatus]:
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        statuses = executor.map(
+            lambda item: get_repository_status(item[0], item[1], fetch, fetch_timeout), repositories.items()
+        )
+        return sorted(statuses, key=lambda status: status.name)
+
+
+def get_repository_status(name: str, dir: Path, fetch: bool = False, fetch_timeout: float = 30) -> RepositoryStatus:
+    """Porcelain v2 reports the branch, its upstream, the ahead/behind counts, and the changes in a single git call"""
+    status = RepositoryStatus(name, str(dir))
+    if fetch:
+        try:
+            process = run_git(dir, ["fetch", "--quiet", "--no-tags", "--no-recurse-submodules"], fetch_timeout)
+            if process.returncode:
+                status.errors.append(f"git fetch failed: {process.stderr.strip()}")
+        except subprocess.TimeoutExpired:
+            status.errors.append(f"git fetch timed out after {fetch_timeout:g} seconds")
+    process = run_git(dir, ["status", "--porcelain=v2", "--branch", "--untracked-files=normal"])
+    if process.returncode:
+        status.errors.append(process.stderr.strip() or "git status failed")
+        return status
+    for line in process.stdout.splitlines():
+        if line.startswith("# branch.head "):
+            head = line.split(" ", 2)[2]
+            status.detached = head == "(detached)"
+            status.branch = None if status.detached else head
+        elif line.startswith("# branch.upstream "):
+            status.upstream = line.split(" ", 2)[2]
+        elif line.startswith("# branch.ab "):
+            ahead, behind = line.split(" ")[2:4]
+            status.ahead, status.behind = int(ahead), -int(behind)
+        elif line.startswith("? "):
+            status.untracked += 1
+        elif line[:2] in {"1 ", "2 ", "u "}:
+            status.changed += 1
+    return status
+
+
+def run_git(dir: Path, args: List[str], timeout: Optional[float] = None) -> "subprocess.CompletedProcess[str]":
+    return subprocess.run(
+        ["git", *args],
+        cwd=dir,
+        env=GIT_ENV,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+
+
+def render_statuses(statuses: List[RepositoryStatus]) -> Table:
+    table = Table("Service", "Branch", "Changed", "Untracked", "Ahead", "Behind", "Errors", title="stb status")
+    for status in statuses:
+        table.add_row(
+            status.name,
+            "[yellow](detached)[/]" if status.detached else status.branch or "",
+            f"[bold red]{status.changed}[/]" if status.changed else "0",
+            f"[red]{status.untracked}[/]" if status.untracked else "0",
+            "" if status.ahead is None else str(status.ahead),
+            "" if status.behind is None else (f"[yellow]{status.behind}[/]" if status.behind else "0"),
+            "[bold red]" + "; ".join(status.errors) + "[/]" if status.errors else "",
+        )
+    return table
@@ -1,22 +1,30 @@
-from contextlib import suppress
+import functools
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
 import rich
 import typer
 from pysh import sh
+from rich.live import Live
+from rich.table import Table
 
 from .db import Choices
 from .db import run_on_single_service as stb_db
 from .utils.common import (
+    CHECK_ARG,
     ENV_VARS,
+    MAX_DEPTH_ARG,
+    RECURSIVE_ARG,
     SERVICE_PATHS_ARG,
+    Service,
     add_default_service_path,
-    cd_with_log,
     gather_services,
+    get_discovery_depth,
+    report_dotenv_changes,
     save_dotenv_file,
-    sh_with_log,
 )
+from .utils.parallel import PrefixedLog, TaskGraph, TaskStatus
+from .utils.venv import install_dependencies
 
 
 def old_reset_databases_flag_deprecation_callback(value: bool) -> None:
@@ -44,30 +52,64 @@ NO_RESET_DATABASES_ARG = typer.Option(
     "--no-reset-databases",
     help="Do not run 'stb db reset -fp' after updating the services",
 )
+ALL_SERVICES = "(all services)"
+STEPS = "git", "install", "env", "ports", "db"
+STATUS_STYLES = {
+    TaskStatus.pending: "dim",
+    TaskStatus.running: "yellow",
+    TaskStatus.done: "green",
+    TaskStatus.failed: "bold red",
+    TaskStatus.skipped: "dim",
+}
+SNAPSHOT_DATABASES_ARG = typer.Option(
+    False,
+    "-s",
+    "--snapshot-databases",
+    help="Reset databases from their snapshots the same way as 'stb db reset --snapshot' does",
+)
 
 
 @app.command()
 @add_default_service_path
-def env(service_paths: List[Path] = SERVICE_PATHS_ARG):
+def env(
+    service_paths: List[Path] = SERVICE_PATHS_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
+    check: bool = CHECK_ARG,
+):
     """Update .env files with new/modified fields from .env.example"""
-    for service in gather_services(service_paths).values():
+    services = gather_services(
+        service_paths, load=("dotenv", "dotenv_example"), max_depth=get_discovery_depth(recursive, max_depth)
+    )
+    diffs = {}
+    for service in services.values():
         for field, example_value in service.dotenv_example.items():
             replacing_value = example_value or ENV_VARS.get(field)
             if field in service.dotenv:
                 pass
             else:
                 service.dotenv[field] = str(replacing_value) if replacing_value else ""
-        save_dotenv_file(service)
-        typer.echo(f"Updated {service.dotenv_path}")
+        diffs[service.dotenv_path] = save_dotenv_file(service, check)
+    report_dotenv_changes(diffs, check)
 
 
 @app.command()
 @add_default_service_path
-def ports(service_paths: List[Path] = SERVICE_PATHS_ARG) -> None:
+def ports(
+    service_paths: List[Path] = SERVICE_PATHS_ARG,
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
+    check: bool = CHECK_ARG,
+) -> None:
     """I update service ports to allow you to quickly set up a set of microservices locally and use all others from dev"""
-    services = gather_services(service_paths)
+    services = gather_services(
+        service_paths,
+        load=("dotenv", "dotenv_example", "yaml_config"),
+        max_depth=get_discovery_depth(recursive, max_depth),
+    )
     service_to_port_mapper = {service.dir.name: port for port, service in enumerate(services.values(), start=8000)}
     microservice_fields = {convert_microservice_name_to_env_field(m): n for m, n in service_to_port_mapper.items()}
+    diffs = {}
     for service_name, service in services.items():
         helm_env_defaults = (service.yaml_config or {}).get("common", {}).get("envs", {})
         service.dotenv["SERVICE_PORT"] = str(service_to_port_mapper[service_name])
@@ -79,8 +121,8 @@ def ports(service_paths: List[Path] = SERVICE_PATHS_ARG) -> None:
                 if helm_defaults is not None and "review" in helm_defaults:
                     service.dotenv[field] = helm_defaults["review"]
 
-        save_dotenv_file(service)
-        typer.echo(f"Updated {service.dotenv_path}")
+        diffs[service.dotenv_path] = save_dotenv_file(service, check)
+    report_dotenv_changes(diffs, check)
 
 
 @app.command()
@@ -95,6 +137,10 @@ def package(
         True,
         help="If --install-dependencies is true, install all extras as well",
     ),
+    partial_install: bool = typer.Option(
+        True,
+        help="When only poetry.lock has changed since the last install, install and remove just the packages whose versions changed instead of running poetry install",
+    ),
     update_dependencies: bool = typer.Option(
         False,
         "-u",
@@ -127,41 +173,141 @@ def package(
     ),
     old_reset_databases: bool = OLD_RESET_DATABASES_ARG,
     no_reset_databases: bool = NO_RESET_DATABASES_ARG,
+    snapshot_databases: bool = SNAPSHOT_DATABASES_ARG,
+    git_workers: int = typer.Option(8, min=1, help="Number of services to run git commands for at the same time"),
+    install_workers: int = typer.Option(
+        4, min=1, help="Number of services to install dependencies for at the same time"
+    ),
+    db_workers: int = typer.Option(2, min=1, help="Number of services to reset databases for at the same time"),
+    recursive: bool = RECURSIVE_ARG,
+    max_depth: Optional[int] = MAX_DEPTH_ARG,
 ):
     """Install the dependencies from poetry.lock file, update submodules, optionally update dependencies, and optionally reset databases"""
-    branches_where_stashes_happened = []
-
-    for service in gather_services(service_paths).values():
-        with cd_with_log(service.dir):
-            if checkout_to_master:
-                res = sh("git diff", capture=True)
-                if res.stdout:
-                    sh_with_log("git stash")
-                    res = sh("git branch --show-current", capture=True)
-                    if res.returncode == 0:
-                        branches_where_stashes_happened.append(service.dir.name + "/" + res.stdout.strip())
-                sh_with_log("git checkout master")
-            if pull_changes:
-                sh_with_log("git pull")
+    from .config import get_log_dir
+
+    services = gather_services(service_paths, max_depth=get_discovery_depth(recursive, max_depth))
+    log_dir = get_log_dir() / "update"
+    logs = {name: PrefixedLog(name, log_dir / f"{name}.log") for name in services}
+    branches_where_stashes_happened: List[str] = []
+    graph: TaskGraph[Tuple[str, str]] = TaskGraph(
+        {"git": git_workers, "install": install_workers, "env": git_workers, "db": db_workers}
+    )
+
+    for name, service in services.items():
+        log = logs[name]
+        git_steps = []
+        if checkout_to_master or pull_changes:
+            graph.add(
+                (name, "git"),
+                functools.partial(
+                    update_git, service, log, checkout_to_master, pull_changes, branches_where_stashes_happened
+                ),
+                "git",
+            )
+            git_steps = [(name, "git")]
+        db_dependencies = list(git_steps)
+        if update_dependencies or install:
             if update_dependencies:
-                sh_with_log("poetry update")
-            elif install:
-                all_extras_arg = "--all-extras" if all_extras else ""
-                sh_with_log(f"poetry install {all_extras_arg}")
-            if update_env:
-                env([service.dir])
-            if update_ports:
-                ports([service.dir])
-            if not no_reset_databases:
-                print(f"Resetting databases for {service.dir.name}...")
-                with suppress(LookupError):
-                    stb_db(service.dir, Choices.drop, force_drop=True)
-                    stb_db(service.dir, Choices.create, parallel_migrations=True)
+                install_step = functools.partial(run_step, log, "poetry update", service.dir)
+            else:
+                install_step = functools.partial(
+                    install_dependencies, service.dir, log, "--all-extras" if all_extras else "", partial_install
+                )
+            graph.add((name, "install"), install_step, "install", git_steps)
+            db_dependencies.append((name, "install"))
+        if update_env:
+            graph.add(
+                (name, "env"),
+                functools.partial(env, [service.dir], recursive=False, max_depth=None, check=False),
+                "env",
+                git_steps,
+            )
+            db_dependencies.append((name, "env"))
+        if not no_reset_databases:
+            graph.add(
+                (name, "db"),
+                functools.partial(reset_databases, service, log, snapshot_databases),
+                "db",
+                db_dependencies,
+            )
+    if update_ports:
+        # Ports are assigned to all services at once so they have to wait until every .env is ready
+        env_steps = [key for key in graph.tasks if key[1] in {"env", "git"}]
+        graph.add(
+            (ALL_SERVICES, "ports"),
+            functools.partial(
+                ports, [service.dir for service in services.values()], recursive=False, max_depth=None, check=False
+            ),
+            "env",
+            env_steps,
+            requires_success=False,
+        )
+
+    try:
+        with Live(render_summary(graph), refresh_per_second=4, redirect_stdout=True, redirect_stderr=True) as live:
+            failures = graph.run(lambda key, status: live.update(render_summary(graph)))
+    finally:
+        for log in logs.values():
+            log.close()
 
     if branches_where_stashes_happened:
         typer.echo(
             f"------------\nStashed changes in the following branches: {', '.join(branches_where_stashes_happened)}"
         )
+    if failures:
+        for (name, step), exception in failures.items():
+            typer.echo(f"[{name}] {step} failed: {exception}", err=True)
+        typer.echo(f"See the logs of each service in {log_dir}", err=True)
+        raise typer.Exit(1)
+
+
+def update_git(
+    service: Service,
+    log: PrefixedLog,
+    checkout_to_master: bool,
+    pull_changes: bool,
+    branches_where_stashes_happened: List[str],
+) -> None:
+    if checkout_to_master:
+        res = sh("git diff", capture=True, cwd=service.dir)
+        if res.stdout:
+            run_step(log, "git stash", service.dir)
+            res = sh("git branch --show-current", capture=True, cwd=service.dir)
+            if res.returncode == 0:
+                branches_where_stashes_happened.append(service.dir.name + "/" + res.stdout.strip())
+        run_step(log, "git checkout master", service.dir)
+    if pull_changes:
+        run_step(log, "git pull", service.dir)
+
+
+def reset_databases(service: Service, log: PrefixedLog, use_snapshots: bool) -> None:
+    try:
+        stb_db(service.dir, Choices.drop, force_drop=True, log=log)
+    except LookupError:
+        log.echo("Skipped resetting the databases")
+        return
+    stb_db(service.dir, Choices.create, parallel_migrations=True, use_snapshots=use_snapshots, log=log)
+
+
+def run_step(log: PrefixedLog, command: str, cwd: Path) -> None:
+    if not log.sh(command, cwd):
+        raise RuntimeError(f"'{command}' has failed")
+
+
+def render_summary(graph: "TaskGraph[Tuple[str, str]]") -> Table:
+    steps = [step for step in STEPS if any(key[1] == step for key in graph.tasks)]
+    table = Table("Service", *steps, title="stb update package")
+    for name in dict.fromkeys(key[0] for key in graph.tasks):
+        table.add_row(
+            name,
+            *(
+                f"[{STATUS_STYLES[graph.statuses[name, step]]}]{graph.statuses[name, step].value}[/]"
+                if (name, step) in graph.statuses
+                else ""
+                for step in steps
+            ),
+        )
+    return table
 
 
 def convert_microservice_name_to_env_field(name: str) -> str:
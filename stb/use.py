@@ -1,12 +1,14 @@
+import functools
 import itertools
 from pathlib import Path
-from typing import Any, List
+from typing import Any, List, Optional
 
 import tomli as toml
 import typer
 from pysh import which
 
 from stb.config import CONFIG
+from stb.registry import RegistryIndex, get_registry_index, sync_registry_index
 from stb.utils.common import sh_with_log
 
 from .utils.dependency_parser import parse_dependency_specification
@@ -47,6 +49,9 @@ def use_packages(requirements: List[str], editable: bool = False, fix: bool = Fa
                     "You must set the pypi_source in the config file before you can use this command"
                 )
 
+            registry_index = _get_registry_index_if_configured()
+            if registry_index is not None:
+                validate_version_in_registry(registry_index, spec.name, version)
             extras_arg = f'[{",".join(extras)}]' if extras else ""
             version_based_requirements.append(f'"{spec.name}{extras_arg}@{version}"')
 
@@ -61,6 +66,30 @@ def use_packages(requirements: List[str], editable: bool = False, fix: bool = Fa
         sh_with_log(f"poetry add {formatted_version_based_requirements} --source={CONFIG['pypi_source']}")
 
 
+@functools.lru_cache(maxsize=None)
+def _get_registry_index_if_configured() -> Optional[RegistryIndex]:
+    """Versions are only validated locally if stb knows how to access the registry"""
+    if all(key in CONFIG for key in ("gitlab_api_token", "git_url", "pypi_registry_id")):
+        return get_registry_index()
+
+
+def validate_version_in_registry(registry_index: RegistryIndex, package_name: str, version: str) -> None:
+    registry_name = registry_index.find_name(package_name)
+    if registry_name is None or not registry_index.matching_versions(registry_name, version):
+        # The index can be up to CATALOG_TTL old so the package or the version could've been published since then
+        sync_registry_index(registry_index)
+        registry_name = registry_index.find_name(package_name)
+    if registry_name is None:
+        raise typer.BadParameter(f"Package '{package_name}' was not found in the registry")
+    matching_versions = registry_index.matching_versions(registry_name, version)
+    if not matching_versions:
+        available_versions = ", ".join(registry_index.packages[registry_name][-10:])
+        raise typer.BadParameter(
+            f"No version of '{package_name}' matches '{version}'. The latest available versions: {available_versions}"
+        )
+    typer.echo(f"Resolved '{package_name}' version '{version}' to {matching_versions[-1]}")
+
+
 def extract_package_info_from_pyproject(package_name: str, dependencies: "dict[str, str | dict]") -> "dict[str, Any]":
     if package_name in dependencies:
         old_value = dependencies[package_name]
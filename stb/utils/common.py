@@ -1,13 +1,17 @@
+import difflib
+import fnmatch
 import functools
+import io
+import os
 import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 
 import dotenv
 import typer
-import yaml
 from pysh import cd, sh
 from typing_extensions import Concatenate, ParamSpec, TypeAlias
 
@@ -20,7 +24,26 @@ SERVICE_PATHS_ARG = typer.Argument(
     show_default=False,
 )
 VERBOSE_ARG = typer.Option(False, "-v", "--verbose", help="Print debugging output")
+RECURSIVE_ARG = typer.Option(
+    False,
+    "--recursive",
+    help="Look for services in all subdirectories of the root directories instead of only in their direct subdirectories",
+)
+MAX_DEPTH_ARG = typer.Option(
+    None, "--max-depth", min=1, help="How many levels of subdirectories to look for services in. Implies --recursive"
+)
+# Directories that never contain services but can contain a lot of subdirectories
+PRUNED_DIRS = {".git", ".venv", "node_modules"}
+STBIGNORE_FILE = ".stbignore"
 DOTENV_SECTION_SEPARATOR = "\n# =======================================\n"
+DOTENV_EXTRA_SECTION_TITLE = "# Env vars not present in .env.example"
+CHECK_ARG = typer.Option(
+    False, "--check", help="Only show how the .env files would change and fail if any of them would"
+)
+# Below this many services, starting threads costs more than loading the services one by one
+PARALLEL_LOAD_THRESHOLD = 8
+LOAD_WORKERS = 8
+_NOT_LOADED: Any = object()
 
 ENV_VARS = {
     # Postgres
@@ -69,74 +92,323 @@ def add_default_service_path(function: Callable[Concatenate[List[Path], P], R])
     return wrapper
 
 
-@dataclass(frozen=True)
 class Service:
-    dir: Path
-    yaml_config: Union[Dict[str, Any], None]
-    dotenv_path: Path
-    dotenv: Dict[str, Union[str, None]]
-    dotenv_example: Dict[str, Union[str, None]]
-    dotenv_example_original_source: str
-
-
-def get_service(dir: Path):
-    dir = dir.absolute()
-    return Service(
-        dir,
-        yaml.safe_load(safely_read_text(dir / ".helm/values.yaml")),
-        dir / "settings/.env",
-        dotenv.dotenv_values(dir / "settings/.env"),
-        dotenv.dotenv_values(dir / "settings/.env.example"),
-        safely_read_text(dir / "settings/.env.example"),
-    )
-
-
-def gather_services(paths: List[Path]) -> Dict[str, Service]:
+    """I read the files of a service only when their contents are first needed and remember them afterwards.
+
+    Most commands need only a part of a service: `stb db` never looks at helm values and `update env` never parses
+    them either, while YAML parsing is the slowest part of loading a service.
+    """
+
+    __slots__ = "dir", "dotenv_path", "_yaml_config", "_dotenv", "_dotenv_example", "_dotenv_example_original_source"
+
+    def __init__(
+        self,
+        dir: Path,
+        *,
+        yaml_config: Any = _NOT_LOADED,
+        dotenv: Any = _NOT_LOADED,
+        dotenv_example: Any = _NOT_LOADED,
+        dotenv_example_original_source: Optional[str] = None,
+    ) -> None:
+        """The fields that are passed are used as is, e.g. when they come from the workspace index"""
+        self.dir = dir
+        self.dotenv_path = dir / "settings/.env"
+        self._yaml_config = yaml_config
+        self._dotenv = dotenv
+        self._dotenv_example = dotenv_example
+        self._dotenv_example_original_source = dotenv_example_original_source
+
+    @property
+    def yaml_config(self) -> Union[Dict[str, Any], None]:
+        if self._yaml_config is _NOT_LOADED:
+            # PyYAML takes a noticeable part of the startup time of the commands that don't need helm values
+            import yaml
+
+            self._yaml_config = yaml.safe_load(safely_read_text(self.dir / ".helm/values.yaml"))
+        return self._yaml_config
+
+    @property
+    def dotenv(self) -> Dict[str, Union[str, None]]:
+        if self._dotenv is _NOT_LOADED:
+            self._dotenv = dotenv.dotenv_values(self.dotenv_path)
+        return self._dotenv
+
+    @property
+    def dotenv_example(self) -> Dict[str, Union[str, None]]:
+        if self._dotenv_example is _NOT_LOADED:
+            self._dotenv_example = dotenv.dotenv_values(stream=io.StringIO(self.dotenv_example_original_source))
+        return self._dotenv_example
+
+    @property
+    def dotenv_example_original_source(self) -> str:
+        if self._dotenv_example_original_source is None:
+            self._dotenv_example_original_source = safely_read_text(self.dir / "settings/.env.example")
+        return self._dotenv_example_original_source
+
+    def load(self, fields: Iterable[str]) -> "Service":
+        for field in fields:
+            getattr(self, field)
+        return self
+
+    def __repr__(self) -> str:
+        return f"Service({str(self.dir)!r})"
+
+
+def get_service(dir: Path) -> Service:
+    return Service(dir.absolute())
+
+
+def gather_services(
+    paths: List[Path],
+    load: Iterable[str] = (),
+    workers: int = LOAD_WORKERS,
+    use_index: bool = True,
+    max_depth: Optional[int] = 1,
+) -> Dict[str, Service]:
+    """Finds the services in the paths. The fields in `load` are read right away, for many services at the same time.
+
+    Root directories are searched max_depth levels deep (see unpack_root_path) and their services come from
+    their workspace index so only the files that have changed are parsed.
+    """
+    from .workspace_index import WorkspaceIndex
+
+    load = tuple(load)
+    services: Dict[str, Service] = {}
     service_dirs: List[Path] = []
     for path in paths:
         path = path.resolve()
 
         if is_service_dir(path):
             service_dirs.append(path)
+            add_service(services, get_service(path))
+        elif use_index:
+            index = WorkspaceIndex.open(path)
+            for service in index.get_services(load, workers, max_depth).values():
+                add_service(services, service)
+            index.save()
         else:
-            service_dirs.extend(unpack_root_path(path))
-
-    return {dir.name: get_service(dir) for dir in service_dirs}
+            for dir in unpack_root_path(path, max_depth):
+                service_dirs.append(dir)
+                add_service(services, get_service(dir))
+
+    services_to_load = [services[dir.name] for dir in service_dirs]
+    if load and len(services_to_load) >= PARALLEL_LOAD_THRESHOLD:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda service: service.load(load), services_to_load))
+    else:
+        for service in services_to_load:
+            service.load(load)
+    return services
+
+
+def add_service(services: Dict[str, Service], service: Service) -> None:
+    """Services are known by their directory names everywhere (ports, logs, databases), so two different services
+    with the same name, e.g. backend/auth and infra/auth found by a recursive search, can't be told apart"""
+    existing = services.get(service.dir.name)
+    if existing is not None and existing.dir != service.dir:
+        raise typer.BadParameter(
+            f"Found two services named '{service.dir.name}': {existing.dir} and {service.dir}. "
+            "Rename one of them, list it in a .stbignore file, or pass the services one by one"
+        )
+    services[service.dir.name] = service
 
 
 def safely_read_text(path: Path) -> str:
     return path.read_text() if path.is_file() else ""
 
 
+def atomic_write_text(path: Path, text: str, mode: Optional[int] = None) -> None:
+    """Writes the file through a temporary file and a rename so that readers never see a partially written file.
+
+    The file gets the mode if it's given, and keeps its current mode (or gets 0o644 if it's new) otherwise.
+    A symlink is followed so that the file it points to is written instead of the link being replaced.
+    """
+    path = path.resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, prefix=f".{path.name}.", delete=False) as f:
+        f.write(text)
+    if mode is None:
+        mode = path.stat().st_mode if path.exists() else 0o644
+    os.chmod(f.name, mode)
+    os.replace(f.name, path)
+
+
 def is_service_dir(path: Path) -> bool:
     return path.is_dir() and (path / "settings/.env.example").exists()
 
 
-def unpack_root_path(path: Path) -> List[Path]:
-    return [p for p in path.iterdir() if is_service_dir(p)]
+def unpack_root_path(path: Path, max_depth: Optional[int] = 1, workers: int = 1) -> List[Path]:
+    """Returns the services under the path, looking max_depth levels deep (or all the way down if it's None).
+
+    I don't descend into services, into PRUNED_DIRS, or into the directories that match the patterns of a .stbignore
+    file. With several workers, the subtrees of the path are walked at the same time, which only pays off on slow
+    filesystems like network mounts because the walk is mostly syscalls.
+    """
+    _, service_dirs, subdirectories, ignore_patterns = scan_directory(str(path), [])
+    if workers > 1 and len(subdirectories) > 1 and max_depth != 1:
+        with ThreadPoolExecutor(workers) as executor:
+            found = executor.map(lambda d: walk_directory(d, ignore_patterns, max_depth), subdirectories)
+            service_dirs.extend(service_dir for subtree in found for service_dir in subtree)
+    else:
+        for subdirectory in subdirectories:
+            service_dirs.extend(walk_directory(subdirectory, ignore_patterns, max_depth))
+    return [Path(service_dir) for service_dir in service_dirs]
+
+
+def walk_directory(directory: str, ignore_patterns: List[Tuple[str, str]], max_depth: Optional[int]) -> List[str]:
+    """Returns the directory if it's a service or the services under it. The directory itself is at depth 1"""
+    service_dirs: List[str] = []
+    stack = [(directory, ignore_patterns, 1)]
+    while stack:
+        directory, ignore_patterns, depth = stack.pop()
+        is_service, symlinked_service_dirs, subdirectories, ignore_patterns = scan_directory(directory, ignore_patterns)
+        if is_service:
+            service_dirs.append(directory)
+        elif max_depth is None or depth < max_depth:
+            service_dirs.extend(symlinked_service_dirs)
+            # Reversed so that the stack pops them in the order of the directory listing
+            stack.extend((subdirectory, ignore_patterns, depth + 1) for subdirectory in reversed(subdirectories))
+    return service_dirs
+
+
+def scan_directory(
+    directory: str, ignore_patterns: List[Tuple[str, str]]
+) -> Tuple[bool, List[str], List[str], List[Tuple[str, str]]]:
+    """Lists the directory once and returns whether it's a service, the symlinks in it that point at services, the
+    subdirectories to walk into, and the ignore patterns for them.
+
+    A symlink is never walked into because it could lead back up the tree, so it only counts if it is a service itself.
+    """
+    try:
+        with os.scandir(directory) as iterator:
+            entries = list(iterator)
+    except OSError:
+        return False, [], [], ignore_patterns
+    names = {entry.name for entry in entries}
+    if "settings" in names and os.path.isfile(os.path.join(directory, "settings", ".env.example")):
+        return True, [], [], ignore_patterns
+    if STBIGNORE_FILE in names:
+        ignore_patterns = ignore_patterns + read_ignore_patterns(directory)
+    symlinked_service_dirs: List[str] = []
+    subdirectories: List[str] = []
+    for entry in entries:
+        if entry.name in PRUNED_DIRS or not entry.is_dir() or is_ignored(entry.path, ignore_patterns):
+            continue
+        elif not entry.is_symlink():
+            subdirectories.append(entry.path)
+        elif os.path.isfile(os.path.join(entry.path, "settings", ".env.example")):
+            symlinked_service_dirs.append(entry.path)
+    return False, symlinked_service_dirs, subdirectories, ignore_patterns
+
+
+def read_ignore_patterns(directory: "Path | str") -> List[Tuple[str, str]]:
+    """Reads gitignore-like patterns: the ones with a slash are matched against the path relative to the directory of
+    the .stbignore file and the others are matched against the name of each directory"""
+    try:
+        lines = Path(directory, STBIGNORE_FILE).read_text().splitlines()
+    except OSError:
+        return []
+    return [(str(directory), line.strip().strip("/")) for line in lines if line.strip() and not line.startswith("#")]
+
+
+def is_ignored(path: str, ignore_patterns: List[Tuple[str, str]]) -> bool:
+    for base, pattern in ignore_patterns:
+        if "/" in pattern:
+            if fnmatch.fnmatchcase(os.path.relpath(path, base).replace(os.sep, "/"), pattern):
+                return True
+        elif fnmatch.fnmatchcase(os.path.basename(path), pattern):
+            return True
+    return False
+
+
+def get_discovery_depth(recursive: bool, max_depth: Optional[int]) -> Optional[int]:
+    """Translates RECURSIVE_ARG and MAX_DEPTH_ARG into the max_depth of unpack_root_path"""
+    if max_depth is not None:
+        return max_depth
+    return None if recursive else 1
+
+
+def save_dotenv_file(service: Service, check: bool = False) -> Optional[str]:
+    """I write service.dotenv into its file, changing only the lines of the variables that have changed.
+
+    The file is written atomically and only if its contents change so that file watchers and reloaders don't wake up.
+    Returns the diff of the file or None if it's already up to date. With check, I only return the diff.
+    """
+    original = safely_read_text(service.dotenv_path)
+    try:
+        text = edit_dotenv_text(service, original)
+    except ImportError:
+        # DotenvDocument relies on the internals of python-dotenv, which a newer release could change
+        text = render_dotenv_text(service)
+    if text == original:
+        return None
+    if not check:
+        atomic_write_text(service.dotenv_path, text)
+    return "".join(
+        difflib.unified_diff(
+            original.splitlines(keepends=True),
+            text.splitlines(keepends=True),
+            f"{service.dotenv_path} (current)",
+            f"{service.dotenv_path} (updated)",
+        )
+    )
+
+
+def edit_dotenv_text(service: Service, original: str) -> str:
+    """Changes only the variables of the original text whose values differ from service.dotenv"""
+    from .dotenv_document import DotenvDocument
+
+    # A new file gets the layout and the comments of .env.example
+    document = DotenvDocument.parse(original if original.strip() else service.dotenv_example_original_source)
+    current_values = document.values()
+    for key in [key for key in document if key not in service.dotenv]:
+        document.remove(key)
+    example_keys = list(service.dotenv_example)
+    for key, value in service.dotenv.items():
+        if key in document and (current_values.get(key) or "") == (value or ""):
+            continue
+        elif key in document or key not in service.dotenv_example:
+            if key not in document and not any(DOTENV_EXTRA_SECTION_TITLE in token.text for token in document.tokens):
+                document.append_comment(
+                    DOTENV_SECTION_SEPARATOR + DOTENV_EXTRA_SECTION_TITLE + DOTENV_SECTION_SEPARATOR
+                )
+            document.set(key, value)
+        else:
+            # New variables from .env.example go next to their neighbours from .env.example
+            position = example_keys.index(key)
+            after = next((k for k in reversed(example_keys[:position]) if k in document), None)
+            before = next((k for k in example_keys[position + 1 :] if k in document), None)
+            document.set(key, value, after=after, before=before)
+    return str(document)
 
 
-def save_dotenv_file(service: Service) -> None:
-    """I save the dotenv file while preserving the comments and the order of entries"""
-    new_lines: List[str] = []
+def render_dotenv_text(service: Service) -> str:
+    """Builds the whole file from scratch in the layout of .env.example, losing the comments of the current file"""
+    lines: List[str] = []
     dotenv_items = service.dotenv.copy()
     for line in service.dotenv_example_original_source.splitlines():
         line = line.strip()
-        if not line:
-            new_lines.append("")
-        elif line.startswith("#"):
-            new_lines.append(line)
+        if not line or line.startswith("#"):
+            lines.append(line)
         elif "=" in line:
-            key, _ = line.split("=", 1)
-            key = key.strip()
+            key = line.split("=", 1)[0].strip()
             if key in dotenv_items:
-                new_lines.append(f"{key}={dotenv_items.pop(key) or ''}")
-
-    new_lines.append(DOTENV_SECTION_SEPARATOR + "# Env vars not present in .env.example" + DOTENV_SECTION_SEPARATOR)
-    for key, value in dotenv_items.items():
-        new_lines.append(f"{key}={value or ''}")
-
-    service.dotenv_path.write_text("\n".join(new_lines))
+                lines.append(f"{key}={dotenv_items.pop(key) or ''}")
+    if dotenv_items:
+        lines.append(DOTENV_SECTION_SEPARATOR + DOTENV_EXTRA_SECTION_TITLE + DOTENV_SECTION_SEPARATOR)
+        lines.extend(f"{key}={value or ''}" for key, value in dotenv_items.items())
+    return "\n".join(lines) + "\n"
+
+
+def report_dotenv_changes(diffs: Dict[Path, Optional[str]], check: bool = False) -> None:
+    """Prints what save_dotenv_file has done and, with check, fails if any file is not up to date"""
+    for path, diff in diffs.items():
+        if diff is not None:
+            typer.echo(diff if check else f"Updated {path}")
+    changed = sum(diff is not None for diff in diffs.values())
+    typer.echo(f"{'Would change' if check else 'Changed'} {changed} .env files, {len(diffs) - changed} unchanged")
+    if check and changed:
+        raise typer.Exit(1)
 
 
 def sh_with_log(cmd: str, prefix: str = "\n", suffix: str = "\n", capture: bool = False):
@@ -0,0 +1,117 @@
+import io
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+# These are not a part of the public api of python-dotenv, so stb.utils.common.save_dotenv_file falls back to rewriting
+# the whole file if they ever go away
+from dotenv.main import resolve_variables
+from dotenv.parser import parse_stream
+
+# Splits a variable into everything before its value (indentation, `export`, the key, and `=`), the value itself,
+# and everything after it (the inline comment and the newline), the same way as dotenv.parser does
+RE_VARIABLE = re.compile(
+    r"""(?P<prefix>[ \t]*(?:export[ \t]+)?(?:'[^']*'|[^=#\s]+)[ \t]*=[ \t]*)"""
+    r"""(?P<value>'(?:\\'|[^'])*'|"(?:\\"|[^"])*"|[^\r\n]*?)"""
+    r"""(?P<suffix>(?:[ \t]+#[^\r\n]*)?[ \t]*(?:\r\n|\n|\r)?)\Z"""
+)
+
+
+@dataclass
+class DotenvToken:
+    """A variable, a comment, a blank line, or a line that dotenv can't parse, exactly as it was written"""
+
+    text: str
+    key: Optional[str] = None
+    # The value before interpolation
+    value: Optional[str] = None
+
+
+class DotenvDocument:
+    """I am a dotenv file as the list of its tokens, so writing me back gives the same file byte for byte.
+
+    Changing a variable only replaces the line of that variable, so the comments, the order, the quoting, and the
+    ${VAR} references of everything else stay the way they were written.
+    """
+
+    def __init__(self, tokens: List[DotenvToken]) -> None:
+        self.tokens = tokens
+        # dotenv uses the last definition of a variable so that's the one we edit
+        self.positions: Dict[str, int] = {token.key: i for i, token in enumerate(tokens) if token.key is not None}
+
+    @classmethod
+    def parse(cls, text: str) -> "DotenvDocument":
+        tokens = []
+        for binding in parse_stream(io.StringIO(text)):
+            chunk = binding.original.string
+            # dotenv glues the blank lines before a variable to it but they must stay when the variable is removed
+            whitespace = chunk[: len(chunk) - len(chunk.lstrip())]
+            blank_lines_end = whitespace.rfind("\n") + 1
+            if blank_lines_end:
+                tokens.append(DotenvToken(chunk[:blank_lines_end]))
+            if chunk[blank_lines_end:]:
+                tokens.append(DotenvToken(chunk[blank_lines_end:], binding.key, binding.value))
+        return cls(tokens)
+
+    @classmethod
+    def load(cls, path: Path) -> "DotenvDocument":
+        return cls.parse(path.read_text() if path.is_file() else "")
+
+    def __str__(self) -> str:
+        return "".join(token.text for token in self.tokens)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.positions)
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the value as written, i.e. without interpolation"""
+        return self.tokens[self.positions[key]].value if key in self.positions else None
+
+    def values(self) -> Dict[str, Optional[str]]:
+        """Returns the variables the same way as dotenv.dotenv_values does, i.e. with ${VAR} references interpolated"""
+        return dict(resolve_variables(((t.key, t.value) for t in self.tokens if t.key is not None), override=True))
+
+    def set(self, key: str, value: Optional[str], after: Optional[str] = None, before: Optional[str] = None) -> None:
+        """Replaces the value of the variable, keeping its `export`, its inline comment, and its newline as they are.
+        A new variable is added right after `after`, right before `before`, or at the end.
+        The value is written as is, so it can contain quotes"""
+        text = f"{key}={value or ''}\n"
+        if key in self.positions:
+            token = self.tokens[self.positions[key]]
+            match = RE_VARIABLE.match(token.text)
+            if match is not None:
+                token.text = match["prefix"] + (value or "") + match["suffix"]
+            else:
+                # Keep the newline situation of the last line as is
+                token.text = text if token.text.endswith("\n") else text[:-1]
+            token.value = next(parse_stream(io.StringIO(token.text))).value
+            return
+        if after in self.positions:
+            position = self.positions[after] + 1
+        elif before in self.positions:
+            position = self.positions[before]
+        else:
+            position = len(self.tokens)
+        self._insert(position, DotenvToken(text, key, next(parse_stream(io.StringIO(text))).value))
+
+    def append_comment(self, text: str) -> None:
+        self._insert(len(self.tokens), DotenvToken(text if text.endswith("\n") else text + "\n"))
+
+    def remove(self, key: str) -> None:
+        if key in self.positions:
+            # Earlier definitions would take over otherwise
+            self.tokens = [token for token in self.tokens if token.key != key]
+            self._reindex()
+
+    def _insert(self, position: int, token: DotenvToken) -> None:
+        if position > 0 and not self.tokens[position - 1].text.endswith("\n"):
+            self.tokens[position - 1].text += "\n"
+        self.tokens.insert(position, token)
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self.positions = {token.key: i for i, token in enumerate(self.tokens) if token.key is not None}
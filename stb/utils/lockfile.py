@@ -0,0 +1,123 @@
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import tomli
+
+# Sources that pip can't install from by name and version alone
+UNSUPPORTED_SOURCE_TYPES = "git", "directory", "file", "url"
+# Keys of a dependency in poetry.lock that make it required only in some environments
+CONDITIONAL_DEPENDENCY_KEYS = {"markers", "python", "optional"}
+
+
+@dataclass(frozen=True)
+class LockedPackage:
+    name: str
+    version: str
+    hashes: List[str] = field(default_factory=list)
+    source_type: Optional[str] = None
+    source_url: Optional[str] = None
+    dependencies: Dict[str, Union[str, dict, list]] = field(default_factory=dict)
+
+    @property
+    def installable_by_pip(self) -> bool:
+        return self.source_type not in UNSUPPORTED_SOURCE_TYPES
+
+
+def canonicalize_name(name: str) -> str:
+    """The same normalization as PEP 503 so that `Typing_Extensions` in METADATA matches `typing-extensions` in the lock"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def read_lock_file(path: Path) -> Dict[str, List[LockedPackage]]:
+    """Returns the locked packages by canonical name. A name has several entries when poetry locked different
+    versions of the package for different environments"""
+    data = tomli.loads(path.read_text())
+    # Before poetry 1.2, the hashes were stored separately from the packages
+    metadata_files = data.get("metadata", {}).get("files", {})
+    packages: Dict[str, List[LockedPackage]] = {}
+    for package in data.get("package", []):
+        name = canonicalize_name(package["name"])
+        files = package.get("files") or metadata_files.get(package["name"]) or metadata_files.get(name) or []
+        source = package.get("source", {})
+        packages.setdefault(name, []).append(
+            LockedPackage(
+                name,
+                package["version"],
+                [file["hash"] for file in files if "hash" in file],
+                source.get("type"),
+                source.get("url"),
+                {canonicalize_name(dependency): spec for dependency, spec in package.get("dependencies", {}).items()},
+            )
+        )
+    return packages
+
+
+def get_installed_distributions(venv_dir: Path) -> Dict[str, str]:
+    """Returns the versions of the distributions installed into the venv by canonical name, reading only the headers of
+    their METADATA files which is much faster than asking pip or importlib.metadata in a separate interpreter"""
+    distributions = {}
+    for metadata_path in venv_dir.glob("lib/python*/site-packages/*.dist-info/METADATA"):
+        headers = {}
+        with metadata_path.open(encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip() or {"Name", "Version"} <= headers.keys():
+                    break
+                key, _, value = line.partition(":")
+                headers[key] = value.strip()
+        if "Name" in headers and "Version" in headers:
+            distributions[canonicalize_name(headers["Name"])] = headers["Version"]
+    return distributions
+
+
+class LockDiffError(Exception):
+    """The venv can't be brought in line with poetry.lock without resolving the dependencies the way poetry does"""
+
+
+def plan_lock_changes(
+    locked: Dict[str, List[LockedPackage]],
+    previously_locked: Dict[str, List[str]],
+    installed: Dict[str, str],
+    root_name: str,
+) -> Tuple[List[LockedPackage], List[str]]:
+    """Returns the packages to install and the names of the packages to remove so that a venv, which was in line with
+    the previous poetry.lock, gets in line with the current one. Raises LockDiffError whenever guessing is required"""
+    to_install: Dict[str, LockedPackage] = {}
+    for name, version in installed.items():
+        if name == root_name or name not in locked or any(p.version == version for p in locked[name]):
+            continue
+        to_install[name] = _get_single_locked_package(locked, name)
+    to_remove = sorted(name for name in previously_locked if name not in locked and name in installed)
+
+    queue = [name for name in installed if name in locked and name not in to_remove]
+    while queue:
+        name = queue.pop()
+        package = to_install[name] if name in to_install else _get_installed_package(locked, name, installed[name])
+        for dependency, spec in package.dependencies.items():
+            if dependency in installed or dependency in to_install:
+                continue
+            elif isinstance(spec, str) or isinstance(spec, dict) and not spec.keys() & CONDITIONAL_DEPENDENCY_KEYS:
+                to_install[dependency] = _get_single_locked_package(locked, dependency)
+                queue.append(dependency)
+            elif dependency not in previously_locked:
+                # Whether it's needed depends on markers, python versions, or extras that only poetry can evaluate
+                raise LockDiffError(f"{name} requires {dependency} under conditions that stb can't evaluate")
+            # Otherwise, the same conditions kept it out of the venv before so they keep it out now as well
+
+    for package in to_install.values():
+        if not package.installable_by_pip:
+            raise LockDiffError(f"{package.name} is installed from a {package.source_type} source")
+    return sorted(to_install.values(), key=lambda p: p.name), to_remove
+
+
+def _get_single_locked_package(locked: Dict[str, List[LockedPackage]], name: str) -> LockedPackage:
+    if name not in locked:
+        raise LockDiffError(f"{name} is missing from poetry.lock")
+    elif len(locked[name]) > 1:
+        raise LockDiffError(f"{name} is locked at several versions for different environments")
+    return locked[name][0]
+
+
+def _get_installed_package(locked: Dict[str, List[LockedPackage]], name: str, version: str) -> LockedPackage:
+    return next((p for p in locked[name] if p.version == version), locked[name][0])
@@ -0,0 +1,161 @@
+import enum
+import os
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from pathlib import Path
+from typing import Callable, Dict, Generic, Iterable, List, Optional, TextIO, TypeVar
+
+import typer
+
+T = TypeVar("T")
+K = TypeVar("K")
+
+_ECHO_LOCK = threading.Lock()
+
+
+class PrefixedLog:
+    """I run shell commands for a single service and prefix every line of their output with the service name.
+
+    Useful when several services are processed at the same time and their outputs would otherwise be interleaved.
+    If log_path is set, the unprefixed output is also written there.
+    """
+
+    def __init__(self, prefix: str, log_path: Optional[Path] = None) -> None:
+        self.prefix = prefix
+        self.log_path = log_path
+        self._log_file: Optional[TextIO] = None
+        if log_path is not None:
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            self._log_file = log_path.open("w")
+
+    def echo(self, message: str, err: bool = False) -> None:
+        if self._log_file is not None:
+            self._log_file.write(message + "\n")
+            self._log_file.flush()
+        with _ECHO_LOCK:
+            for line in message.splitlines() or [""]:
+                typer.echo(f"[{self.prefix}] {line}", err=err)
+
+    def sh(self, cmd: str, cwd: "Path | str" = ".", env: Optional[Dict[str, str]] = None) -> bool:
+        self.echo(f">>> {cmd}")
+        process = subprocess.Popen(
+            cmd,
+            shell=True,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env={**os.environ, **(env or {})},
+        )
+        assert process.stdout is not None
+        for line in process.stdout:
+            self.echo(line.rstrip("\n"))
+        return process.wait() == 0
+
+    def close(self) -> None:
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def __enter__(self) -> "PrefixedLog":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def run_concurrently(function: Callable[[T], object], items: Iterable[T], max_workers: int) -> Dict[T, BaseException]:
+    """Runs the function for every item in a bounded thread pool and returns the exceptions raised for each failed item
+
+    An exception in one item never stops the processing of the other items.
+    """
+    failures: Dict[T, BaseException] = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            exception = future.exception()
+            if exception is not None:
+                failures[futures[future]] = exception
+    return failures
+
+
+class TaskGraph(Generic[K]):
+    """I run tasks as soon as their dependencies are finished, each task in the bounded thread pool it belongs to.
+
+    A task whose dependency has failed or was skipped is skipped as well, unless it was added with
+    requires_success=False. Such tasks only wait for their dependencies to finish, whatever the outcome.
+    """
+
+    def __init__(self, pool_sizes: Dict[str, int]) -> None:
+        self.pool_sizes = pool_sizes
+        self.tasks: Dict[K, Callable[[], object]] = {}
+        self.pools: Dict[K, str] = {}
+        self.dependencies: Dict[K, List[K]] = {}
+        self.requires_success: Dict[K, bool] = {}
+        self.statuses: Dict[K, TaskStatus] = {}
+
+    def add(
+        self,
+        key: K,
+        function: Callable[[], object],
+        pool: str,
+        dependencies: Iterable[K] = (),
+        requires_success: bool = True,
+    ) -> None:
+        self.tasks[key] = function
+        self.pools[key] = pool
+        self.dependencies[key] = list(dependencies)
+        self.requires_success[key] = requires_success
+        self.statuses[key] = TaskStatus.pending
+
+    def run(self, on_change: Callable[[K, "TaskStatus"], None] = lambda key, status: None) -> Dict[K, BaseException]:
+        """Runs all tasks and returns the exceptions of the ones that have failed"""
+        failures: Dict[K, BaseException] = {}
+        executors = {pool: ThreadPoolExecutor(max(1, size)) for pool, size in self.pool_sizes.items()}
+
+        def set_status(key: K, status: TaskStatus) -> None:
+            self.statuses[key] = status
+            on_change(key, status)
+
+        try:
+            running: Dict[Future, K] = {}
+            while True:
+                # Skipping a task can make its dependents ready so we keep going until nothing changes
+                changed = True
+                while changed:
+                    changed = False
+                    for key in [key for key, status in self.statuses.items() if status == TaskStatus.pending]:
+                        dependency_statuses = [self.statuses[dependency] for dependency in self.dependencies[key]]
+                        if any(s in {TaskStatus.pending, TaskStatus.running} for s in dependency_statuses):
+                            continue
+                        changed = True
+                        if self.requires_success[key] and any(s != TaskStatus.done for s in dependency_statuses):
+                            set_status(key, TaskStatus.skipped)
+                        else:
+                            set_status(key, TaskStatus.running)
+                            running[executors[self.pools[key]].submit(self.tasks[key])] = key
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        set_status(key, TaskStatus.done)
+                    else:
+                        failures[key] = exception
+                        set_status(key, TaskStatus.failed)
+        finally:
+            for executor in executors.values():
+                executor.shutdown()
+        return failures
+
+
+class TaskStatus(str, enum.Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+    skipped = "skipped"
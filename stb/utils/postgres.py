@@ -0,0 +1,207 @@
+import contextlib
+import functools
+import importlib
+import os
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union, cast
+
+MAINTENANCE_DB = "postgres"
+SUPPORTED_DRIVERS = "psycopg", "psycopg2"
+MAX_IDENTIFIER_LENGTH = 63
+DUMP_COMPRESSION_LEVEL = 6
+PSQL_FIELD_SEPARATOR = "\x1f"
+
+
+class PostgresError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_postgres_driver() -> Any:
+    """Returns the first installed postgres driver or None. Drivers are optional: stb falls back to the cli tools"""
+    for driver_name in SUPPORTED_DRIVERS:
+        with contextlib.suppress(ImportError):
+            return importlib.import_module(driver_name)
+
+
+@dataclass(frozen=True)
+class PostgresServer:
+    host: str
+    port: int
+    user: str
+    password: str
+
+    @classmethod
+    def from_dotenv(cls, dotenv: Mapping[str, Union[str, None]]) -> "PostgresServer":
+        # stb only manages local databases so POSTGRES_HOST is ignored, just like it has always been for the cli tools
+        return cls(
+            "localhost",
+            int(dotenv.get("POSTGRES_PORT") or 5432),
+            dotenv.get("POSTGRES_USER") or "",
+            dotenv.get("POSTGRES_PASSWORD") or "",
+        )
+
+    @property
+    def env(self) -> Dict[str, str]:
+        return {**os.environ, "PGPASSWORD": self.password}
+
+    def cli_args(self) -> List[str]:
+        return ["-h", self.host, "-p", str(self.port), "-U", self.user]
+
+    def connect(self, dbname: str = MAINTENANCE_DB) -> Any:
+        connection = get_postgres_driver().connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            dbname=dbname,
+            # Otherwise, databases initialized without a locale make the driver return raw bytes instead of strings
+            client_encoding="utf8",
+        )
+        # CREATE DATABASE and DROP DATABASE can't run inside a transaction
+        connection.autocommit = True
+        return connection
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def query(server: PostgresServer, sql: str) -> List[Tuple[Optional[str], ...]]:
+    """Runs a single statement against the maintenance database and returns its rows with every value as text"""
+    driver = get_postgres_driver()
+    if driver is None:
+        process = subprocess.run(
+            ["psql", *server.cli_args(), "-d", MAINTENANCE_DB, "-X", "-q", "-t", "-A", "-F", PSQL_FIELD_SEPARATOR],
+            input=sql,
+            env=server.env,
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode:
+            raise PostgresError(process.stderr.strip() or f"psql failed with exit code {process.returncode}")
+        return [
+            tuple(value or None for value in line.split(PSQL_FIELD_SEPARATOR)) for line in process.stdout.splitlines()
+        ]
+    try:
+        with contextlib.closing(server.connect()) as connection, connection.cursor() as cursor:
+            cursor.execute(sql)
+            rows = cursor.fetchall() if cursor.description is not None else []
+    except driver.Error as e:
+        raise PostgresError(str(e).strip()) from e
+    return [tuple(None if value is None else str(value) for value in row) for row in rows]
+
+
+def get_database_comments(server: PostgresServer, names: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Returns the comments of the databases that exist. Missing databases are left out of the result"""
+    names = sorted(names)
+    if not names:
+        return {}
+    rows = query(
+        server,
+        "SELECT datname, shobj_description(oid, 'pg_database') FROM pg_database "
+        f"WHERE datname IN ({', '.join(quote_literal(name) for name in names)})",
+    )
+    return {cast(str, row[0]): row[1] for row in rows}
+
+
+def get_database_oids(server: PostgresServer, names: Iterable[str]) -> Dict[str, str]:
+    """Returns the oids of the databases that exist. A database gets a new oid every time it is recreated"""
+    names = sorted(names)
+    if not names:
+        return {}
+    rows = query(
+        server,
+        f"SELECT datname, oid FROM pg_database WHERE datname IN ({', '.join(quote_literal(name) for name in names)})",
+    )
+    return {cast(str, row[0]): cast(str, row[1]) for row in rows}
+
+
+def set_database_comment(server: PostgresServer, name: str, comment: str) -> None:
+    query(server, f"COMMENT ON DATABASE {quote_identifier(name)} IS {quote_literal(comment)}")
+
+
+def create_databases(server: PostgresServer, names: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Creates the databases over a single connection and returns an error message (or None) for every database"""
+    return _run_for_each_database(
+        server,
+        names,
+        lambda name: f"CREATE DATABASE {quote_identifier(name)}",
+        lambda name: ["createdb", *server.cli_args(), name],
+    )
+
+
+def drop_databases(server: PostgresServer, names: Iterable[str], force: bool = False) -> Dict[str, Optional[str]]:
+    """Drops the databases over a single connection and returns an error message (or None) for every database"""
+    return _run_for_each_database(
+        server,
+        names,
+        lambda name: f"DROP DATABASE {quote_identifier(name)}{' WITH (FORCE)' if force else ''}",
+        lambda name: ["dropdb", *(["-f"] if force else []), *server.cli_args(), name],
+    )
+
+
+def copy_databases(server: PostgresServer, sources: Mapping[str, str]) -> Dict[str, Optional[str]]:
+    """Creates every database in sources as a file-level copy of its source database which is much faster than
+    recreating its contents. Postgres requires the source databases to have no active connections during the copy"""
+    return _run_for_each_database(
+        server,
+        sources,
+        lambda name: f"CREATE DATABASE {quote_identifier(name)} TEMPLATE {quote_identifier(sources[name])}",
+        lambda name: ["createdb", "-T", sources[name], *server.cli_args(), name],
+    )
+
+
+def dump_database(server: PostgresServer, name: str, directory: Path, jobs: int = 1) -> Optional[str]:
+    """Dumps the database in the directory format which is compressed and allows dumping several tables at once"""
+    return _run_cli(
+        server,
+        ["pg_dump", *server.cli_args(), "--format=directory", f"--compress={DUMP_COMPRESSION_LEVEL}"]
+        + [f"--jobs={jobs}", f"--file={directory}", name],
+    )
+
+
+def restore_database(server: PostgresServer, name: str, directory: Path, jobs: int = 1) -> Optional[str]:
+    """Restores a dump made by dump_database into an existing empty database"""
+    return _run_cli(
+        server, ["pg_restore", *server.cli_args(), "--no-owner", f"--jobs={jobs}", f"--dbname={name}", str(directory)]
+    )
+
+
+def _run_cli(server: PostgresServer, command: List[str]) -> Optional[str]:
+    process = subprocess.run(command, env=server.env, capture_output=True, text=True)
+    return (process.stderr.strip() or "Failed") if process.returncode else None
+
+
+def _run_for_each_database(
+    server: PostgresServer,
+    names: Iterable[str],
+    make_statement: Callable[[str], str],
+    make_cli_command: Callable[[str], List[str]],
+) -> Dict[str, Optional[str]]:
+    names = sorted(names)
+    results: Dict[str, Optional[str]] = {}
+    driver = get_postgres_driver()
+    if not names:
+        return results
+    elif driver is None:
+        return {name: _run_cli(server, make_cli_command(name)) for name in names}
+
+    try:
+        connection = server.connect()
+    except driver.Error as e:
+        return {name: str(e).strip() for name in names}
+    with contextlib.closing(connection), connection.cursor() as cursor:
+        for name in names:
+            try:
+                cursor.execute(make_statement(name))
+                results[name] = None
+            except driver.Error as e:
+                results[name] = str(e).strip()
+    return results
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import shlex
+import subprocess
+import tempfile
+import time
+from contextlib import suppress
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import tomli
+
+from .common import atomic_write_text
+from .lockfile import LockDiffError, canonicalize_name, get_installed_distributions, plan_lock_changes, read_lock_file
+from .parallel import PrefixedLog
+
+VENV_CACHE_FORMAT_VERSION = 1
+INSTALL_CACHE_FORMAT_VERSION = 1
+# The sections of [tool.poetry] that decide which of the locked packages get installed
+INSTALL_FINGERPRINT_SECTIONS = "dependencies", "dev-dependencies", "group", "extras"
+
+
+@dataclass(frozen=True)
+class PoetryEnv:
+    """I build commands that run programs from the virtualenv of a poetry project directly.
+
+    `poetry run` spends about a second on its own startup before the program even begins, which adds up quickly
+    when we run a command for every aerich app of every service.
+    """
+
+    project_dir: Path
+    venv_dir: Optional[Path]
+    # How long a single poetry startup took when the venv was resolved, i.e. how much every direct run saves
+    poetry_overhead: float = 0.0
+
+    def get_executable(self, program: str) -> Optional[Path]:
+        if self.venv_dir is None:
+            return None
+        executable = self.venv_dir / "bin" / program
+        return executable if executable.is_file() else None
+
+    def command(self, program: str, args: str = "") -> str:
+        executable = self.get_executable(program)
+        if executable is None:
+            return f"poetry run {program} {args}".strip()
+        return f"{shlex.quote(str(executable))} {args}".strip()
+
+
+def get_poetry_env(project_dir: Path) -> PoetryEnv:
+    """Returns the env of the project, resolving its venv with `poetry env info -p` only when pyproject.toml or
+    poetry.lock have changed since the last time"""
+    project_dir = project_dir.absolute()
+    cache_path = get_venv_cache_path(project_dir)
+    mtimes = get_project_mtimes(project_dir)
+    if cache_path.is_file():
+        with suppress(ValueError, KeyError):
+            data = json.loads(cache_path.read_text())
+            if data["version"] == VENV_CACHE_FORMAT_VERSION and data["mtimes"] == mtimes:
+                env = PoetryEnv(project_dir, Path(data["venv_dir"]), data["poetry_overhead"])
+                if env.get_executable("python") is not None:
+                    return env
+
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(["poetry", "env", "info", "-p"], cwd=project_dir, capture_output=True, text=True)
+    except OSError:
+        return PoetryEnv(project_dir, None)
+    poetry_overhead = time.perf_counter() - start
+    if process.returncode or not process.stdout.strip():
+        return PoetryEnv(project_dir, None)
+    env = PoetryEnv(project_dir, Path(process.stdout.strip()), poetry_overhead)
+    data = {
+        "version": VENV_CACHE_FORMAT_VERSION,
+        "venv_dir": str(env.venv_dir),
+        "mtimes": mtimes,
+        "poetry_overhead": poetry_overhead,
+    }
+    atomic_write_text(cache_path, json.dumps(data))
+    return env
+
+
+def get_project_mtimes(project_dir: Path) -> Dict[str, Optional[int]]:
+    mtimes = {}
+    for name in ("pyproject.toml", "poetry.lock"):
+        path = project_dir / name
+        mtimes[name] = path.stat().st_mtime_ns if path.is_file() else None
+    return mtimes
+
+
+def get_venv_cache_path(project_dir: Path) -> Path:
+    # stb.config imports tomlkit which slows down the startup of the commands that import this module
+    from ..config import get_cache_dir
+
+    return get_cache_dir() / "venvs" / f"{hashlib.sha256(str(project_dir).encode()).hexdigest()[:16]}.json"
+
+
+def install_dependencies(
+    project_dir: Path, log: PrefixedLog, args: str = "--all-extras", partial: bool = False
+) -> None:
+    """I run `poetry install` unless nothing that affects its result has changed since its last successful run.
+
+    With `partial`, when only poetry.lock has changed, I install and remove just the packages whose locked versions
+    differ from the ones in the venv, and run `poetry install` only if that can't be done reliably.
+    """
+    project_dir = project_dir.absolute()
+    cache_path = get_install_cache_path(project_dir)
+    poetry_env = get_poetry_env(project_dir)
+    inputs = get_install_inputs(poetry_env, args)
+    cache = read_install_cache(cache_path)
+    if inputs is not None and cache is not None and cache["inputs"] == inputs:
+        log.echo(
+            "Skipped 'poetry install' because neither poetry.lock, nor the dependencies in pyproject.toml, "
+            "nor the python version have changed since the last install"
+        )
+        return
+    if partial and inputs is not None and cache is not None and {**cache["inputs"], "lock": inputs["lock"]} == inputs:
+        if install_lock_changes(poetry_env, cache["packages"], log):
+            save_install_cache(cache_path, poetry_env, inputs)
+            return
+        log.echo("Falling back to 'poetry install'")
+    command = f"poetry install {args}".strip()
+    if not log.sh(command, project_dir):
+        raise RuntimeError(f"'{command}' has failed")
+    poetry_env = get_poetry_env(project_dir)
+    inputs = get_install_inputs(poetry_env, args)
+    if inputs is not None:
+        save_install_cache(cache_path, poetry_env, inputs)
+
+
+def install_lock_changes(poetry_env: PoetryEnv, previously_locked: Dict[str, List[str]], log: PrefixedLog) -> bool:
+    """Brings the venv in line with poetry.lock using a single pip call per kind of change. Returns False if the
+    changes can't be reconciled without poetry"""
+    python = poetry_env.get_executable("python")
+    assert python is not None and poetry_env.venv_dir is not None
+    poetry_config = (
+        tomli.loads((poetry_env.project_dir / "pyproject.toml").read_text()).get("tool", {}).get("poetry", {})
+    )
+    try:
+        to_install, to_remove = plan_lock_changes(
+            read_lock_file(poetry_env.project_dir / "poetry.lock"),
+            previously_locked,
+            get_installed_distributions(poetry_env.venv_dir),
+            canonicalize_name(poetry_config.get("name", "")),
+        )
+    except LockDiffError as e:
+        log.echo(f"Can't install only the changes of poetry.lock: {e}")
+        return False
+    pip = f"{shlex.quote(str(python))} -m pip --disable-pip-version-check"
+    if to_install:
+        log.echo(f"Installing {', '.join(f'{p.name}=={p.version}' for p in to_install)}")
+        # Hashes are all or nothing for pip so we only check them when the lock has them for every package
+        use_hashes = all(p.hashes for p in to_install)
+        requirements = "".join(
+            f"{p.name}=={p.version}{''.join(f' --hash={h}' for h in p.hashes) if use_hashes else ''}\n"
+            for p in to_install
+        )
+        index_urls = sorted({p.source_url for p in to_install if p.source_type == "legacy" and p.source_url})
+        with tempfile.NamedTemporaryFile("w", prefix="stb-requirements-", suffix=".txt") as f:
+            f.write(requirements)
+            f.flush()
+            command = f"{pip} install --no-deps {''.join(f'--extra-index-url {shlex.quote(u)} ' for u in index_urls)}"
+            if not log.sh(f"{command}-r {shlex.quote(f.name)}", poetry_env.project_dir):
+                return False
+    if to_remove:
+        log.echo(f"Removing {', '.join(to_remove)}")
+        if not log.sh(f"{pip} uninstall --yes {' '.join(to_remove)}", poetry_env.project_dir):
+            return False
+    if not to_install and not to_remove:
+        log.echo("The venv already matches poetry.lock")
+    return True
+
+
+def get_install_inputs(poetry_env: PoetryEnv, args: str) -> Optional[Dict[str, str]]:
+    """Hashes everything that decides what `poetry install` puts into the venv. Returns None if there's no venv"""
+    python_version = get_venv_python_version(poetry_env)
+    lock_path, pyproject_path = poetry_env.project_dir / "poetry.lock", poetry_env.project_dir / "pyproject.toml"
+    if python_version is None or not lock_path.is_file() or not pyproject_path.is_file():
+        return None
+    poetry_config = tomli.loads(pyproject_path.read_text()).get("tool", {}).get("poetry", {})
+    dependencies = {section: poetry_config.get(section) for section in INSTALL_FINGERPRINT_SECTIONS}
+    return {
+        "lock": hashlib.sha256(lock_path.read_bytes()).hexdigest(),
+        "pyproject": hashlib.sha256(json.dumps(dependencies, sort_keys=True, default=str).encode()).hexdigest(),
+        "args": args,
+        "python": python_version,
+    }
+
+
+def read_install_cache(cache_path: Path) -> Optional[Dict[str, Any]]:
+    with suppress(OSError, ValueError, KeyError):
+        data = json.loads(cache_path.read_text())
+        if data["version"] == INSTALL_CACHE_FORMAT_VERSION:
+            return data
+    return None
+
+
+def save_install_cache(cache_path: Path, poetry_env: PoetryEnv, inputs: Dict[str, str]) -> None:
+    # The locked versions let the next partial install find out which packages poetry.lock has dropped since then
+    locked = read_lock_file(poetry_env.project_dir / "poetry.lock")
+    packages = {name: [p.version for p in locked_packages] for name, locked_packages in locked.items()}
+    data = {"version": INSTALL_CACHE_FORMAT_VERSION, "inputs": inputs, "packages": packages}
+    atomic_write_text(cache_path, json.dumps(data))
+
+
+def get_venv_python_version(poetry_env: PoetryEnv) -> Optional[str]:
+    if poetry_env.venv_dir is None or poetry_env.get_executable("python") is None:
+        return None
+    config_path = poetry_env.venv_dir / "pyvenv.cfg"
+    if config_path.is_file():
+        for line in config_path.read_text().splitlines():
+            key, _, value = line.partition("=")
+            if key.strip() in {"version", "version_info"}:
+                return value.strip()
+    # Without pyvenv.cfg, the interpreter itself is the best thing we can compare
+    return str(poetry_env.get_executable("python").resolve())
+
+
+def get_install_cache_path(project_dir: Path) -> Path:
+    from ..config import get_cache_dir
+
+    return get_cache_dir() / "installs" / f"{hashlib.sha256(str(project_dir).encode()).hexdigest()[:16]}.json"
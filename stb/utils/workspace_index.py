@@ -0,0 +1,208 @@
+import copy
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import dotenv
+
+from .common import (
+    LOAD_WORKERS,
+    PARALLEL_LOAD_THRESHOLD,
+    PRUNED_DIRS,
+    Service,
+    add_service,
+    atomic_write_text,
+    is_ignored,
+    read_ignore_patterns,
+    safely_read_text,
+    unpack_root_path,
+)
+
+INDEX_FORMAT_VERSION = 1
+DOTENV_FILE, DOTENV_EXAMPLE_FILE, HELM_VALUES_FILE = "settings/.env", "settings/.env.example", ".helm/values.yaml"
+# The files that have to be parsed to load each field of a service
+FIELD_FILES = {
+    "dotenv": DOTENV_FILE,
+    "dotenv_example": DOTENV_EXAMPLE_FILE,
+    "dotenv_example_original_source": DOTENV_EXAMPLE_FILE,
+    "yaml_config": HELM_VALUES_FILE,
+}
+FileStat = Optional[Tuple[int, int]]
+
+
+def load_dotenv_example(path: Path) -> Dict[str, Any]:
+    source = safely_read_text(path)
+    return {"source": source, "values": dotenv.dotenv_values(stream=io.StringIO(source))}
+
+
+def load_helm_values(path: Path) -> Any:
+    import yaml
+
+    return yaml.safe_load(safely_read_text(path))
+
+
+FILE_LOADERS: Dict[str, Callable[[Path], Any]] = {
+    DOTENV_FILE: dotenv.dotenv_values,
+    DOTENV_EXAMPLE_FILE: load_dotenv_example,
+    HELM_VALUES_FILE: load_helm_values,
+}
+
+
+class WorkspaceIndex:
+    """I am an on-disk index of the services in a root directory and of the parsed contents of their files.
+
+    Every cached file is validated by its mtime and size, so a warm run parses only the files that have changed since
+    the last one. The subdirectories of the root are listed again only when the mtime of the root changes.
+
+    Tools that import stb can use me directly:
+
+        index = WorkspaceIndex.open(Path("~/my_company").expanduser())
+        services = index.get_services(load=["dotenv"])
+        index.save()
+    """
+
+    def __init__(self, root: Path, path: Path) -> None:
+        self.root = root
+        self.path = path
+        self.root_mtime: Optional[int] = None
+        self.subdirectories: List[str] = []
+        # Relative path of a file -> its stat when it was parsed and the parsed contents
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, root: Path, path: Optional[Path] = None) -> "WorkspaceIndex":
+        root = root.resolve()
+        index = cls(root, path or get_workspace_index_path(root))
+        with suppress(OSError, ValueError, KeyError, TypeError):
+            data = json.loads(index.path.read_text())
+            if data["version"] == INDEX_FORMAT_VERSION and data["root"] == str(root):
+                index.root_mtime, index.subdirectories = data["root_mtime"], data["subdirectories"]
+                index.files = {
+                    key: {**entry, "stat": tuple(entry["stat"]) if entry["stat"] else None}
+                    for key, entry in data["files"].items()
+                }
+        return index
+
+    def find_service_dirs(self, max_depth: Optional[int] = 1) -> List[Path]:
+        if max_depth != 1:
+            # Only the listing of the root is cached because a deep tree would have to be stat-ed all over anyway
+            return unpack_root_path(self.root, max_depth)
+        root_mtime = self.root.stat().st_mtime_ns
+        if root_mtime != self.root_mtime:
+            # Same order as Path.iterdir because ports are assigned in the order of the services
+            with os.scandir(self.root) as entries:
+                self.subdirectories = [
+                    entry.name for entry in entries if entry.is_dir() and entry.name not in PRUNED_DIRS
+                ]
+            self.root_mtime = root_mtime
+            self.changed = True
+        ignore_patterns = read_ignore_patterns(self.root)
+        return [
+            self.root / name
+            for name in self.subdirectories
+            if (self.root / name / DOTENV_EXAMPLE_FILE).is_file()
+            and not is_ignored(str(self.root / name), ignore_patterns)
+        ]
+
+    def get_services(
+        self, load: Iterable[str] = (), workers: int = LOAD_WORKERS, max_depth: Optional[int] = 1
+    ) -> Dict[str, Service]:
+        """Returns the services with every field whose files are unchanged already loaded from the index.
+
+        The files of the fields in `load` are parsed if they have changed, for many services at the same time.
+        The fields that are neither requested nor cached are left for the service to load on first access.
+        """
+        service_dirs = self.find_service_dirs(max_depth)
+        files_to_load = {FIELD_FILES[field] for field in load}
+        stats = {(dir, file): get_file_stat(dir / file) for dir in service_dirs for file in FILE_LOADERS}
+        contents: Dict[str, Any] = {}
+        stale = []
+        for (dir, file), stat in stats.items():
+            key = self._get_key(dir, file)
+            entry = self.files.get(key)
+            if entry is not None and entry["stat"] == stat:
+                contents[key] = entry["data"]
+                self.hits += 1
+            elif file in files_to_load:
+                stale.append((dir, file))
+
+        if len(stale) >= PARALLEL_LOAD_THRESHOLD:
+            with ThreadPoolExecutor(workers) as executor:
+                loaded = dict(zip(stale, executor.map(lambda item: FILE_LOADERS[item[1]](item[0] / item[1]), stale)))
+        else:
+            loaded = {(dir, file): FILE_LOADERS[file](dir / file) for dir, file in stale}
+        for (dir, file), data in loaded.items():
+            key = self._get_key(dir, file)
+            contents[key] = data
+            self.misses += 1
+            if is_json_serializable(data):
+                self.files[key] = {"stat": stats[dir, file], "data": data}
+        if loaded or self.files.keys() - contents.keys():
+            self.changed = True
+        # Files of the services that are gone or the ones that have changed but weren't reloaded are useless now
+        self.files = {key: entry for key, entry in self.files.items() if key in contents}
+        services: Dict[str, Service] = {}
+        for dir in service_dirs:
+            add_service(services, self._make_service(dir, contents))
+        return services
+
+    def _get_key(self, dir: Path, file: str) -> str:
+        return f"{dir.relative_to(self.root).as_posix()}/{file}"
+
+    def _make_service(self, dir: Path, contents: Dict[str, Any]) -> Service:
+        fields: Dict[str, Any] = {}
+        if self._get_key(dir, DOTENV_FILE) in contents:
+            # Commands edit these dicts in place so they must never share them with the index
+            fields["dotenv"] = dict(contents[self._get_key(dir, DOTENV_FILE)])
+        if self._get_key(dir, DOTENV_EXAMPLE_FILE) in contents:
+            example = contents[self._get_key(dir, DOTENV_EXAMPLE_FILE)]
+            fields["dotenv_example"] = dict(example["values"])
+            fields["dotenv_example_original_source"] = example["source"]
+        if self._get_key(dir, HELM_VALUES_FILE) in contents:
+            fields["yaml_config"] = copy.deepcopy(contents[self._get_key(dir, HELM_VALUES_FILE)])
+        return Service(dir, **fields)
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        data = {
+            "version": INDEX_FORMAT_VERSION,
+            "root": str(self.root),
+            "root_mtime": self.root_mtime,
+            "subdirectories": self.subdirectories,
+            "files": self.files,
+        }
+        # The index holds the values of every .env, passwords and tokens included, so only the user may read it
+        atomic_write_text(self.path, json.dumps(data), mode=0o600)
+        self.changed = False
+
+
+def get_file_stat(path: Path) -> FileStat:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_json_serializable(data: Any) -> bool:
+    """Helm values can contain dates and other values that JSON would silently turn into something else"""
+    try:
+        return json.loads(json.dumps(data)) == data
+    except (TypeError, ValueError):
+        return False
+
+
+def get_workspace_index_path(root: Path) -> Path:
+    # stb.config is imported here to keep it out of the import time of the modules that import this one
+    from ..config import get_cache_dir
+
+    return get_cache_dir() / "workspaces" / f"{hashlib.sha256(str(root).encode()).hexdigest()[:16]}.json"
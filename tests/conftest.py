@@ -1,4 +1,5 @@
 import contextlib
+import os
 import shutil
 from pathlib import Path
 
@@ -21,6 +22,13 @@ def temporary_directory():
     shutil.rmtree(tmp_dir)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Keeps the caches of stb, like the workspace indexes, out of the cache directory of the user"""
+    monkeypatch.setattr("stb.config.get_cache_dir", lambda: tmp_path / "cache")
+    return tmp_path / "cache"
+
+
 @pytest.fixture
 def dummy_microservice(request: pytest.FixtureRequest, temporary_directory: Path):
     microservice_dir: Path = temporary_directory / (request.function.__name__ + "_microservice")
@@ -35,3 +43,19 @@ def keyring_app():
     yield keyring.get_keyring()
     with contextlib.suppress(keyring.errors.PasswordDeleteError):
         keyring.delete_password(TESTING_KEYRING_SERVICE_NAME, TESTING_KEYRING_USERNAME)
+
+
+@pytest.fixture(scope="session")
+def postgres_server():
+    """Points at a disposable postgres server. Set STB_TEST_POSTGRES_PORT (and optionally _USER/_PASSWORD) to enable"""
+    from stb.utils.postgres import PostgresServer
+
+    port = os.environ.get("STB_TEST_POSTGRES_PORT")
+    if not port:
+        pytest.skip("STB_TEST_POSTGRES_PORT is not set")
+    return PostgresServer(
+        "localhost",
+        int(port),
+        os.environ.get("STB_TEST_POSTGRES_USER", "postgres"),
+        os.environ.get("STB_TEST_POSTGRES_PASSWORD", "postgres"),
+    )
@@ -0,0 +1,137 @@
+import datetime
+from pathlib import Path
+
+import pytest
+
+from stb import catalog
+from stb.config import CONFIG
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, json_data=None, headers=None):
+        self.status_code = status_code
+        self._json_data = json_data
+        self.headers = headers or {}
+        self.links = {}
+
+    def json(self):
+        return self._json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+class _FakeGitlabSession:
+    def __init__(self, groups, projects, per_page=4):
+        self.groups = groups
+        self.projects = projects
+        self.per_page = per_page
+        self.requested_urls = []
+
+    def get(self, url: str, params=None):
+        params = params or {}
+        self.requested_urls.append(url)
+        path = url.split("/api/v4/", 1)[1]
+        if path.endswith("projects"):
+            projects = self.projects
+            if path.startswith("groups/"):
+                group = path[len("groups/") : -len("/projects")].replace("%2F", "/")
+                projects = [p for p in projects if p["path_with_namespace"].startswith(group + "/")]
+            if "last_activity_after" in params:
+                projects = [p for p in projects if p["last_activity_at"] > params["last_activity_after"]]
+            page = int(params.get("page", 1))
+            records = projects[(page - 1) * self.per_page : page * self.per_page]
+            total_pages = max(1, -(-len(projects) // self.per_page))
+            return _FakeResponse(200, records, {"X-Total-Pages": str(total_pages)})
+        group = path.split("/", 1)[1].replace("%2F", "/")
+        return _FakeResponse(200 if group in self.groups else 404, {})
+
+    def close(self):
+        pass
+
+
+def _project(id: int, path_with_namespace: str, last_activity_at: str = "2020-01-01T00:00:00+00:00"):
+    return {
+        "id": id,
+        "path": path_with_namespace.split("/")[-1],
+        "path_with_namespace": path_with_namespace,
+        "name": path_with_namespace.split("/")[-1],
+        "name_with_namespace": path_with_namespace.replace("/", " / "),
+        "ssh_url_to_repo": f"git@gitlab.test:{path_with_namespace}.git",
+        "default_branch": "master",
+        "last_activity_at": last_activity_at,
+    }
+
+
+@pytest.fixture
+def gitlab_session(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    projects = [_project(i, f"company/{'backend' if i % 2 else 'frontend'}/service{i}") for i in range(25)]
+    session = _FakeGitlabSession({"company", "company/backend", "company/frontend"}, projects)
+    monkeypatch.setitem(CONFIG.doc, "git_url", "git@gitlab.test")
+    monkeypatch.setattr(catalog, "get_cache_dir", lambda: tmp_path)
+    monkeypatch.setattr(catalog, "get_gitlab_api_url", lambda: "https://gitlab.test/api/v4")
+    monkeypatch.setattr(catalog, "gitlab_session", lambda: session)
+    return session
+
+
+def test_find_projects__prefix_of_a_group__only_the_enclosing_group_is_listed(gitlab_session: _FakeGitlabSession):
+    found = catalog.find_projects(["company/back"])["company/back"]
+
+    assert [p.path for p in found] == sorted(f"service{i}" for i in range(1, 25, 2))
+    assert all("/groups/company/projects" in url for url in gitlab_session.requested_urls[2:])
+
+
+def test_find_projects__warm_catalog__no_requests_are_made(gitlab_session: _FakeGitlabSession):
+    catalog.find_projects(["company/backend"])
+    gitlab_session.requested_urls.clear()
+
+    found = catalog.find_projects(["company/backend/service1", "company/backend/"])
+
+    assert gitlab_session.requested_urls == []
+    assert [p.id for p in found["company/backend/service1"]] == [1, 11, 13, 15, 17, 19]
+    assert len(found["company/backend/"]) == 12
+
+
+def test_find_projects__stale_catalog__only_changed_projects_are_requested(
+    gitlab_session: _FakeGitlabSession, monkeypatch: pytest.MonkeyPatch
+):
+    catalog.find_projects(["company/backend"])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    gitlab_session.projects.append(_project(100, "company/backend/new_service", now.isoformat()))
+    gitlab_session.requested_urls.clear()
+    monkeypatch.setattr(catalog, "CATALOG_TTL", datetime.timedelta(seconds=-1))
+
+    found = catalog.find_projects(["company/backend/new"])
+
+    assert gitlab_session.requested_urls == ["https://gitlab.test/api/v4/groups/company%2Fbackend/projects"]
+    assert [p.id for p in found["company/backend/new"]] == [100]
+
+
+def test_find_projects__stale_catalog__projects_outside_of_the_scopes_are_not_added(
+    gitlab_session: _FakeGitlabSession, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    catalog.find_projects(["company/backend"])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    gitlab_session.projects.append(_project(100, "company/frontend/new_service", now.isoformat()))
+    monkeypatch.setattr(catalog, "CATALOG_TTL", datetime.timedelta(seconds=-1))
+
+    catalog.find_projects(["company/backend"])
+
+    stored_catalog = catalog.ProjectCatalog.load(tmp_path / "gitlab/gitlab.test.json", "git@gitlab.test")
+    assert len(stored_catalog.projects) == 12
+    assert 100 not in stored_catalog.projects
+
+
+def test_find_projects__relist_is_due__deleted_projects_are_dropped(
+    gitlab_session: _FakeGitlabSession, monkeypatch: pytest.MonkeyPatch
+):
+    catalog.find_projects(["company/backend"])
+    gitlab_session.projects = [p for p in gitlab_session.projects if p["id"] != 1]
+    monkeypatch.setattr(catalog, "CATALOG_TTL", datetime.timedelta(seconds=-1))
+    monkeypatch.setattr(catalog, "CATALOG_RELIST_INTERVAL", datetime.timedelta(seconds=-1))
+
+    found = catalog.find_projects(["company/backend"])
+
+    assert len(found["company/backend"]) == 11
+    assert 1 not in {p.id for p in found["company/backend"]}
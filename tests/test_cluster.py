@@ -0,0 +1,87 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import dotenv
+import pytest
+import typer
+
+from stb import cluster
+
+
+@pytest.fixture
+def workspace(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    for name, port in [("first", "5432"), ("second", None)]:
+        (tmp_path / name / "settings").mkdir(parents=True)
+        (tmp_path / name / "settings/.env.example").write_text("POSTGRES_PORT=\nPOSTGRES_USER=\n")
+        (tmp_path / name / "settings/.env").write_text(
+            (f"POSTGRES_PORT={port}\n" if port else "") + f"POSTGRES_USER={name}_user\n"
+        )
+    monkeypatch.setattr(cluster, "get_cluster_state_path", lambda paths: tmp_path / "state.json")
+    monkeypatch.setattr(cluster, "get_ram_backed_dir", lambda: tmp_path)
+    return tmp_path
+
+
+def test_cluster_up_and_down__rewrite_and_restore_postgres_ports(workspace: Path, monkeypatch: pytest.MonkeyPatch):
+    started: List[Dict[str, str]] = []
+    stopped: List[Path] = []
+    monkeypatch.setattr(cluster, "stop_cluster", lambda data_dir: stopped.append(data_dir))
+
+    def start_cluster(data_dir: Path, port: int, users: Dict[str, str]):
+        started.append(users)
+        (data_dir / "postmaster.pid").write_text(f"{os.getpid()}\n{data_dir}\n")
+
+    monkeypatch.setattr(cluster, "start_cluster", start_cluster)
+
+    def ports():
+        return {
+            name: dotenv.dotenv_values(workspace / name / "settings/.env").get("POSTGRES_PORT")
+            for name in ["first", "second"]
+        }
+
+    cluster.up([workspace], port=54400, recursive=False, max_depth=None)
+    assert started == [{"first_user": "", "second_user": ""}]
+    assert ports() == {"first": "54400", "second": "54400"}
+
+    cluster.up([workspace], port=54401, recursive=False, max_depth=None)
+    assert len(started) == 1
+
+    cluster.down([workspace])
+    assert len(stopped) == 1 and stopped[0].parent == workspace
+    assert ports() == {"first": "5432", "second": None}
+    with pytest.raises(typer.Exit):
+        cluster.down([workspace])
+
+
+def test_cluster_up__failed_start__cleans_up_and_keeps_ports(workspace: Path, monkeypatch: pytest.MonkeyPatch):
+    stopped: List[Path] = []
+
+    def fail(data_dir, port, users):
+        raise RuntimeError("initdb failed")
+
+    monkeypatch.setattr(cluster, "start_cluster", fail)
+    monkeypatch.setattr(cluster, "stop_cluster", lambda data_dir: stopped.append(data_dir))
+    with pytest.raises(RuntimeError):
+        cluster.up([workspace], recursive=False, max_depth=None)
+
+    assert len(stopped) == 1
+    assert not (workspace / "state.json").exists()
+    assert dotenv.dotenv_values(workspace / "first/settings/.env")["POSTGRES_PORT"] == "5432"
+
+
+def test_cluster_up__cluster_is_gone__ports_are_restored_and_a_new_cluster_is_started(
+    workspace: Path, monkeypatch: pytest.MonkeyPatch
+):
+    started: List[int] = []
+    monkeypatch.setattr(cluster, "start_cluster", lambda data_dir, port, users: started.append(port))
+    (workspace / "first/settings/.env").write_text("POSTGRES_PORT=54400\nPOSTGRES_USER=first_user\n")
+    state = {"data_dir": str(workspace / "wiped"), "port": 54400, "services": {str(workspace / "first"): "5432"}}
+    (workspace / "state.json").write_text(json.dumps(state))
+
+    cluster.up([workspace], port=54401, recursive=False, max_depth=None)
+
+    assert started == [54401]
+    new_state = json.loads((workspace / "state.json").read_text())
+    assert new_state["services"][str(workspace / "first")] == "5432"
+    assert dotenv.dotenv_values(workspace / "first/settings/.env")["POSTGRES_PORT"] == "54401"
@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import pytest
+import typer
+
+from stb.utils import common
+from stb.utils.common import gather_services
+
+
+@pytest.fixture
+def workspace(tmp_path: Path):
+    for i in range(common.PARALLEL_LOAD_THRESHOLD):
+        (tmp_path / f"service{i}/settings").mkdir(parents=True)
+        (tmp_path / f"service{i}/settings/.env.example").write_text("# Comment\nA=1\nB=\n")
+        (tmp_path / f"service{i}/settings/.env").write_text("A=2\n")
+    (tmp_path / "service0/.helm").mkdir()
+    (tmp_path / "service0/.helm/values.yaml").write_text("common:\n  envs: {}\n")
+    return tmp_path
+
+
+def test_service__files_are_read_once_and_only_when_needed(workspace: Path, monkeypatch: pytest.MonkeyPatch):
+    reads = []
+    original_read = common.safely_read_text
+    monkeypatch.setattr(common, "safely_read_text", lambda path: reads.append(path.name) or original_read(path))
+
+    service = gather_services([workspace])["service0"]
+    assert reads == []
+
+    assert service.dotenv_example == {"A": "1", "B": ""}
+    assert service.dotenv_example_original_source.startswith("# Comment")
+    assert service.dotenv == {"A": "2"}
+    assert service.dotenv is service.dotenv
+    assert reads == [".env.example"]
+    assert service.yaml_config == {"common": {"envs": {}}}
+    assert reads == [".env.example", "values.yaml"]
+    assert not hasattr(service, "__dict__")
+
+
+def test_gather_services__requested_fields_are_loaded_concurrently(workspace: Path):
+    services = gather_services([workspace], load=("dotenv",))
+
+    assert len(services) == common.PARALLEL_LOAD_THRESHOLD
+    assert all(service._dotenv == {"A": "2"} for service in services.values())
+    assert all(service._yaml_config is common._NOT_LOADED for service in services.values())
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_unpack_root_path__recursive__prunes_ignored_directories_and_stops_at_services(tmp_path: Path, workers: int):
+    for service in ["backend/first", "backend/first/vendored/nested", "infra/second", "a/b/c/third"]:
+        (tmp_path / service / "settings").mkdir(parents=True)
+        (tmp_path / service / "settings/.env.example").write_text("")
+    for ignored in ["node_modules/service", ".git/service", "old/service", "infra/tmp/service", "a/archive/service"]:
+        (tmp_path / ignored / "settings").mkdir(parents=True)
+        (tmp_path / ignored / "settings/.env.example").write_text("")
+    (tmp_path / ".stbignore").write_text("# Comment\nold\ninfra/tmp\n")
+    (tmp_path / "a/.stbignore").write_text("arch*\n")
+
+    def find(max_depth):
+        return sorted(p.relative_to(tmp_path).as_posix() for p in common.unpack_root_path(tmp_path, max_depth, workers))
+
+    assert find(None) == ["a/b/c/third", "backend/first", "infra/second"]
+    assert find(2) == ["backend/first", "infra/second"]
+    assert find(1) == []
+    assert sorted(gather_services([tmp_path], load=("dotenv",), max_depth=None)) == ["first", "second", "third"]
+
+
+@pytest.mark.parametrize("use_index", [True, False])
+def test_gather_services__recursive__services_with_the_same_name_are_rejected(tmp_path: Path, use_index: bool):
+    for service in ["backend/auth", "infra/auth"]:
+        (tmp_path / service / "settings").mkdir(parents=True)
+        (tmp_path / service / "settings/.env.example").write_text("")
+
+    with pytest.raises(typer.BadParameter, match="two services named 'auth'"):
+        gather_services([tmp_path], max_depth=None, use_index=use_index)
+    assert list(gather_services([tmp_path / "backend", tmp_path / "backend/auth"], use_index=use_index)) == ["auth"]
@@ -0,0 +1,231 @@
+import contextlib
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+import dotenv
+import pytest
+import typer
+
+from stb import db as db_module
+from stb.db import Choices
+from stb.utils import postgres
+from stb.utils.common import get_service
+from stb.utils.parallel import PrefixedLog
+from stb.utils.postgres import PostgresServer, create_databases, drop_databases, quote_identifier
+
+
+def test_quote_identifier():
+    assert quote_identifier('my"db') == '"my""db"'
+
+
+def test_create_and_drop_databases_over_a_single_connection(postgres_server):
+    if postgres.get_postgres_driver() is None:
+        pytest.skip("No postgres driver is installed")
+    names = {f"stb_test_{uuid.uuid4().hex[:8]}", f"stb_test_{uuid.uuid4().hex[:8]}"}
+
+    assert create_databases(postgres_server, names) == {name: None for name in sorted(names)}
+    results = create_databases(postgres_server, names)
+    assert all("already exists" in error for error in results.values())
+    assert drop_databases(postgres_server, names, force=True) == {name: None for name in sorted(names)}
+    assert all(drop_databases(postgres_server, names).values())
+
+
+def test_create_and_drop_databases_without_a_driver(postgres_server, monkeypatch: pytest.MonkeyPatch):
+    if shutil.which("createdb") is None:
+        pytest.skip("Postgres client tools are not installed")
+    monkeypatch.setattr(postgres, "get_postgres_driver", lambda: None)
+    name = f"stb_test_{uuid.uuid4().hex[:8]}"
+
+    assert create_databases(postgres_server, [name]) == {name: None}
+    assert create_databases(postgres_server, [name])[name]
+    assert drop_databases(postgres_server, [name]) == {name: None}
+
+
+@pytest.fixture
+def migrated_service(tmp_path: Path, postgres_server: PostgresServer, monkeypatch: pytest.MonkeyPatch):
+    if postgres.get_postgres_driver() is None:
+        pytest.skip("No postgres driver is installed")
+    monkeypatch.setattr(db_module, "get_upgrade_cache_path", lambda service: tmp_path / "cache/upgrades.json")
+    db = f"stb_test_{uuid.uuid4().hex[:8]}"
+    (tmp_path / "settings").mkdir()
+    (tmp_path / "settings/.env.example").write_text("POSTGRES_DB=\n")
+    (tmp_path / "settings/.env").write_text(
+        f"POSTGRES_DB={db}\nPOSTGRES_PORT={postgres_server.port}\n"
+        f"POSTGRES_USER={postgres_server.user}\nPOSTGRES_PASSWORD={postgres_server.password}\n"
+    )
+    (tmp_path / f"migrations/{db}").mkdir(parents=True)
+    (tmp_path / f"migrations/{db}/0_init.py").write_text("CREATE TABLE first (id int)")
+    yield tmp_path, db
+    drop_databases(postgres_server, [db, db_module.get_snapshot_name(db)], force=True)
+
+
+def test_create_with_snapshots_skips_migrations_that_are_already_in_the_snapshot(
+    migrated_service, postgres_server: PostgresServer, monkeypatch: pytest.MonkeyPatch
+):
+    service_dir, db = migrated_service
+    migration_runs = []
+
+    def fake_aerich_upgrade(log: PrefixedLog, cmd: str, *args, **kwargs):
+        migration_runs.append(cmd)
+        with contextlib.closing(postgres_server.connect(db)) as connection, connection.cursor() as cursor:
+            for migration in sorted((service_dir / f"migrations/{db}").iterdir()):
+                cursor.execute(migration.read_text().replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"))
+        return True
+
+    def reset():
+        migration_runs.clear()
+        db_module.run_on_single_service(service_dir, Choices.drop, force_drop=True)
+        db_module.run_on_single_service(service_dir, Choices.create, use_snapshots=True)
+
+    def tables():
+        with contextlib.closing(postgres_server.connect(db)) as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT tablename::text FROM pg_tables WHERE schemaname = 'public' ORDER BY tablename")
+            return [row[0] for row in cursor.fetchall()]
+
+    monkeypatch.setattr(PrefixedLog, "sh", fake_aerich_upgrade)
+    reset()
+    assert migration_runs == ["poetry run aerich upgrade", f"poetry run aerich --app {db} upgrade"]
+    assert tables() == ["first"]
+
+    reset()
+    assert migration_runs == []
+    assert tables() == ["first"]
+
+    (service_dir / f"migrations/{db}/1_second.py").write_text("CREATE TABLE second (id int)")
+    reset()
+    assert migration_runs == ["poetry run aerich upgrade", f"poetry run aerich --app {db} upgrade"]
+    assert tables() == ["first", "second"]
+
+    reset()
+    assert migration_runs == []
+
+    (service_dir / f"migrations/{db}/0_init.py").write_text("CREATE TABLE changed (id int)")
+    reset()
+    assert migration_runs == ["poetry run aerich upgrade", f"poetry run aerich --app {db} upgrade"]
+    assert tables() == ["changed", "second"]
+
+
+def test_upgrade_skips_apps_whose_migrations_and_databases_have_not_changed(
+    migrated_service, monkeypatch: pytest.MonkeyPatch
+):
+    service_dir, db = migrated_service
+    migration_runs = []
+
+    def fake_aerich_upgrade(log: PrefixedLog, cmd: str, *args, **kwargs):
+        migration_runs.append(cmd)
+        return True
+
+    def upgrade(**kwargs):
+        migration_runs.clear()
+        db_module.run_on_single_service(service_dir, Choices.upgrade, **kwargs)
+        return migration_runs
+
+    monkeypatch.setattr(PrefixedLog, "sh", fake_aerich_upgrade)
+    db_module.run_on_single_service(service_dir, Choices.create)
+    all_runs = ["poetry run aerich upgrade", f"poetry run aerich --app {db} upgrade"]
+
+    assert upgrade() == []
+    assert upgrade(force_upgrade=True) == all_runs
+
+    (service_dir / f"migrations/{db}/1_second.py").write_text("CREATE TABLE second (id int)")
+    assert upgrade() == all_runs
+    assert upgrade() == []
+
+    db_module.run_on_single_service(service_dir, Choices.drop)
+    db_module.run_on_single_service(service_dir, Choices.create)
+    assert migration_runs == all_runs
+
+
+def test_run_on_several_services__limits_jobs_per_server_and_collects_failures(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    for name, port in [("first", 5432), ("second", 5432), ("third", 5433), ("broken", 5433), ("no_db", 5432)]:
+        (tmp_path / name / "settings").mkdir(parents=True)
+        (tmp_path / name / "settings/.env.example").write_text("")
+        (tmp_path / name / "settings/.env").write_text(f"POSTGRES_PORT={port}\n")
+    lock, running, max_running, calls = threading.Lock(), Counter(), Counter(), []
+
+    def fake_run_on_single_service(service_path: Path, command: Choices, *args):
+        port = dotenv.dotenv_values(service_path / "settings/.env")["POSTGRES_PORT"]
+        with lock:
+            running[port] += 1
+            max_running[port] = max(max_running[port], running[port])
+            calls.append((service_path.name, command))
+        time.sleep(0.05)
+        with lock:
+            running[port] -= 1
+        if service_path.name == "broken":
+            raise RuntimeError("Failed to upgrade the migrations of broken")
+        elif service_path.name == "no_db":
+            db_module.get_postgres_server(get_service(service_path), PrefixedLog("no_db"))
+
+    monkeypatch.setattr(db_module, "run_on_single_service", fake_run_on_single_service)
+    with pytest.raises(typer.Exit):
+        db_module.run_on_several_services([tmp_path], [Choices.drop, Choices.create], jobs_per_server=1)
+
+    assert max_running == {"5432": 1, "5433": 1}
+    commands_by_service = {name: [command for service, command in calls if service == name] for name, _ in calls}
+    assert commands_by_service == {
+        "first": [Choices.drop, Choices.create],
+        "second": [Choices.drop, Choices.create],
+        "third": [Choices.drop, Choices.create],
+        "broken": [Choices.drop],
+        "no_db": [Choices.drop],
+    }
+
+
+def test_run_for_each_service__services_without_postgres_settings_are_skipped(
+    tmp_path: Path, capsys: pytest.CaptureFixture
+):
+    (tmp_path / "no_db/settings").mkdir(parents=True)
+    (tmp_path / "no_db/settings/.env.example").write_text("")
+
+    db_module.run_for_each_service(
+        [tmp_path], lambda service, log: db_module.get_postgres_server(service, log), "upgrade"
+    )
+
+    assert "Skipped the services without postgres settings: no_db" in capsys.readouterr().err
+
+
+def test_get_data_snapshot_dir__services_with_the_same_name_do_not_share_snapshots(tmp_path: Path):
+    for group in ("backend", "infra"):
+        (tmp_path / group / "auth/settings").mkdir(parents=True)
+
+    backend_dir = db_module.get_data_snapshot_dir(get_service(tmp_path / "backend/auth"), "seeded")
+    infra_dir = db_module.get_data_snapshot_dir(get_service(tmp_path / "infra/auth"), "seeded")
+
+    assert backend_dir != infra_dir
+    assert backend_dir.parent.name.startswith("auth-")
+
+
+def test_data_snapshot__restores_the_saved_data_and_detects_changed_migrations(
+    migrated_service, postgres_server: PostgresServer, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    if shutil.which("pg_dump") is None:
+        pytest.skip("Postgres client tools are not installed")
+    service_dir, db = migrated_service
+    service, log = get_service(service_dir), PrefixedLog(service_dir.name)
+    monkeypatch.setattr(db_module, "get_data_snapshot_dir", lambda service, name: tmp_path / "snapshots" / name)
+
+    def execute(sql: str):
+        with contextlib.closing(postgres_server.connect(db)) as connection, connection.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall() if cursor.description else None
+
+    create_databases(postgres_server, [db])
+    execute("CREATE TABLE items (id int); INSERT INTO items SELECT generate_series(1, 100)")
+    db_module.save_data_snapshot(service, "seeded", 2, log)
+    execute("DELETE FROM items")
+
+    db_module.restore_data_snapshot(service, "seeded", 2, False, log)
+    assert execute("SELECT count(*) FROM items") == [(100,)]
+
+    (service_dir / f"migrations/{db}/1_second.py").write_text("CREATE TABLE second (id int)")
+    with pytest.raises(RuntimeError, match="different migrations"):
+        db_module.restore_data_snapshot(service, "seeded", 2, False, log)
+    with pytest.raises(LookupError):
+        db_module.restore_data_snapshot(service, "missing", 2, False, log)
@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+from stb.utils.common import Service, save_dotenv_file
+from stb.utils.dotenv_document import DotenvDocument
+
+SOURCE = """# Database
+POSTGRES_USER=postgres
+export POSTGRES_HOST="localhost"  # inline comment
+DATABASE_URL=postgres://${POSTGRES_USER}@${POSTGRES_HOST}
+
+MULTILINE="first
+second"
+not a variable
+LAST=1"""
+
+
+def test_dotenv_document__round_trips_byte_for_byte():
+    document = DotenvDocument.parse(SOURCE)
+
+    assert str(document) == SOURCE
+    assert list(document) == ["POSTGRES_USER", "POSTGRES_HOST", "DATABASE_URL", "MULTILINE", "LAST"]
+    assert document.get("DATABASE_URL") == "postgres://${POSTGRES_USER}@${POSTGRES_HOST}"
+    assert document.values()["DATABASE_URL"] == "postgres://postgres@localhost"
+
+
+def test_dotenv_document__edits_only_touch_their_own_lines():
+    document = DotenvDocument.parse(SOURCE)
+
+    document.set("POSTGRES_USER", "admin")
+    document.set("POSTGRES_HOST", '"127.0.0.1"')
+    document.set("LAST", "2")
+    document.set("NEW", '"quoted value"', after="POSTGRES_USER")
+    document.set("APPENDED", "3")
+    document.remove("MULTILINE")
+
+    assert str(document) == (
+        "# Database\n"
+        "POSTGRES_USER=admin\n"
+        'NEW="quoted value"\n'
+        'export POSTGRES_HOST="127.0.0.1"  # inline comment\n'
+        "DATABASE_URL=postgres://${POSTGRES_USER}@${POSTGRES_HOST}\n"
+        "\n"
+        "not a variable\n"
+        "LAST=2\n"
+        "APPENDED=3\n"
+    )
+    assert document.values()["NEW"] == "quoted value"
+    assert document.values()["DATABASE_URL"] == "postgres://admin@127.0.0.1"
+
+
+def test_save_dotenv_file__without_the_dotenv_parser__the_file_is_rewritten(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setitem(sys.modules, "stb.utils.dotenv_document", None)
+    (tmp_path / "settings").mkdir()
+    (tmp_path / "settings/.env").write_text("# Stale comment\nB=2\nA=1\n")
+    service = Service(tmp_path, dotenv={"A": "1", "B": "3", "C": "4"}, dotenv_example_original_source="# A\nA=\nB=\n")
+
+    assert save_dotenv_file(service) is not None
+    assert (tmp_path / "settings/.env").read_text() == (
+        "# A\nA=1\nB=3\n\n# =======================================\n# Env vars not present in .env.example\n"
+        "# =======================================\n\nC=4\n"
+    )
+    assert save_dotenv_file(service) is None
+
+
+def test_save_dotenv_file__symlinked_dotenv__the_target_is_written_and_the_link_is_kept(tmp_path: Path):
+    shared_dotenv = tmp_path / "shared.env"
+    shared_dotenv.write_text("A=1\n")
+    (tmp_path / "service/settings").mkdir(parents=True)
+    (tmp_path / "service/settings/.env").symlink_to(shared_dotenv)
+    service = Service(tmp_path / "service", dotenv={"A": "2"}, dotenv_example_original_source="A=\n")
+
+    save_dotenv_file(service)
+
+    assert (tmp_path / "service/settings/.env").is_symlink()
+    assert shared_dotenv.read_text() == "A=2\n"
@@ -0,0 +1,204 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+import requests
+
+from stb import graph
+from stb.catalog import CatalogProject
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, content: bytes = b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+class _FakeGitlabSession:
+    def __init__(self, files):
+        self.files = files
+        self.forbidden = set()
+        self.downloads = []
+        self.refs = []
+
+    def head(self, url: str, params=None):
+        self.refs.append(params["ref"])
+        project_id = int(url.split("/projects/")[1].split("/")[0])
+        if project_id not in self.files:
+            return _FakeResponse(404)
+        blob_id = hashlib.sha1(self.files[project_id].encode()).hexdigest()
+        return _FakeResponse(200, headers={"X-Gitlab-Blob-Id": blob_id})
+
+    def get(self, url: str, params=None):
+        project_id = int(url.split("/projects/")[1].split("/")[0])
+        self.downloads.append(project_id)
+        self.refs.append(params["ref"])
+        if project_id in self.forbidden:
+            return _FakeResponse(403)
+        return _FakeResponse(200, self.files[project_id].encode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _project(id: int) -> CatalogProject:
+    return CatalogProject(id, f"p{id}", f"g/p{id}", f"p{id}", f"g / p{id}", "", "main", "")
+
+
+def _pyproject(name: str, *dependencies: str) -> str:
+    return f'[tool.poetry]\nname = "{name}"\n[tool.poetry.dependencies]\n' + "".join(
+        f'{d} = "*"\n' for d in dependencies
+    )
+
+
+def test_get_dependency_records__unchanged_pyproject__cached_record_is_reused(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    session = _FakeGitlabSession({1: _pyproject("first-service", "python"), 2: _pyproject("second-service")})
+    monkeypatch.setattr(graph, "gitlab_session", lambda *_: session)
+    monkeypatch.setattr(graph, "get_gitlab_api_url", lambda: "https://gitlab.test/api/v4")
+    projects = [_project(1), _project(2), _project(3)]
+
+    first_run_cache = graph.DependencyCache.load(tmp_path / "cache.json")
+    records = {project.id: record for project, record in graph.get_dependency_records(projects, first_run_cache)}
+    first_run_cache.save()
+    session.files[2] = _pyproject("second-service", "first-service-sdk")
+    second_run_cache = graph.DependencyCache.load(tmp_path / "cache.json")
+    list(graph.get_dependency_records(projects, second_run_cache))
+
+    assert records[1]["service_name"] == "first"
+    assert records[1]["dependencies"] == ["python"]
+    assert records[3] is None
+    assert sorted(session.downloads) == [1, 2, 2]
+    assert (second_run_cache.reused, second_run_cache.refetched) == (1, 1)
+
+
+def test_get_dependency_records__unreadable_pyproject__project_is_skipped(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    session = _FakeGitlabSession({1: _pyproject("first-service"), 2: "[tool.poetry", 3: _pyproject("third-service")})
+    session.forbidden.add(3)
+    monkeypatch.setattr(graph, "gitlab_session", lambda *_: session)
+    monkeypatch.setattr(graph, "get_gitlab_api_url", lambda: "https://gitlab.test/api/v4")
+    cache = graph.DependencyCache.load(tmp_path / "cache.json")
+
+    records = {
+        project.id: record
+        for project, record in graph.get_dependency_records([_project(1), _project(2), _project(3)], cache)
+    }
+
+    assert records[1]["service_name"] == "first"
+    assert records[2] is None
+    assert records[3] is None
+
+
+def test_get_dependency_records__no_default_branch__blob_sha_and_contents_come_from_the_same_ref(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    session = _FakeGitlabSession({1: _pyproject("first-service")})
+    monkeypatch.setattr(graph, "gitlab_session", lambda *_: session)
+    monkeypatch.setattr(graph, "get_gitlab_api_url", lambda: "https://gitlab.test/api/v4")
+    project = CatalogProject(1, "p1", "g/p1", "p1", "g / p1", "", None, "")
+
+    list(graph.get_dependency_records([project], graph.DependencyCache.load(tmp_path / "cache.json")))
+
+    assert session.refs == ["HEAD", "HEAD"]
+
+
+SCANNERS = [
+    "python",
+    pytest.param("ripgrep", marks=pytest.mark.skipif(not graph.RIPGREP_INSTALLED, reason="rg is not installed")),
+]
+
+
+@pytest.mark.parametrize("scanner", SCANNERS)
+def test_find_connector_usages_in_project__both_scanners__scan_the_same_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, scanner: str
+):
+    if scanner == "python":
+        monkeypatch.setattr(graph, "RIPGREP_INSTALLED", None)
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app/main.py").write_text(
+        "from payments_sdk.connectors.http import PaymentsConnector\nfrom auth_sdk.models import User\n"
+    )
+    (tmp_path / "app/generated.py").write_text("from billing.connectors import BillingConnector\n")
+    (tmp_path / ".gitignore").write_text("app/generated.py\n")
+    (tmp_path / "README.md").write_text("from auth_sdk.connectors import AuthConnector\n")
+    for ignored_dir in [".venv", "node_modules"]:
+        (tmp_path / ignored_dir).mkdir()
+        (tmp_path / ignored_dir / "lib.py").write_text("from ledger.connectors import LedgerConnector\n")
+
+    found = graph.find_connector_usages_in_project(tmp_path, ["payments_sdk", "auth_sdk", "ledger", "billing"])
+
+    assert found == {"payments_sdk", "billing"}
+
+
+@pytest.mark.parametrize("scanner", SCANNERS)
+def test_find_connector_usages_in_project__overlapping_names__usage_is_credited_to_the_imported_dependency(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, scanner: str
+):
+    if scanner == "python":
+        monkeypatch.setattr(graph, "RIPGREP_INSTALLED", None)
+    (tmp_path / "main.py").write_text(
+        "from auth_sdk.connectors import AuthConnector\nfrom oauth.connectors import OAuthConnector\n"
+    )
+
+    found = graph.find_connector_usages_in_project(tmp_path, ["auth", "auth_sdk", "oauth_sdk"])
+
+    assert found == {"auth_sdk"}
+
+
+def test_json__local_checkouts__internal_packages_are_taken_from_local_package_names(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(graph, "get_cache_dir", lambda: tmp_path / "cache")
+    workspace = tmp_path / "backend"
+    for name, pyproject in {
+        "orders": _pyproject("orders-service", "python", "payments-service", "auth_service"),
+        "payments": _pyproject("payments-service", "python", "auth-service", "requests"),
+        "auth": _pyproject("auth-service", "python"),
+        "docs": "",
+    }.items():
+        (workspace / name).mkdir(parents=True)
+        (workspace / name / "pyproject.toml").write_text(pyproject)
+
+    dep_mapping = graph.json_(None, [], False, False, workspace)
+
+    assert dep_mapping == {
+        "auth": {"id": None, "name": "auth", "name_with_namespace": "backend / auth", "dependencies": []},
+        "orders": {
+            "id": None,
+            "name": "orders",
+            "name_with_namespace": "backend / orders",
+            "dependencies": ["payments-service", "auth-service"],
+        },
+        "payments": {
+            "id": None,
+            "name": "payments",
+            "name_with_namespace": "backend / payments",
+            "dependencies": ["auth-service"],
+        },
+    }
+
+
+def test_json__local_single_project_with_a_broken_neighbour__project_is_its_own_namespace(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(graph, "get_cache_dir", lambda: tmp_path / "cache")
+    (tmp_path / "orders").mkdir()
+    (tmp_path / "orders/pyproject.toml").write_text(_pyproject("orders-service", "python"))
+    (tmp_path / "broken").mkdir()
+    (tmp_path / "broken/pyproject.toml").write_text("[tool.poetry")
+
+    assert (
+        graph.json_(None, [], False, False, tmp_path / "orders")["orders"]["name_with_namespace"] == "orders / orders"
+    )
+    assert list(graph.json_(None, [], False, False, tmp_path)) == ["orders"]
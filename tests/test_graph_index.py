@@ -0,0 +1,38 @@
+from stb.graph_index import GraphIndex
+
+DEP_MAPPING = {
+    "orders": {"dependencies": ["payments", "auth"]},
+    "payments": {"dependencies": ["auth", "ledger"]},
+    "ledger": {"dependencies": ["auth"]},
+    "auth": {"dependencies": []},
+    "reports": {"dependencies": ["orders"]},
+}
+
+
+def test_dependents__transitive__every_service_to_redeploy_is_returned():
+    index = GraphIndex.from_dependency_mapping(DEP_MAPPING)
+
+    assert sorted(index.dependents("ledger")) == ["orders", "payments", "reports"]
+    assert sorted(index.dependents("ledger", transitive=False)) == ["payments"]
+    assert sorted(index.dependencies("orders")) == ["auth", "ledger", "payments"]
+
+
+def test_topological_order__dependencies_come_first():
+    order = GraphIndex.from_dependency_mapping(DEP_MAPPING).topological_order()
+
+    assert len(order) == len(DEP_MAPPING)
+    for service, info in DEP_MAPPING.items():
+        assert all(order.index(dep) < order.index(service) for dep in info["dependencies"])
+
+
+def test_cycles__only_components_with_cycles_are_returned():
+    index = GraphIndex([("a", "b"), ("b", "c"), ("c", "a"), ("c", "d"), ("e", "e")])
+
+    assert sorted(sorted(cycle) for cycle in index.cycles()) == [["a", "b", "c"], ["e"]]
+    assert index.topological_order() == ["d"]
+
+
+def test_fan_in_out__sorted_by_number_of_dependents():
+    ranking = GraphIndex.from_dependency_mapping(DEP_MAPPING).fan_in_out()
+
+    assert ranking[0] == ("auth", 3, 0)
@@ -0,0 +1,81 @@
+from pathlib import Path
+
+import pytest
+
+from stb.utils.lockfile import LockDiffError, get_installed_distributions, plan_lock_changes, read_lock_file
+
+LOCK = """
+[[package]]
+name = "Requests"
+version = "2.31.0"
+files = [{file = "requests-2.31.0-py3-none-any.whl", hash = "sha256:abc"}]
+
+[package.dependencies]
+urllib3 = ">=1.21.1,<3"
+importlib-metadata = {version = ">=1", python = "<3.8"}
+
+[[package]]
+name = "urllib3"
+version = "2.0.7"
+
+[[package]]
+name = "numpy"
+version = "1.24.4"
+
+[[package]]
+name = "numpy"
+version = "1.26.1"
+
+[[package]]
+name = "company-package"
+version = "0.1.0"
+
+[package.source]
+type = "git"
+url = "https://gitlab.com/company/package.git"
+"""
+
+
+@pytest.fixture
+def locked(tmp_path: Path):
+    (tmp_path / "poetry.lock").write_text(LOCK)
+    return read_lock_file(tmp_path / "poetry.lock")
+
+
+def test_read_lock_file(locked):
+    assert locked["requests"][0].hashes == ["sha256:abc"]
+    assert set(locked["requests"][0].dependencies) == {"urllib3", "importlib-metadata"}
+    assert [p.version for p in locked["numpy"]] == ["1.24.4", "1.26.1"]
+    assert not locked["company-package"][0].installable_by_pip
+
+
+def test_get_installed_distributions(tmp_path: Path):
+    dist_info = tmp_path / "lib/python3.11/site-packages/Typing_Extensions-4.8.0.dist-info"
+    dist_info.mkdir(parents=True)
+    (dist_info / "METADATA").write_text("Metadata-Version: 2.1\nName: typing_extensions\nVersion: 4.8.0\n\nBody: 1\n")
+    assert get_installed_distributions(tmp_path) == {"typing-extensions": "4.8.0"}
+
+
+def test_plan_lock_changes__upgrades_removes_and_adds_unconditional_dependencies(locked):
+    to_install, to_remove = plan_lock_changes(
+        locked,
+        {"requests": ["2.28.0"], "idna": ["3.4"], "numpy": ["1.24.4", "1.26.1"], "importlib-metadata": ["6.0"]},
+        {"requests": "2.28.0", "idna": "3.4", "numpy": "1.26.1", "my-service": "0.1.0", "pip": "23.2"},
+        "my-service",
+    )
+    assert [(p.name, p.version) for p in to_install] == [("requests", "2.31.0"), ("urllib3", "2.0.7")]
+    assert to_remove == ["idna"]
+
+
+@pytest.mark.parametrize(
+    "installed",
+    [
+        {"numpy": "1.20.0"},
+        {"company-package": "0.0.1"},
+        {"requests": "2.31.0", "urllib3": "2.0.7"},
+    ],
+    ids=["several locked versions", "git source", "new conditional dependency"],
+)
+def test_plan_lock_changes__refuses_to_guess(locked, installed):
+    with pytest.raises(LockDiffError):
+        plan_lock_changes(locked, {}, installed, "my-service")
@@ -0,0 +1,98 @@
+import pytest
+import typer
+
+from stb import use
+from stb.registry import RegistryIndex, version_key, version_matches
+
+
+@pytest.mark.parametrize(
+    "version, constraint, expected",
+    [
+        ("4.5.0", "^4.5", True),
+        ("4.9.1", "^4.5", True),
+        ("5.0.0", "^4.5", False),
+        ("4.4.9", "^4.5", False),
+        ("0.2.9", "^0.2.3", True),
+        ("0.3.0", "^0.2.3", False),
+        ("1.2.9", "~1.2.3", True),
+        ("1.3.0", "~1.2.3", False),
+        ("1.9", "~=1.2", True),
+        ("2.0", "~=1.2", False),
+        ("8.3.1", "==8.3.1", True),
+        ("8.3.1", "8.3", False),
+        ("8.3.0", "8.3", True),
+        ("1.2.7", "1.2.*", True),
+        ("1.5", ">=1.2,<2", True),
+        ("2.0.0rc1", "^1.0", False),
+        ("9.9.9", "latest", True),
+    ],
+)
+def test_version_matches(version: str, constraint: str, expected: bool):
+    assert version_matches(version, constraint) is expected
+
+
+def test_registry_index_add__versions_are_deduplicated_and_sorted(tmp_path):
+    index = RegistryIndex(tmp_path / "index.json")
+
+    index.add(
+        {"name": "my-package", "version": version, "created_at": f"2023-01-0{i}T00:00:00Z"}
+        for i, version in enumerate(["1.10.0", "1.2.0", "1.10.0", "1.10.0rc1", "0.9"], start=1)
+    )
+
+    assert index.packages == {"my-package": ["0.9", "1.2.0", "1.10.0rc1", "1.10.0"]}
+    assert index.newest_created_at == "2023-01-05T00:00:00Z"
+    assert index.find_name("My_Package") == "my-package"
+    assert index.matching_versions("my-package", "^1.2") == ["1.2.0", "1.10.0"]
+    assert sorted(["2.0", "10.0", "2.0.1"], key=version_key) == ["2.0", "2.0.1", "10.0"]
+
+
+@pytest.mark.parametrize(
+    "version, constraint, expected",
+    [
+        ("2.1.0", "^1.0 || ^2.0", True),
+        ("1.4.0", "^1.0 | ^2.0", True),
+        ("3.0.0", "^1.0 || ^2.0", False),
+        ("1.10.0rc1", "^1.2", False),
+        ("1.10.0rc1", ">=1.10.0rc1,<2", True),
+        ("1.10.0rc1", "latest", False),
+        ("1.0.post1", "^1.0", True),
+    ],
+)
+def test_version_matches__alternatives_and_prereleases(version: str, constraint: str, expected: bool):
+    assert version_matches(version, constraint) is expected
+
+
+def test_registry_index_matching_versions__prereleases_only_when_nothing_else_matches(tmp_path):
+    index = RegistryIndex(tmp_path / "index.json")
+    index.packages = {"my-package": ["1.2.0", "2.0.0a1"]}
+
+    assert index.matching_versions("my-package", "*") == ["1.2.0"]
+    assert index.matching_versions("my-package", ">=1.5") == ["2.0.0a1"]
+
+
+def test_validate_version_in_registry__syncs_before_rejecting_a_version(tmp_path, monkeypatch):
+    index = RegistryIndex(tmp_path / "index.json")
+    index.packages = {"my-package": ["1.0.0"]}
+    monkeypatch.setattr(use, "sync_registry_index", lambda index: index.packages["my-package"].append("1.1.0"))
+
+    use.validate_version_in_registry(index, "my-package", "==1.1.0")
+
+    monkeypatch.setattr(use, "sync_registry_index", lambda index: None)
+    with pytest.raises(typer.BadParameter, match="No version of 'my-package' matches '==2.0.0'"):
+        use.validate_version_in_registry(index, "my-package", "==2.0.0")
+
+
+def test_version_key__pre_release_numbers_are_compared_as_numbers():
+    versions = ["1.0.0", "1.0.0a10", "1.0.0rc1", "1.0.0a2", "1.0.0.dev1", "1.0.0b1", "1.0.post10", "1.0.post2"]
+
+    assert sorted(versions, key=version_key) == [
+        "1.0.0.dev1",
+        "1.0.0a2",
+        "1.0.0a10",
+        "1.0.0b1",
+        "1.0.0rc1",
+        "1.0.0",
+        "1.0.post2",
+        "1.0.post10",
+    ]
+    assert version_matches("1.0.0a10", ">1.0.0a2")
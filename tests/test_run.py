@@ -0,0 +1,27 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from stb import run
+
+
+class _FakePoetryEnv:
+    def command(self, *args: str) -> str:
+        return " ".join(args)
+
+
+def test_run_services__relative_service_path__dependencies_are_installed_in_the_service_dir(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    (tmp_path / "svc").mkdir()
+    monkeypatch.chdir(tmp_path)
+    installed_dirs = []
+    monkeypatch.setattr(run, "sh_with_log", lambda cmd: None)
+    monkeypatch.setattr(run, "install_dependencies", lambda project_dir, log: installed_dirs.append(project_dir))
+    monkeypatch.setattr(run, "get_poetry_env", lambda project_dir: _FakePoetryEnv())
+
+    run.run_services({"svc"})
+
+    assert installed_dirs == [tmp_path / "svc"]
+    assert Path(os.getcwd()) == tmp_path
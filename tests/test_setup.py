@@ -1,2 +1,41 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from stb import setup
+from stb.config import CONFIG
+
+
 def test_setup_one_repo(dummy_microservice):
     pass
+
+
+def _make_git_repo(path: Path) -> Path:
+    path.mkdir(parents=True)
+    (path / "README.md").write_text("hello")
+    subprocess.run(
+        "git init -q && git add . && git -c user.name=t -c user.email=t@t commit -qm init", shell=True, cwd=path
+    )
+    return path
+
+
+def test_setup_services__one_failed_clone__other_repos_are_still_cloned(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    origins = tmp_path / "origins"
+    repos = {name: str(_make_git_repo(origins / name)) for name in ("first", "second")}
+    repos["broken"] = str(origins / "does_not_exist")
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    monkeypatch.chdir(workspace)
+    monkeypatch.setitem(CONFIG.doc, "git_url", "git@localhost")
+    monkeypatch.setattr(setup, "get_repositories_to_clone", lambda *_: list(repos.items()))
+    monkeypatch.setattr(setup, "get_log_dir", lambda: tmp_path / "logs")
+
+    setup.setup_services(list(repos), True, False, False, False, clone_workers=3)
+
+    assert (workspace / "first/README.md").exists()
+    assert (workspace / "second/README.md").exists()
+    assert not (workspace / "broken").exists()
+    assert "git clone" in (tmp_path / "logs/setup/broken.log").read_text()
@@ -0,0 +1,44 @@
+import subprocess
+import sys
+from typing import Dict, List
+
+import pytest
+
+# Microseconds of cumulative import time of the stb package, including typer and click
+STARTUP_IMPORT_BUDGET = 600_000
+HEAVY_MODULES = {"gitlab", "requests", "keyring", "tomlkit", "yaml", "dotenv"}
+
+
+def get_import_times(args: List[str], tmp_path) -> Dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"from stb import app; app({args!r})"],
+        capture_output=True,
+        text=True,
+        cwd=tmp_path,
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("package"):
+            _, cumulative, module = line.removeprefix("import time:").split("|")
+            import_times[module.strip()] = int(cumulative)
+    return import_times
+
+
+@pytest.mark.parametrize(
+    "args, allowed_heavy_modules",
+    [
+        (["--version"], set()),
+        (["update", "env", "."], {"dotenv"}),
+        (["db", "--help"], {"dotenv"}),
+    ],
+)
+def test_startup__common_commands__heavy_modules_are_not_imported_and_budget_is_kept(
+    args, allowed_heavy_modules, tmp_path
+):
+    import_times = get_import_times(args, tmp_path)
+
+    assert "stb" in import_times
+    assert import_times["stb"] < STARTUP_IMPORT_BUDGET
+    assert {module for module in import_times if module.split(".")[0] in HEAVY_MODULES} <= {
+        module for module in import_times if module.split(".")[0] in allowed_heavy_modules
+    }
@@ -0,0 +1,47 @@
+import json
+import subprocess
+from pathlib import Path
+
+from typer.testing import CliRunner
+
+from stb import app
+
+GIT = "git -c user.name=t -c user.email=t@t"
+
+
+def _git(cwd: Path, command: str) -> None:
+    subprocess.run(f"{GIT} {command}", shell=True, cwd=cwd, check=True, capture_output=True)
+
+
+def _make_service(path: Path) -> Path:
+    (path / "settings").mkdir(parents=True)
+    (path / "settings/.env.example").write_text("A=1\n")
+    return path
+
+
+def test_status__reports_branches_changes_and_ahead_behind_counts(tmp_path: Path):
+    origin = _make_service(tmp_path / "origin")
+    _git(origin, "init -q -b master && git add . && " + GIT + " commit -qm init")
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    for name in ["clean", "dirty"]:
+        _git(workspace, f"clone -q {origin} {name}")
+    _make_service(workspace / "not_a_repo")
+    _git(workspace / "dirty", "checkout -qb feature && echo B=2 >> settings/.env.example && touch new_file")
+    _git(workspace / "clean", "commit -q --allow-empty -m local")
+    _git(origin, "commit -q --allow-empty -m remote")
+
+    result = CliRunner().invoke(app, ["status", str(workspace), "--fetch", "--json"])
+
+    assert result.exit_code == 0, result.output
+    statuses = {status["name"]: status for status in json.loads(result.output)}
+    assert statuses["clean"]["branch"] == "master"
+    assert (statuses["clean"]["ahead"], statuses["clean"]["behind"]) == (1, 1)
+    assert not statuses["clean"]["dirty"]
+    assert statuses["dirty"]["branch"] == "feature"
+    assert (statuses["dirty"]["changed"], statuses["dirty"]["untracked"], statuses["dirty"]["upstream"]) == (1, 1, None)
+    assert statuses["not_a_repo"]["errors"]
+
+    result = CliRunner().invoke(app, ["status", str(workspace)])
+    assert result.exit_code == 0
+    assert "feature" in result.output
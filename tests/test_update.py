@@ -0,0 +1,68 @@
+import os
+import stat
+from pathlib import Path
+
+import dotenv
+import pytest
+from typer.testing import CliRunner
+
+from stb import update
+
+
+@pytest.fixture
+def workspace(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    for name in ["first", "second", "broken"]:
+        (tmp_path / name / "settings").mkdir(parents=True)
+        (tmp_path / name / "settings/.env.example").write_text("SERVICE_PORT=\nSECOND_URL=\n")
+        (tmp_path / name / "settings/.env").write_text("SECOND_URL=https://example.com\n")
+    bin_dir = tmp_path / "fake_bin"
+    bin_dir.mkdir()
+    poetry = bin_dir / "poetry"
+    poetry.write_text('#!/bin/sh\n[ "$(basename "$PWD")" != broken ]\n')
+    poetry.chmod(poetry.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr("stb.config.get_log_dir", lambda: tmp_path / "logs")
+    return tmp_path
+
+
+def test_package__runs_steps_as_a_graph__ports_once_and_dependents_of_failures_are_skipped(
+    workspace: Path, monkeypatch: pytest.MonkeyPatch
+):
+    reset_services = []
+    monkeypatch.setattr(
+        update, "reset_databases", lambda service, log, use_snapshots: reset_services.append(service.dir.name)
+    )
+
+    result = CliRunner().invoke(update.app, ["package", str(workspace), "--env", "--ports"])
+
+    assert result.exit_code == 1
+    assert "[broken] install failed" in result.output
+    assert sorted(reset_services) == ["first", "second"]
+    dotenvs = {name: dotenv.dotenv_values(workspace / name / "settings/.env") for name in ["first", "second", "broken"]}
+    assert sorted(d["SERVICE_PORT"] for d in dotenvs.values()) == ["8000", "8001", "8002"]
+    assert dotenvs["first"]["SECOND_URL"] == f"http://localhost:{dotenvs['second']['SERVICE_PORT']}"
+
+
+def test_env__writes_only_files_that_change_and_check_reports_the_diff(tmp_path: Path):
+    (tmp_path / "settings").mkdir()
+    (tmp_path / "settings/.env.example").write_text("# Ports\nSERVICE_PORT=\nLOG_LEVEL=\nSECOND_URL=\n")
+    dotenv_path = tmp_path / "settings/.env"
+    dotenv_path.write_text("# My own comment\nSERVICE_PORT=8000\nSECOND_URL='https://example.com'\n")
+
+    result = CliRunner().invoke(update.app, ["env", str(tmp_path), "--check"])
+    assert result.exit_code == 1
+    assert "+LOG_LEVEL=INFO" in result.output
+    assert "Would change 1 .env files, 0 unchanged" in result.output
+    assert "LOG_LEVEL" not in dotenv_path.read_text()
+
+    result = CliRunner().invoke(update.app, ["env", str(tmp_path)])
+    assert result.exit_code == 0
+    assert dotenv_path.read_text() == (
+        "# My own comment\nSERVICE_PORT=8000\nLOG_LEVEL=INFO\nSECOND_URL='https://example.com'\n"
+    )
+    mtime = dotenv_path.stat().st_mtime_ns
+
+    result = CliRunner().invoke(update.app, ["env", str(tmp_path)])
+    assert "Changed 0 .env files, 1 unchanged" in result.output
+    assert dotenv_path.stat().st_mtime_ns == mtime
+    assert CliRunner().invoke(update.app, ["env", str(tmp_path), "--check"]).exit_code == 0
@@ -0,0 +1,129 @@
+import os
+import stat
+from pathlib import Path
+
+import pytest
+
+from stb.utils import venv
+from stb.utils.parallel import PrefixedLog
+from stb.utils.venv import get_poetry_env, install_dependencies
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    project_dir, venv_dir, bin_dir = tmp_path / "project", tmp_path / "venv", tmp_path / "fake_bin"
+    for directory in (project_dir, venv_dir / "bin", bin_dir):
+        directory.mkdir(parents=True)
+    (project_dir / "pyproject.toml").write_text("[tool.poetry]\n")
+    (project_dir / "poetry.lock").write_text("")
+    (venv_dir / "bin/python").write_text("")
+    (venv_dir / "bin/aerich").write_text("")
+    (venv_dir / "pyvenv.cfg").write_text("home = /usr/bin\nversion = 3.11.7\n")
+    poetry = bin_dir / "poetry"
+    poetry.write_text(
+        "#!/bin/sh\n" f'echo "$@" >> {tmp_path / "poetry_calls"}\n' f'if [ "$1" = env ]; then echo {venv_dir}; fi\n'
+    )
+    poetry.chmod(poetry.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(venv, "get_venv_cache_path", lambda project_dir: tmp_path / "cache.json")
+    monkeypatch.setattr(venv, "get_install_cache_path", lambda project_dir: tmp_path / "install_fingerprint")
+    return project_dir, venv_dir
+
+
+def test_get_poetry_env__resolves_the_venv_once_until_the_lock_file_changes(project, tmp_path: Path):
+    project_dir, venv_dir = project
+
+    def poetry_calls():
+        return len((tmp_path / "poetry_calls").read_text().splitlines())
+
+    env = get_poetry_env(project_dir)
+    assert env.command("aerich", "--app models upgrade") == f"{venv_dir / 'bin/aerich'} --app models upgrade"
+    assert env.command("uvicorn") == "poetry run uvicorn"
+    assert env.poetry_overhead > 0
+    assert poetry_calls() == 1
+
+    assert get_poetry_env(project_dir) == env
+    assert poetry_calls() == 1
+
+    os.utime(project_dir / "poetry.lock", ns=(0, 0))
+    assert get_poetry_env(project_dir).venv_dir == venv_dir
+    assert poetry_calls() == 2
+
+
+def test_get_poetry_env__without_a_venv__falls_back_to_poetry_run(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("PATH", str(tmp_path))
+    monkeypatch.setattr(venv, "get_venv_cache_path", lambda project_dir: tmp_path / "cache.json")
+
+    assert get_poetry_env(tmp_path).command("aerich", "upgrade") == "poetry run aerich upgrade"
+
+
+def test_install_dependencies__skips_installs_until_something_that_affects_them_changes(project, tmp_path: Path):
+    project_dir, venv_dir = project
+    log = PrefixedLog("project")
+
+    def installs():
+        return [call for call in (tmp_path / "poetry_calls").read_text().splitlines() if call.startswith("install")]
+
+    install_dependencies(project_dir, log)
+    install_dependencies(project_dir, log)
+    assert installs() == ["install --all-extras"]
+
+    (project_dir / "pyproject.toml").write_text('[tool.poetry]\ndescription = "Changed"\n')
+    install_dependencies(project_dir, log)
+    assert len(installs()) == 1
+
+    for change in [
+        lambda: (project_dir / "poetry.lock").write_text('[[package]]\nname = "requests"\nversion = "2.31.0"\n'),
+        lambda: (project_dir / "pyproject.toml").write_text('[tool.poetry.dependencies]\nrequests = "*"\n'),
+        lambda: (venv_dir / "pyvenv.cfg").write_text("version = 3.12.0\n"),
+    ]:
+        change()
+        install_dependencies(project_dir, log)
+        install_dependencies(project_dir, log)
+    assert len(installs()) == 4
+
+    install_dependencies(project_dir, log, args="")
+    assert installs()[-1] == "install"
+
+
+def test_install_dependencies__installs_only_the_changes_of_the_lock_file(project, tmp_path: Path):
+    project_dir, venv_dir = project
+    log = PrefixedLog("project")
+    python = venv_dir / "bin/python"
+    python.write_text(
+        "#!/bin/sh\n"
+        f'echo "$@" >> {tmp_path / "pip_calls"}\n'
+        "eval last=\\${$#}\n"
+        f'if [ -f "$last" ]; then cat "$last" >> {tmp_path / "pip_calls"}; fi\n'
+    )
+    python.chmod(python.stat().st_mode | stat.S_IEXEC)
+    for name, version in [("requests", "2.28.0"), ("idna", "3.4")]:
+        dist_info = venv_dir / f"lib/python3.11/site-packages/{name}-{version}.dist-info"
+        dist_info.mkdir(parents=True)
+        (dist_info / "METADATA").write_text(f"Name: {name}\nVersion: {version}\n")
+    lock = project_dir / "poetry.lock"
+    lock.write_text(
+        '[[package]]\nname = "requests"\nversion = "2.28.0"\n\n[[package]]\nname = "idna"\nversion = "3.4"\n'
+    )
+    install_dependencies(project_dir, log, partial=True)
+
+    lock.write_text(
+        '[[package]]\nname = "requests"\nversion = "2.31.0"\n\n[package.dependencies]\nurllib3 = "*"\n\n'
+        '[[package]]\nname = "urllib3"\nversion = "2.0.7"\n'
+    )
+    install_dependencies(project_dir, log, partial=True)
+    pip_calls = (tmp_path / "pip_calls").read_text()
+    assert "install --no-deps" in pip_calls
+    assert "requests==2.31.0\nurllib3==2.0.7\n" in pip_calls
+    assert "uninstall --yes idna" in pip_calls
+    assert (tmp_path / "poetry_calls").read_text().count("install") == 1
+
+    # Whether the new package is needed depends on a marker that only poetry can evaluate
+    lock.write_text(
+        lock.read_text().replace(
+            'urllib3 = "*"', 'urllib3 = "*"\ncolorama = {version = "*", markers = "os_name == \'nt\'"}'
+        )
+        + '\n[[package]]\nname = "colorama"\nversion = "0.4.6"\n'
+    )
+    install_dependencies(project_dir, log, partial=True)
+    assert (tmp_path / "poetry_calls").read_text().count("install") == 2
@@ -0,0 +1,60 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from stb.utils import workspace_index
+from stb.utils.common import gather_services
+from stb.utils.workspace_index import WorkspaceIndex
+
+
+@pytest.fixture
+def workspace(tmp_path: Path):
+    root = tmp_path / "workspace"
+    for name in ["first", "second"]:
+        (root / name / "settings").mkdir(parents=True)
+        (root / name / "settings/.env.example").write_text("A=1\n")
+        (root / name / "settings/.env").write_text("A=2\n")
+        (root / name / ".helm").mkdir()
+        (root / name / ".helm/values.yaml").write_text("common: {envs: {A: {review: '3'}}}\n")
+    (root / "not_a_service").mkdir()
+    return root
+
+
+def test_workspace_index__parses_only_the_files_that_have_changed(workspace: Path, monkeypatch: pytest.MonkeyPatch):
+    index = WorkspaceIndex.open(workspace)
+    services = index.get_services(load=["dotenv", "yaml_config"])
+    assert (index.hits, index.misses) == (0, 4)
+    assert services["first"].dotenv == {"A": "2"}
+    services["first"].dotenv["A"] = "changed in memory only"
+    services["first"].yaml_config["common"]["envs"]["A"]["review"] = "changed in memory only"
+    index.save()
+    assert index.path.stat().st_mode & 0o777 == 0o600
+
+    (workspace / "second/settings/.env").write_text("A=22\n")
+    index = WorkspaceIndex.open(workspace)
+    services = index.get_services(load=["dotenv", "yaml_config"])
+    assert (index.hits, index.misses) == (3, 1)
+    assert services["first"].dotenv == {"A": "2"}
+    assert services["second"].dotenv == {"A": "22"}
+    assert services["first"].yaml_config == {"common": {"envs": {"A": {"review": "3"}}}}
+    index.save()
+
+    shutil.rmtree(workspace / "first")
+    shutil.copytree(workspace / "second", workspace / "third")
+    monkeypatch.setitem(workspace_index.FILE_LOADERS, workspace_index.HELM_VALUES_FILE, pytest.fail)
+    index = WorkspaceIndex.open(workspace)
+    services = index.get_services(load=["dotenv"])
+    assert sorted(services) == ["second", "third"]
+    assert services["third"].dotenv == {"A": "22"}
+    assert not any(key.startswith("first/") for key in index.files)
+
+
+def test_gather_services__uses_the_index_of_root_directories(workspace: Path):
+    gather_services([workspace], load=["dotenv_example"])
+
+    index = WorkspaceIndex.open(workspace)
+    services = index.get_services()
+    assert (index.hits, index.misses) == (2, 0)
+    assert services["first"].dotenv_example == {"A": "1"}
+    assert services["first"].dotenv_example_original_source == "A=1\n"